@@ -9,7 +9,12 @@ if [ "$execution_mode" == "k8s" ]; then
   # TODO: build into run_nginx.py script
   sed -i 's/resolver 127.0.0.11/resolver kube-dns.kube-system.svc.cluster.local/g' /etc/nginx/nginx.conf
   namespace="$(cat /var/run/secrets/kubernetes.io/serviceaccount/namespace)"
-  sed -i "s/set \$service_suffix ''/set \$service_suffix .$namespace.svc.cluster.local/g" /etc/nginx/nginx.conf
+  service_suffix=".$namespace.svc.cluster.local"
+  if [ "${KUBERNETES_ROUTING_MODE:-service}" == "headless" ]; then
+    # workspace pods are resolved via the headless service shared by all pods (see mlhubkubernetesspawner.py)
+    service_suffix=".${HUB_NAME:-mlhub}-workspaces$service_suffix"
+  fi
+  sed -i "s/set \$service_suffix ''/set \$service_suffix $service_suffix/g" /etc/nginx/nginx.conf
 
   # Preserve Kubernetes-specific environment variables for sshd process
   echo "export KUBERNETES_SERVICE_HOST=$KUBERNETES_SERVICE_HOST" >> $SSHD_ENVIRONMENT_VARIABLES
@@ -3,22 +3,30 @@ Web service that is supposed to be started via JupyterHub.
 By this, the service has access to some information passed
 by JupyterHub. For more information check out https://jupyterhub.readthedocs.io/en/stable/reference/services.html
 
+All work runs on the tornado IOLoop: the Hub API is called with an async HTTP client and the blocking Docker / Kubernetes
+calls are executed in a bounded thread pool. Manually triggered cleanups run as background jobs whose progress can be queried.
+As the logs are hard to reach, the service exposes Prometheus metrics about its jobs and calls under `/metrics`.
+
 Note: Logs probably don't appear in stdout, as the service is started as a subprocess by JupyterHub
 """
 
 import os
-import urllib3
 import json
 import time
-import math
-from threading import Thread
+import uuid
+import collections
+import heapq
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
-from tornado import web, ioloop
+from tornado import web, ioloop, gen
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
 from jupyterhub.services.auth import HubAuthenticated
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 import docker.errors
-from kubernetes import client, config, stream
+from kubernetes import client, stream, watch
 
 from mlhubspawner import utils
 
@@ -32,235 +40,825 @@ auth_header = {"Authorization": "token " + jupyterhub_api_token}
 
 execution_mode = os.environ[utils.ENV_NAME_EXECUTION_MODE]
 
-http = urllib3.PoolManager()
+# Number of Docker / Kubernetes calls that are executed in parallel
+max_workers = int(os.getenv(utils.ENV_NAME_CLEANUP_MAX_WORKERS, 16))
+executor = ThreadPoolExecutor(max_workers)
+
+# A failed removal is retried with exponential backoff: 0.5s, 1s, 2s, ...
+REMOVE_MAX_TRIES = 4
+REMOVE_INITIAL_BACKOFF_SECONDS = 0.5
+
+# Number of users requested per page from the Hub API. JupyterHub caps it at its `api_page_max_limit`.
+HUB_API_PAGE_SIZE = 200
+
+# The removal of an expired workspace is delayed by up to this window, so that workspaces expiring shortly after it are removed together
+EXPIRY_BATCH_WINDOW_SECONDS = 5
+
+# Seconds to wait before reconnecting to the Docker events stream after it broke
+EVENTS_RECONNECT_DELAY_SECONDS = 5
+
+# The Kubernetes pod watch is reopened after this time (from the last resourceVersion, so no events are lost)
+POD_WATCH_TIMEOUT_SECONDS = 300
+# Seconds to wait for the initial pod listing before the pods are listed directly
+POD_INDEX_SYNC_TIMEOUT_SECONDS = 30
+
+# Number of deleted users whose Kubernetes resources are removed with one deletecollection call per kind.
+# Bounds the length of the label selector.
+KUBERNETES_USER_BATCH_SIZE = 50
+
+# Number of finished jobs whose progress can still be queried
+MAX_STORED_JOBS = 100
+
+RESOURCE_KIND_CONTAINER = "container"
+RESOURCE_KIND_NETWORK = "network"
+RESOURCE_KIND_VOLUME = "volume"
+RESOURCE_KIND_SERVICE = "service"
+
+JOB_KIND_USERS = "users"
+JOB_KIND_EXPIRED = "expired"
 
 if execution_mode == utils.EXECUTION_MODE_LOCAL:
     docker_client_kwargs = json.loads(os.getenv("DOCKER_CLIENT_KWARGS"))
     docker_tls_kwargs = json.loads(os.getenv("DOCKER_TLS_CONFIG"))
-    docker_client = utils.init_docker_client(docker_client_kwargs, docker_tls_kwargs)
+    docker_client = utils.get_docker_client(docker_client_kwargs, docker_tls_kwargs)
 elif execution_mode == utils.EXECUTION_MODE_KUBERNETES:
-    # incluster config is the config given by a service account and it's role permissions
-    config.load_incluster_config()
-    kubernetes_client = client.CoreV1Api()
+    # same client setup as the hub's spawners: incluster config (or kubeconfig outside of a cluster) and a sized keep-alive pool
+    kubernetes_client = utils.get_kubernetes_client()
 
 hub_name = utils.ENV_HUB_NAME
 origin_label = "{}={}".format(utils.LABEL_MLHUB_ORIGIN, hub_name)
 origin_label_filter = {"label": origin_label}
 
-class UnifiedContainer():
+JOB_DURATION = Histogram("mlhub_cleanup_job_duration_seconds", "Duration of the cleanup jobs", ["kind", "status"],
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, float("inf")))
+RESOURCES_SCANNED = Counter("mlhub_cleanup_resources_scanned_total", "Resources scanned by the cleanup jobs", ["kind"])
+RESOURCES_REMOVED = Counter("mlhub_cleanup_resources_removed_total", "Resources removed by the cleanup jobs", ["kind", "result"])
+HUB_API_REQUEST_DURATION = Histogram("mlhub_cleanup_hub_api_request_duration_seconds", "Latency of the Hub API requests", ["method", "code"])
+BACKEND_CALL_DURATION = Histogram("mlhub_cleanup_backend_call_duration_seconds", "Latency of the Docker / Kubernetes calls", ["operation"])
+REMOVE_RETRIES = Counter("mlhub_cleanup_remove_retries_total", "Retries of failed removals")
+OLDEST_OVERDUE_WORKSPACE = Gauge("mlhub_cleanup_oldest_overdue_workspace_seconds",
+    "Seconds since the expiration of the oldest expired workspace that is not removed yet (0 if there is none)")
+
+def run_blocking(func, *args, operation: str = None, **kwargs):
+    """Run a blocking call, e.g. of the Docker or Kubernetes client, in the bounded executor.
 
-    def __init__(self, resource):
-        self.remove = lambda: logging.info("Remove property is not defined")
-        self.resource = resource
+    Args:
+        operation (str): name of the call in the latency metrics (default: the function name)
 
-    def with_id(self, id):
+    Returns:
+        Future: to be awaited on the IOLoop
+    """
+
+    operation = operation or getattr(func, "__name__", "call")
+
+    def timed_call():
+        start_time = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            BACKEND_CALL_DURATION.labels(operation=operation).observe(time.time() - start_time)
+
+    return ioloop.IOLoop.current().run_in_executor(executor, timed_call)
+
+async def hub_api_request(method: str, path: str, body: dict = None, headers: dict = None, raise_error: bool = True):
+    """Call the JupyterHub REST API without blocking the IOLoop.
+
+    Returns:
+        tornado.httpclient.HTTPResponse
+    """
+
+    start_time = time.time()
+    code = 599
+    try:
+        response = await AsyncHTTPClient().fetch(
+            jupyterhub_api_url + path,
+            method=method,
+            headers={**auth_header, **(headers or {})},
+            body=json.dumps(body).encode("utf-8") if body is not None else None,
+            # JupyterHub expects a body for some DELETE requests
+            allow_nonstandard_methods=True,
+            raise_error=raise_error
+        )
+        code = response.code
+        return response
+    except HTTPClientError as e:
+        code = e.code
+        raise
+    finally:
+        HUB_API_REQUEST_DURATION.labels(method=method, code=str(code)).observe(time.time() - start_time)
+
+async def try_to_remove(remove_callback, resource_name: str) -> bool:
+    """Call the remove callback until the call succeeds or until the number of tries is exceeded.
+    Between the tries, it waits with exponential backoff without blocking the IOLoop.
+
+        Returns:
+            bool: True if it could be removed, False if it was not removable within the number of tries
+    """
+
+    backoff_seconds = REMOVE_INITIAL_BACKOFF_SECONDS
+    for i in range(REMOVE_MAX_TRIES):
+        try:
+            await run_blocking(remove_callback, operation="remove")
+            return True
+        except docker.errors.NotFound:
+            # already removed
+            return True
+        except (docker.errors.APIError, client.rest.ApiException) as e:
+            if getattr(e, "status", None) == 404:
+                return True
+            if i < REMOVE_MAX_TRIES - 1:
+                REMOVE_RETRIES.inc()
+                await gen.sleep(backoff_seconds)
+                backoff_seconds *= 2
+
+    logging.info("Could not remove " + resource_name)
+    return False
+
+class CleanupJob():
+    """Progress of a cleanup run, which can be queried via the jobs endpoint."""
+
+    def __init__(self, kind: str):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = "pending"
+        self.message = ""
+        self.scanned = 0
+        self.to_remove = 0
+        self.removed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        self.future = None
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in ("pending", "running")
+
+    def track_scanned(self, resources: list) -> None:
+        self.scanned += len(resources)
+        for resource in resources:
+            RESOURCES_SCANNED.labels(kind=resource.kind).inc()
+
+    def track_removal(self, successful: bool, kind: str) -> None:
+        if successful:
+            self.removed += 1
+        else:
+            self.failed += 1
+        RESOURCES_REMOVED.labels(kind=kind, result="removed" if successful else "failed").inc()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "message": self.message,
+            "scanned": self.scanned,
+            "to_remove": self.to_remove,
+            "removed": self.removed,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+jobs = collections.OrderedDict()
+
+# ETag, user names, and the following page of each page of the last user listing (see get_hub_usernames)
+user_pages_cache = {}
+
+async def run_job(job: CleanupJob, cleanup_function) -> None:
+    job.status = "running"
+    try:
+        await cleanup_function(job)
+        job.status = "finished"
+    except UserWarning as e:
+        job.status = "failed"
+        job.message = str(e)
+    except Exception as e:
+        logging.exception("Cleanup job {} failed".format(job.kind))
+        job.status = "failed"
+        job.message = str(e)
+    finally:
+        job.finished_at = time.time()
+        JOB_DURATION.labels(kind=job.kind, status=job.status).observe(job.finished_at - job.started_at)
+
+def start_job(kind: str, cleanup_function) -> CleanupJob:
+    """Start the cleanup function as a background job on the IOLoop. If a job of the same kind is already running,
+    that job is returned instead of starting a second one.
+
+        Args:
+            kind (str): kind of the job, e.g. JOB_KIND_USERS
+            cleanup_function (func): async function that gets the job passed to report its progress
+
+        Returns:
+            CleanupJob: the job; `job.future` can be awaited
+    """
+
+    for job in jobs.values():
+        if job.kind == kind and job.is_active:
+            return job
+
+    job = CleanupJob(kind)
+    jobs[job.id] = job
+    while len(jobs) > MAX_STORED_JOBS:
+        jobs.popitem(last=False)
+
+    job.future = gen.convert_yielded(run_job(job, cleanup_function))
+    return job
+
+class HubResource():
+    """A container, network, or volume created by the hub. Built from the low-level Docker listings, which contain the labels
+    and, hence, do not need an additional inspect call per resource.
+    """
+
+    def __init__(self, kind: str, id: str, name: str, labels: dict):
+        self.kind = kind
         self.id = id
-        return self
-    
-    def with_name(self, name):
         self.name = name
-        return self
-    
-    def with_labels(self, labels):
-        self.labels = labels
-        return self
-    
-    def with_remove(self, func):
-        self.remove = lambda: func(self.resource)
-        return self
-
-def extract_container(resource):
-    if execution_mode == utils.EXECUTION_MODE_LOCAL:
-        unified_container = UnifiedContainer(resource) \
-            .with_id(resource.id) \
-            .with_name(resource.name) \
-            .with_labels(resource.labels) \
-            .with_remove(lambda container: container.remove(v=True, force=True))
-    elif execution_mode == utils.EXECUTION_MODE_KUBERNETES:
-        unified_container = UnifiedContainer(resource) \
-            .with_id(resource.metadata.uid) \
-            .with_name(resource.metadata.name) \
-            .with_labels(resource.metadata.labels)
+        self.labels = labels or {}
 
-    if unified_container == None:
-        raise UserWarning("The execution mode environment variable is not set correctly")
+    @property
+    def user_name(self) -> str:
+        return self.labels.get(utils.LABEL_MLHUB_USER)
 
-    return unified_container
+def docker_container_to_resource(container: dict) -> HubResource:
+    """Convert an entry of the low-level Docker container listing."""
+    return HubResource(RESOURCE_KIND_CONTAINER, container["Id"], (container.get("Names") or [container["Id"]])[0].lstrip("/"), container.get("Labels"))
 
-def get_hub_docker_resources(docker_client_obj):
-    return docker_client_obj.list(filters=origin_label_filter)
+def pod_to_resource(pod) -> HubResource:
+    return HubResource(RESOURCE_KIND_CONTAINER, pod.metadata.uid, pod.metadata.name, pod.metadata.labels)
 
 def get_hub_kubernetes_resources(namespaced_list_command, **kwargs):
     return namespaced_list_command(hub_name, **kwargs).items
 
-def get_hub_containers():
+class PodIndex():
+    """In-memory index of the hub's pods (Kubernetes mode), kept up-to-date by a watch stream that resumes from the last
+    resourceVersion. The pods are only listed again if the API server answers with '410 Gone', i.e. the resourceVersion
+    is too old. Hence, the load on the API server does not grow with the number of workspace pods.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pods = {}
+        self.resource_version = None
+        self.is_synced = Event()
+
+    def get_pods(self) -> list:
+        """Get all indexed pods. Waits for the initial listing; if it is not available in time, the pods are listed directly."""
+
+        if not self.is_synced.wait(POD_INDEX_SYNC_TIMEOUT_SECONDS):
+            return get_hub_kubernetes_resources(kubernetes_client.list_namespaced_pod, label_selector=origin_label)
+
+        with self._lock:
+            return list(self._pods.values())
+
+    def relist(self, io_loop) -> None:
+        pod_list = kubernetes_client.list_namespaced_pod(hub_name, label_selector=origin_label)
+        with self._lock:
+            self._pods = {pod.metadata.uid: pod for pod in pod_list.items}
+            self.resource_version = pod_list.metadata.resource_version
+        self.is_synced.set()
+        io_loop.add_callback(expiry_scheduler.set_workspaces, [pod_to_resource(pod) for pod in pod_list.items if is_pod_running(pod)])
+
+    def watch(self, io_loop) -> None:
+        """Apply the pod events to the index and forward them to the expiry scheduler. Runs in its own thread, as the watch stream is blocking."""
+
+        while True:
+            try:
+                if self.resource_version is None:
+                    self.relist(io_loop)
+
+                pod_watch = watch.Watch()
+                for event in pod_watch.stream(kubernetes_client.list_namespaced_pod, hub_name, label_selector=origin_label,
+                        resource_version=self.resource_version, timeout_seconds=POD_WATCH_TIMEOUT_SECONDS):
+                    if event["type"] == "ERROR":
+                        # Older clients report an expired resourceVersion as an event instead of an exception
+                        raise client.rest.ApiException(status=event["raw_object"].get("code"), reason=event["raw_object"].get("message"))
+
+                    pod = event["object"]
+                    with self._lock:
+                        if event["type"] == "DELETED":
+                            self._pods.pop(pod.metadata.uid, None)
+                        elif event["type"] in ("ADDED", "MODIFIED"):
+                            self._pods[pod.metadata.uid] = pod
+                        self.resource_version = pod.metadata.resource_version
+
+                    if event["type"] != "DELETED" and is_pod_running(pod):
+                        io_loop.add_callback(expiry_scheduler.add, pod_to_resource(pod))
+                    elif event["type"] in ("DELETED", "MODIFIED"):
+                        io_loop.add_callback(expiry_scheduler.remove, pod.metadata.uid)
+                continue
+            except client.rest.ApiException as e:
+                if e.status == 410:
+                    logging.info("Pod watch expired, list the pods again")
+                    self.resource_version = None
+                    continue
+                logging.warning("Pod watch broke: " + str(e))
+            except Exception as e:
+                logging.warning("Pod watch broke: " + str(e))
+
+            time.sleep(EVENTS_RECONNECT_DELAY_SECONDS)
+
+pod_index = PodIndex()
+
+def is_pod_running(pod) -> bool:
+    return pod.status is not None and pod.status.phase == "Running" and pod.metadata.deletion_timestamp is None
+
+def get_hub_containers() -> list:
+    """List the running workspaces of the hub, i.e. Docker containers or Kubernetes pods.
+
+    Returns:
+        list: list of HubResource
+    """
+
     if execution_mode == utils.EXECUTION_MODE_LOCAL:
-        hub_containers = get_hub_docker_resources(docker_client.containers)
+        hub_containers = [docker_container_to_resource(container) for container in docker_client.api.containers(filters=origin_label_filter)]
     elif execution_mode == utils.EXECUTION_MODE_KUBERNETES:
-        hub_containers = get_hub_kubernetes_resources(kubernetes_client.list_namespaced_pod, field_selector="status.phase=Running", label_selector=origin_label)
-    
+        hub_containers = [pod_to_resource(pod) for pod in pod_index.get_pods() if is_pod_running(pod)]
+
     return hub_containers
 
-def remove_deleted_user_resources(existing_user_names: []):
-    """Remove resources for which no user exists anymore by checking whether the label of user name occurs in the existing
-    users list.
+def remove_workspace_container(container: HubResource) -> None:
+    """Remove the container of a deleted workspace. In Kubernetes mode, deleting the server via the Hub API already removes the pod."""
 
-        Args:
-            existing_user_names: list of user names that exist in the JupyterHub database
+    if execution_mode == utils.EXECUTION_MODE_LOCAL:
+        docker_client.api.remove_container(container.id, v=True, force=True)
 
-        Raises:
-            UserWarning: in Kubernetes mode, the function does not work
+async def list_hub_docker_resources() -> list:
+    """List all containers (also stopped ones), networks, and volumes created by the hub. The three listings run concurrently.
+    Containers claimed from the warm pool carry no user labels, as Docker cannot add labels to an existing container.
+    They get the labels of the user network they were moved into on claim.
     """
 
-    if execution_mode == utils.EXECUTION_MODE_KUBERNETES:
-        raise UserWarning("This method cannot be used in following hub execution mode " + execution_mode)
+    def list_containers():
+        return docker_client.api.containers(all=True, filters=origin_label_filter)
 
-    def try_to_remove(remove_callback, resource) -> bool:
-        """Call the remove callback until the call succeeds or until the number of tries is exceeded.
+    def list_networks():
+        return [HubResource(RESOURCE_KIND_NETWORK, network["Id"], network["Name"], network.get("Labels"))
+            for network in docker_client.api.networks(filters=origin_label_filter)]
 
-            Returns:
-                bool: True if it could be removed, False if it was not removable within the number of tries
-        """
+    def list_volumes():
+        return [HubResource(RESOURCE_KIND_VOLUME, volume["Name"], volume["Name"], volume.get("Labels"))
+            for volume in (docker_client.api.volumes(filters=origin_label_filter).get("Volumes") or [])]
 
-        for i in range(3):
-            try:
-                remove_callback()
-                return True
-            except docker.errors.APIError:
-                time.sleep(3)
-        
-        logging.info("Could not remove " + resource.name)
-        return False
+    containers, networks, volumes = await gen.multi([run_blocking(list_containers), run_blocking(list_networks), run_blocking(list_volumes)])
 
+    network_labels = {network.name: network.labels for network in networks if network.user_name}
+    container_resources = []
+    for container in containers:
+        resource = docker_container_to_resource(container)
+        if not resource.user_name:
+            container_networks = ((container.get("NetworkSettings") or {}).get("Networks") or {}).keys()
+            user_labels = next((network_labels[name] for name in container_networks if name in network_labels), None)
+            if user_labels:
+                resource.labels = {**user_labels, **resource.labels}
+        container_resources.append(resource)
 
-    def find_and_remove(docker_client_obj, get_labels, action_callback) -> None:
-        """List all resources belonging to `docker_client_obj` which were created by MLHub.
-        Then check the list of resources for resources that belong to a user who does not exist anymore 
-        and call the remove function on them.
+    return [container_resources, networks, volumes]
 
-            Args:
-                docker_client_obj: A Python docker client object, such as docker_client.containers, docker_client.networks,... It must implement a .list() function (check https://docker-py.readthedocs.io/en/stable/containers.html)
-                get_labels (func): function to call on the docker resource to get the labels
-                remove (func): function to call on the docker resource to remove it                
-        """
+async def remove_user_resources(resources: list, job: CleanupJob) -> None:
+    """Remove all resources of one user. Containers are removed first, as networks and volumes cannot be removed while they are in use.
+    Each network is disconnected from the hub and removed right afterwards.
+    """
 
-        resources = get_hub_docker_resources(docker_client_obj)
-        for resource in resources:
-            user_label = get_labels(resource)[utils.LABEL_MLHUB_USER]
-            if user_label not in existing_user_names:
-                action_callback(resource)
-                # successful = try_to_remove(remove, resource)
-                    
-    def container_action(container):
-        try_to_remove(
-            lambda: container.remove(v=True, force=True), 
-            container
-        )
+    def get_resources(kind: str) -> list:
+        return [resource for resource in resources if resource.kind == kind]
 
-    find_and_remove(
-        docker_client.containers, 
-        lambda res: res.labels, 
-        container_action
-    )
+    async def remove_container(container: HubResource) -> bool:
+        return await try_to_remove(lambda: docker_client.api.remove_container(container.id, v=True, force=True), container.name)
 
-    def network_action(network):
+    async def remove_network(network: HubResource) -> bool:
         try:
-            network.disconnect(hub_name)
+            await run_blocking(docker_client.api.disconnect_container_from_network, hub_name, network.id)
         except docker.errors.APIError:
             pass
-        
-        try_to_remove(network.remove, network)
 
-    find_and_remove(
-        docker_client.networks, 
-        lambda res: res.attrs["Labels"], 
-        network_action
-    )
+        return await try_to_remove(lambda: docker_client.api.remove_network(network.id), network.name)
 
-    find_and_remove(
-        docker_client.volumes,
-        lambda res: res.attrs["Labels"],
-        lambda res: try_to_remove(res.remove, res)
-    )
+    async def remove_volume(volume: HubResource) -> bool:
+        return await try_to_remove(lambda: docker_client.api.remove_volume(volume.name), volume.name)
+
+    for remove_function, kind in ((remove_container, RESOURCE_KIND_CONTAINER), (remove_network, RESOURCE_KIND_NETWORK), (remove_volume, RESOURCE_KIND_VOLUME)):
+        results = await gen.multi([remove_function(resource) for resource in get_resources(kind)])
+        for successful in results:
+            job.track_removal(successful, kind)
+
+def list_hub_kubernetes_resources() -> list:
+    """List the pods (taken from the pod index), services, and persistent volume claims created by the hub."""
+
+    def list_pods():
+        return [pod_to_resource(pod) for pod in pod_index.get_pods()]
+
+    def list_services():
+        return [HubResource(RESOURCE_KIND_SERVICE, service.metadata.uid, service.metadata.name, service.metadata.labels)
+            for service in get_hub_kubernetes_resources(kubernetes_client.list_namespaced_service, label_selector=origin_label)]
+
+    def list_persistent_volume_claims():
+        return [HubResource(RESOURCE_KIND_VOLUME, pvc.metadata.uid, pvc.metadata.name, pvc.metadata.labels)
+            for pvc in get_hub_kubernetes_resources(kubernetes_client.list_namespaced_persistent_volume_claim, label_selector=origin_label)]
+
+    return gen.multi([run_blocking(list_pods), run_blocking(list_services), run_blocking(list_persistent_volume_claims)])
+
+def delete_kubernetes_services(label_selector: str) -> None:
+    """Delete all services matching the label selector. Older clients and API servers (Kubernetes < 1.19) do not support
+    deletecollection for services; then, the services are listed and deleted one by one.
+    """
 
-def get_hub_usernames() -> []:
-    r = http.request('GET', jupyterhub_api_url + "/users", 
-        headers = {**auth_header}
+    delete_collection = getattr(kubernetes_client, "delete_collection_namespaced_service", None)
+    if delete_collection is not None:
+        try:
+            delete_collection(hub_name, label_selector=label_selector)
+            return
+        except client.rest.ApiException as e:
+            if e.status not in (404, 405):
+                raise
+
+    for service in get_hub_kubernetes_resources(kubernetes_client.list_namespaced_service, label_selector=label_selector):
+        try:
+            kubernetes_client.delete_namespaced_service(service.metadata.name, hub_name, body=client.V1DeleteOptions())
+        except client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+
+async def remove_kubernetes_user_resources(user_names: list, resources: list, job: CleanupJob) -> None:
+    """Remove all resources of a batch of users with one deletecollection call per kind, selected via the `mlhub.origin` and
+    `mlhub.user` labels. Pods are removed first, so that their persistent volume claims are not in use anymore.
+    """
+
+    label_selector = "{},{} in ({})".format(origin_label, utils.LABEL_MLHUB_USER, ",".join(user_names))
+    delete_functions = (
+        (RESOURCE_KIND_CONTAINER, lambda: kubernetes_client.delete_collection_namespaced_pod(hub_name, label_selector=label_selector)),
+        (RESOURCE_KIND_SERVICE, lambda: delete_kubernetes_services(label_selector)),
+        (RESOURCE_KIND_VOLUME, lambda: kubernetes_client.delete_collection_namespaced_persistent_volume_claim(hub_name, label_selector=label_selector))
     )
 
-    data = json.loads(r.data.decode("utf-8"))
-    existing_user_names = []
-    for user in data:
-        existing_user_names.append(user["name"])
+    for kind, delete_function in delete_functions:
+        kind_resources = [resource for resource in resources if resource.kind == kind]
+        if not kind_resources:
+            continue
+
+        successful = await try_to_remove(delete_function, "{}s of users {}".format(kind, ", ".join(user_names)))
+        for _ in kind_resources:
+            job.track_removal(successful, kind)
+
+async def remove_deleted_user_resources(existing_user_names: [], job: CleanupJob):
+    """Remove resources for which no user exists anymore by checking whether the label of user name occurs in the existing
+    users list. The resources are grouped by user and the users are cleaned up in parallel (bounded by the executor).
+    In Kubernetes mode, the resources of up to KUBERNETES_USER_BATCH_SIZE users are removed together via label selectors.
+    Resources without a user label are skipped.
+
+        Args:
+            existing_user_names: list of user names that exist in the JupyterHub database
+            job: the job to report the progress to
+    """
+
+    existing_user_names = set(existing_user_names)
+    if execution_mode == utils.EXECUTION_MODE_KUBERNETES:
+        hub_resources = await list_hub_kubernetes_resources()
+    else:
+        hub_resources = await list_hub_docker_resources()
+
+    resources_by_user = collections.defaultdict(list)
+    for resources in hub_resources:
+        job.track_scanned(resources)
+        for resource in resources:
+            if not resource.user_name:
+                job.skipped += 1
+                logging.info("Skip {} {} without {} label".format(resource.kind, resource.name, utils.LABEL_MLHUB_USER))
+                continue
+
+            if resource.user_name not in existing_user_names:
+                resources_by_user[resource.user_name].append(resource)
+                job.to_remove += 1
+
+    if execution_mode == utils.EXECUTION_MODE_KUBERNETES:
+        user_names = sorted(resources_by_user.keys())
+        batches = [user_names[i:i + KUBERNETES_USER_BATCH_SIZE] for i in range(0, len(user_names), KUBERNETES_USER_BATCH_SIZE)]
+        await gen.multi([remove_kubernetes_user_resources(batch, [resource for user_name in batch for resource in resources_by_user[user_name]], job)
+            for batch in batches])
+        return
+
+    await gen.multi([remove_user_resources(resources, job) for resources in resources_by_user.values()])
+
+def decode_user_names(body: bytes):
+    """Decode a response of the Hub API's users endpoint, keeping only the user names. The object hook drops all other
+    fields (servers, groups, ...) while decoding, so that the full user models are never kept in memory.
+
+    Returns:
+        (list, dict): the user names and the pagination information (None if the Hub does not support pagination)
+    """
+
+    def keep_relevant_fields(obj: dict) -> dict:
+        return {key: obj[key] for key in ("name", "items", "_pagination", "next", "offset", "limit") if key in obj}
+
+    data = json.loads(body.decode("utf-8"), object_hook=keep_relevant_fields)
+    if isinstance(data, list):
+        # Hubs older than JupyterHub 2.0 ignore the pagination parameters and return all users at once
+        return [user["name"] for user in data], None
+
+    return [user["name"] for user in data["items"]], data["_pagination"]
+
+async def get_hub_usernames() -> set:
+    """Get the names of all hub users page by page. Each page is requested with the ETag of the last response,
+    so that unchanged pages are answered with '304 Not Modified' and taken from the cache instead of being downloaded again.
+
+    Returns:
+        set: the names of all users
+    """
+
+    existing_user_names = set()
+    offset = 0
+    limit = HUB_API_PAGE_SIZE
+    fetched_offsets = set()
+    while offset is not None and offset not in fetched_offsets:
+        fetched_offsets.add(offset)
+        cached_page = user_pages_cache.get(offset)
+        headers = {"Accept": "application/jupyterhub-pagination+json, application/json"}
+        if cached_page is not None:
+            headers["If-None-Match"] = cached_page["etag"]
+
+        r = await hub_api_request('GET', "/users?offset={}&limit={}".format(offset, limit), headers=headers, raise_error=False)
+        if r.code == 304 and cached_page is not None:
+            page = cached_page
+        elif r.code == 200:
+            user_names, pagination = decode_user_names(r.body)
+            next_page = (pagination or {}).get("next")
+            page = {
+                "etag": r.headers.get("Etag"),
+                "user_names": user_names,
+                "next_offset": next_page["offset"] if next_page else None,
+                "next_limit": next_page["limit"] if next_page else limit
+            }
+            if page["etag"]:
+                user_pages_cache[offset] = page
+            else:
+                user_pages_cache.pop(offset, None)
+        else:
+            # Never continue with an incomplete user list, otherwise resources of existing users would be removed
+            raise UserWarning("Could not get the hub users: {} {}".format(r.code, r.reason))
+
+        existing_user_names.update(page["user_names"])
+        offset = page["next_offset"]
+        limit = page["next_limit"]
+
+    # Forget pages that do not exist anymore, e.g. because users were deleted
+    for cached_offset in [cached_offset for cached_offset in user_pages_cache if cached_offset not in fetched_offsets]:
+        del user_pages_cache[cached_offset]
 
     return existing_user_names
 
-def remove_expired_workspaces(): 
-    hub_containers = get_hub_containers()
-    for container in hub_containers:
-        unified_container = extract_container(container)
-        lifetime_timestamp = utils.get_lifetime_timestamp(unified_container.labels)
-        if lifetime_timestamp != 0:
-            difference = math.ceil(lifetime_timestamp - time.time())
-            # container lifetime is exceeded (remaining lifetime is negative)
-            if difference < 0:
-                user_name = unified_container.labels[utils.LABEL_MLHUB_USER]
-                server_name = unified_container.labels[utils.LABEL_MLHUB_SERVER_NAME]
-                url = jupyterhub_api_url + "/users/{user_name}/servers/{server_name}".format(user_name=user_name, server_name=server_name)
-                r = http.request('DELETE', url,
-                    body = json.dumps({"remove": True}).encode('utf-8'),
-                    headers = {**auth_header}
-                )
-
-                if r.status == 202 or r.status == 204:
-                    logging.info("Delete expired container " + unified_container.name)
-                    unified_container.remove()
-
-class CleanupUserResources(HubAuthenticated, web.RequestHandler):
+async def remove_deleted_users_job(job: CleanupJob) -> None:
+    await remove_deleted_user_resources(await get_hub_usernames(), job)
+
+class ExpiryScheduler():
+    """Keeps the workspaces that have an expiration timestamp in a min-heap and wakes up EXPIRY_BATCH_WINDOW_SECONDS after
+    the next workspace expires. All workspaces that have expired by then are removed together in one job; no workspace is removed before it expires.
+    Must only be used on the IOLoop.
+    """
+
+    def __init__(self, is_enabled: bool = True):
+        self.is_enabled = is_enabled
+        # entries are (expiration_timestamp, container_id); entries of removed or changed workspaces are skipped lazily
+        self._heap = []
+        self._workspaces = {}
+        # ids and expiration timestamps of the workspaces that are currently being removed
+        self._in_progress = {}
+        self._timeout = None
+
+    def set_workspaces(self, containers: list) -> None:
+        """Replace all scheduled workspaces, e.g. with the result of a full listing."""
+
+        self._heap = []
+        self._workspaces = {}
+        for container in containers:
+            self._add(container)
+        heapq.heapify(self._heap)
+        self._reschedule()
+
+    def add(self, container: HubResource) -> None:
+        self._add(container, push=True)
+        self._reschedule()
+
+    def remove(self, container_id: str) -> None:
+        if self._workspaces.pop(container_id, None) is not None:
+            self._reschedule()
+
+    def pop_due(self, until: float = None) -> list:
+        """Remove and return all workspaces that expire until the given timestamp (default: now)."""
+
+        until = until if until is not None else time.time()
+        due_containers = []
+        while self._heap and self._heap[0][0] <= until:
+            expiration_timestamp, container_id = heapq.heappop(self._heap)
+            entry = self._workspaces.get(container_id)
+            if entry is not None and entry[0] == expiration_timestamp:
+                del self._workspaces[container_id]
+                self._in_progress[container_id] = expiration_timestamp
+                due_containers.append(entry[1])
+        return due_containers
+
+    def finish(self, containers: list) -> None:
+        """Mark the removal of workspaces returned by `pop_due` as done."""
+
+        for container in containers:
+            self._in_progress.pop(container.id, None)
+
+    def get_oldest_overdue_seconds(self) -> float:
+        """Seconds since the oldest expired workspace, which is not removed yet, has expired (0 if there is none)."""
+
+        expiration_timestamps = [entry[0] for entry in self._workspaces.values()] + list(self._in_progress.values())
+        return max(0, time.time() - min(expiration_timestamps, default=time.time()))
+
+    def _add(self, container: HubResource, push: bool = False) -> None:
+        expiration_timestamp = utils.get_lifetime_timestamp(container.labels)
+        if expiration_timestamp == 0 or container.id in self._in_progress:
+            self._workspaces.pop(container.id, None)
+            return
+
+        self._workspaces[container.id] = (expiration_timestamp, container)
+        if push:
+            heapq.heappush(self._heap, (expiration_timestamp, container.id))
+        else:
+            self._heap.append((expiration_timestamp, container.id))
+
+    def _reschedule(self) -> None:
+        # drop stale entries so that the heap's first entry is the next workspace to expire
+        while self._heap and self._workspaces.get(self._heap[0][1], (None,))[0] != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+        if self._timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+
+        if self.is_enabled and self._heap:
+            delay_seconds = max(0, self._heap[0][0] + EXPIRY_BATCH_WINDOW_SECONDS - time.time())
+            self._timeout = ioloop.IOLoop.current().call_later(delay_seconds, self._on_timeout)
+
+    def _on_timeout(self) -> None:
+        self._timeout = None
+        if any(job.kind == JOB_KIND_EXPIRED and job.is_active for job in jobs.values()):
+            # try again when the running job is done
+            self._timeout = ioloop.IOLoop.current().call_later(1, self._on_timeout)
+            return
+
+        due_containers = self.pop_due()
+        if due_containers:
+            start_job(JOB_KIND_EXPIRED, lambda job: expire_workspaces(due_containers, job))
+        self._reschedule()
+
+async def expire_workspaces(containers: list, job: CleanupJob) -> None:
+    """Delete the named servers of the given workspaces via the Hub API and remove their containers.
+    The Hub API calls of all workspaces are sent concurrently.
+    """
+
+    async def remove_expired_workspace(container: HubResource) -> bool:
+        user_name = container.labels[utils.LABEL_MLHUB_USER]
+        server_name = container.labels[utils.LABEL_MLHUB_SERVER_NAME]
+        url = "/users/{user_name}/servers/{server_name}".format(user_name=user_name, server_name=server_name)
+        r = await hub_api_request('DELETE', url, body={"remove": True}, raise_error=False)
+
+        if r.code == 202 or r.code == 204:
+            logging.info("Delete expired container " + container.name)
+            return await try_to_remove(lambda: remove_workspace_container(container), container.name)
+        return False
+
+    job.to_remove += len(containers)
+    try:
+        results = await gen.multi([remove_expired_workspace(container) for container in containers])
+        for successful in results:
+            job.track_removal(successful, RESOURCE_KIND_CONTAINER)
+    finally:
+        expiry_scheduler.finish(containers)
+
+async def sync_expiry_scheduler() -> list:
+    """Seed the expiry scheduler with a full listing of the hub's workspaces.
+
+    Returns:
+        list: the listed workspaces
+    """
+
+    hub_containers = await run_blocking(get_hub_containers)
+    expiry_scheduler.set_workspaces(hub_containers)
+    return hub_containers
+
+async def remove_expired_workspaces(job: CleanupJob) -> None:
+    hub_containers = await sync_expiry_scheduler()
+    job.track_scanned(hub_containers)
+    await expire_workspaces(expiry_scheduler.pop_due(), job)
+
+def watch_docker_events(io_loop) -> None:
+    """Update the expiry scheduler when workspace containers are created or destroyed. Runs in its own thread,
+    as the Docker events stream is blocking. After the stream broke, the scheduler is seeded again.
+
+        Args:
+            io_loop: the IOLoop of the service; it cannot be looked up from the events thread
+    """
+
+    filters = {"type": "container", "label": origin_label, "event": ["create", "destroy"]}
+    while True:
+        try:
+            for event in docker_client.events(decode=True, filters=filters):
+                container_id = (event.get("Actor") or {}).get("ID") or event.get("id")
+                if event.get("Action", event.get("status")) == "destroy":
+                    io_loop.add_callback(expiry_scheduler.remove, container_id)
+                    continue
+
+                for container in docker_client.api.containers(all=True, filters={**origin_label_filter, "id": container_id}):
+                    io_loop.add_callback(expiry_scheduler.add, docker_container_to_resource(container))
+        except Exception as e:
+            logging.warning("Docker events stream broke: " + str(e))
+
+        time.sleep(EVENTS_RECONNECT_DELAY_SECONDS)
+        io_loop.add_callback(sync_expiry_scheduler)
+
+class AdminHandler(HubAuthenticated, web.RequestHandler):
+
+    def is_admin(self) -> bool:
+        """Finish the request with 401 if the current user is not an admin."""
 
-    @web.authenticated
-    def get(self):
         current_user = self.get_current_user()
         if current_user["admin"] is False:
             self.set_status(401)
             self.finish()
+            return False
+        return True
+
+    def finish_with_job(self, job: CleanupJob) -> None:
+        self.set_status(202)
+        self.finish({**job.to_dict(), "progress_url": "{}jobs/{}".format(prefix, job.id)})
+
+class CleanupUserResources(AdminHandler):
+
+    @web.authenticated
+    def get(self):
+        if not self.is_admin():
             return
 
-        try:
-            remove_deleted_user_resources(get_hub_usernames())
-        except UserWarning as e:
-            self.finish(str(e))
+        self.finish_with_job(start_job(JOB_KIND_USERS, remove_deleted_users_job))
 
-class CleanupExpiredContainers(HubAuthenticated, web.RequestHandler):
+class CleanupExpiredContainers(AdminHandler):
 
     @web.authenticated
     def get(self):
-        current_user = self.get_current_user()
-        if current_user["admin"] is False:
-            self.set_status(401)
-            self.finish()
+        if not self.is_admin():
+            return
+
+        self.finish_with_job(start_job(JOB_KIND_EXPIRED, remove_expired_workspaces))
+
+class Metrics(AdminHandler):
+
+    @web.authenticated
+    def get(self):
+        if not self.is_admin():
+            return
+
+        self.set_header("Content-Type", CONTENT_TYPE_LATEST)
+        self.finish(generate_latest())
+
+class CleanupJobProgress(AdminHandler):
+
+    @web.authenticated
+    def get(self, job_id):
+        if not self.is_admin():
             return
 
-        remove_expired_workspaces()
+        job = jobs.get(job_id)
+        if job is None:
+            raise web.HTTPError(404, "Job {} does not exist".format(job_id))
+
+        self.finish(job.to_dict())
 
 app = web.Application([
     (r"{}users".format(prefix), CleanupUserResources),
-    (r"{}expired".format(prefix), CleanupExpiredContainers)
+    (r"{}expired".format(prefix), CleanupExpiredContainers),
+    (r"{}jobs/([0-9a-f]+)".format(prefix), CleanupJobProgress),
+    (r"{}metrics".format(prefix), Metrics)
 ])
 
 service_port = int(service_url.split(":")[-1])
 app.listen(service_port)
 
-def internal_service_caller():
-    clean_interval_seconds = int(os.getenv(utils.ENV_NAME_CLEANUP_INTERVAL_SECONDS))
+clean_interval_seconds = int(os.getenv(utils.ENV_NAME_CLEANUP_INTERVAL_SECONDS))
+
+# Expired workspaces are removed by the scheduler at their expiration time. The automatic removal is disabled together with the periodic cleanup.
+expiry_scheduler = ExpiryScheduler(is_enabled=clean_interval_seconds != -1)
+OLDEST_OVERDUE_WORKSPACE.set_function(expiry_scheduler.get_oldest_overdue_seconds)
+
+async def internal_service_caller():
+    if execution_mode == utils.EXECUTION_MODE_KUBERNETES:
+        # the pod index seeds the expiry scheduler with its initial listing
+        Thread(target=pod_index.watch, args=(ioloop.IOLoop.current(),), name="pod-watch", daemon=True).start()
+    await sync_expiry_scheduler()
+    if execution_mode == utils.EXECUTION_MODE_LOCAL:
+        Thread(target=watch_docker_events, args=(ioloop.IOLoop.current(),), name="docker-events", daemon=True).start()
+
     while True and clean_interval_seconds != -1:
-        time.sleep(clean_interval_seconds)
-        try:
-            remove_deleted_user_resources(get_hub_usernames())
-        except UserWarning:
-            pass
-        remove_expired_workspaces()
+        await gen.sleep(clean_interval_seconds)
+        await start_job(JOB_KIND_USERS, remove_deleted_users_job).future
+        # Safety net for missed events; the scheduler itself wakes up exactly when the next workspace expires
+        await sync_expiry_scheduler()
 
-Thread(target=internal_service_caller).start()
+ioloop.IOLoop.current().spawn_callback(internal_service_caller)
 
 ioloop.IOLoop.current().start()
@@ -14,7 +14,7 @@ import json
 from traitlets.log import get_logger
 logger = get_logger()
 
-from mlhubspawner import utils
+from mlhubspawner import utils, networks, image_puller, dynamic_whitelist
 from subprocess import call
 
 c = get_config()
@@ -27,36 +27,19 @@ from jupyterhub.auth import Authenticator
 original_normalize_username = Authenticator.normalize_username
 def custom_normalize_username(self, username):
     username = original_normalize_username(self, username)
-    more_than_one_forbidden_char = False
-    for forbidden_username_char in [" ", ",", ";", ".", "-", "@", "_"]:
-        # Replace special characters with a non-special character. Cannot just be empty, like "", because then it could happen that two distinct user names are transformed into the same username.
-        # Example: "foo, bar" and "fo, obar" would both become "foobar".
-        replace_char = "0"
-        # If there is more than one special character, just replace one of them. Otherwise, "foo, bar" would become "foo00bar" instead of "foo0bar"
-        if more_than_one_forbidden_char == True:
-            replace_char = ""
-        temp_username = username
-        username = username.replace(forbidden_username_char, replace_char, 1)
-        if username != temp_username:
-            more_than_one_forbidden_char = True
-
-    return username
+    return utils.replace_forbidden_username_chars(username)
 Authenticator.normalize_username = custom_normalize_username
 
 original_check_whitelist = Authenticator.check_whitelist
 def dynamic_check_whitelist(self, username, authentication=None):
-    dynamic_whitelist_file = "/resources/users/dynamic_whitelist.txt"
-
-    if os.getenv("DYNAMIC_WHITELIST_ENABLED", "false") == "true":
+    if os.getenv(utils.ENV_NAME_DYNAMIC_WHITELIST_ENABLED, "false") == "true":
+        # The file is only re-read when it changed, see dynamic_whitelist.DynamicWhitelist
+        whitelisted_users = dynamic_whitelist.get_dynamic_whitelist().get_usernames()
         # TODO: create the file and warn the user that the user has to go into the hub pod and modify it there
-        if not os.path.exists(dynamic_whitelist_file):
-            logger.error("The dynamic white list has to be mounted to '{}'. Use standard JupyterHub whitelist behavior.".format(dynamic_whitelist_file))
-        else:  
-            with open(dynamic_whitelist_file, "r") as f:
-                #whitelisted_users = f.readlines()
-                # rstrip() will remove trailing whitespaces or newline characters
-                whitelisted_users = [line.rstrip() for line in f]
-                return username.lower() in whitelisted_users
+        if whitelisted_users is None:
+            logger.error("The dynamic white list has to be mounted to '{}'. Use standard JupyterHub whitelist behavior.".format(dynamic_whitelist.DYNAMIC_WHITELIST_FILE))
+        else:
+            return dynamic_whitelist.normalize_whitelist_entry(username) in whitelisted_users
     
     return original_check_whitelist(self, username, authentication)
 Authenticator.check_whitelist = dynamic_check_whitelist
@@ -150,6 +133,9 @@ service_environment = {
     ENV_NAME_HUB_NAME: ENV_HUB_NAME,
     utils.ENV_NAME_EXECUTION_MODE: ENV_EXECUTION_MODE,
     utils.ENV_NAME_CLEANUP_INTERVAL_SECONDS: os.getenv(utils.ENV_NAME_CLEANUP_INTERVAL_SECONDS),
+    utils.ENV_NAME_DOCKER_CLIENT_POOL_SIZE: str(utils.DOCKER_CLIENT_POOL_SIZE),
+    utils.ENV_NAME_KUBERNETES_CLIENT_POOL_SIZE: str(utils.KUBERNETES_CLIENT_POOL_SIZE),
+    utils.ENV_NAME_CLEANUP_MAX_WORKERS: os.getenv(utils.ENV_NAME_CLEANUP_MAX_WORKERS, "16"),
 }
 
 # In Kubernetes mode, load the Kubernetes Jupyterhub config that can be configured via a config.yaml.
@@ -183,7 +169,7 @@ elif ENV_EXECUTION_MODE == utils.EXECUTION_MODE_LOCAL:
     client_kwargs = {**get_or_init(c.Spawner.client_kwargs, dict)} # {**get_or_init(c.DockerSpawner.client_kwargs, dict), **get_or_init(c.MLHubDockerSpawner.client_kwargs, dict)}
     tls_config = {**get_or_init(c.Spawner.tls_config, dict)} # {**get_or_init(c.DockerSpawner.tls_config, dict), **get_or_init(c.MLHubDockerSpawner.tls_config, dict)}
 
-    docker_client = utils.init_docker_client(client_kwargs, tls_config)
+    docker_client = utils.get_docker_client(client_kwargs, tls_config)
     try:
         container = docker_client.containers.list(filters={"id": socket.gethostname()})[0]
         if container.name.lower() != ENV_HUB_NAME.lower():
@@ -192,6 +178,24 @@ elif ENV_EXECUTION_MODE == utils.EXECUTION_MODE_LOCAL:
         logger.error("Could not correctly start MLHub container. " + str(e))
         os.kill(os.getpid(), signal.SIGTERM)
 
+    # Connect the hub to the existing workspace networks (e.g. after the hub container was recreated), so that it can reach the running workspaces.
+    # This is done once here instead of in every spawner instance.
+    try:
+        reconciliation = networks.reconcile_hub_networks(docker_client, ENV_HUB_NAME)
+        logger.info("Connected hub to {connected} of {missing} missing workspace networks ({networks} in total) in {duration_seconds:.2f}s".format(**reconciliation))
+    except docker.errors.APIError as e:
+        logger.error("Could not connect the hub to the existing workspace networks. " + str(e))
+
+    # Pull the workspace images in the background, so that no spawn has to wait for an image pull
+    prepull_max_workers = int(os.getenv(utils.ENV_NAME_PREPULL_MAX_WORKERS, image_puller.PREPULL_MAX_WORKERS))
+    if prepull_max_workers > 0:
+        prepull_images = image_puller.get_unique_images(
+            c.Spawner.image,
+            get_or_init(c.Spawner.workspace_images, list),
+            [profile.get("image") for profile in get_or_init(c.Spawner.warm_pool, list)]
+        )
+        image_puller.prepull_images(docker_client, prepull_images, max_workers=prepull_max_workers)
+
     # For cleanup-service
     service_environment.update({"DOCKER_CLIENT_KWARGS": json.dumps(client_kwargs), "DOCKER_TLS_CONFIG": json.dumps(tls_config)})
     service_host = "127.0.0.1"
@@ -0,0 +1,272 @@
+"""
+Hub-wide in-memory cache of the metadata of the containers started by the hub (Docker-local mode).
+The cache is primed with one filtered container listing and kept up-to-date via the Docker events stream, so that
+the admin and home pages can show the workspace information of all servers without a Docker call per server.
+The cache is read on the hub's event loop, so all Docker calls run in background threads and readers get the entries known so far.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+from traitlets.log import get_logger
+
+from mlhubspawner import utils
+
+# Container events that can change the cached metadata. Frequent events, such as exec_* or health_status, are ignored.
+CONTAINER_EVENTS = {"create", "start", "restart", "die", "stop", "kill", "pause", "unpause", "rename", "update", "oom", "destroy"}
+# Image events after which the tags of an image might have changed
+IMAGE_EVENTS = {"tag", "untag", "delete", "pull", "import", "load"}
+
+# Seconds to wait before reconnecting to the events stream after it broke
+EVENTS_RECONNECT_DELAY_SECONDS = 5
+
+_container_cache = None
+_container_cache_lock = threading.Lock()
+
+def extract_container_info(container: dict) -> dict:
+    """Convert an entry of the low-level container listing into the cached representation."""
+
+    names = container.get("Names") or []
+    return {
+        "id": container["Id"],
+        "name": names[0].lstrip("/") if names else "",
+        "labels": container.get("Labels") or {},
+        "image": container.get("Image"),
+        "image_id": container.get("ImageID"),
+        "state": container.get("State")
+    }
+
+class ContainerCache():
+    """Metadata (labels, image, state) of all containers carrying the hub's `mlhub.origin` label.
+    The cache is primed and refreshed from the Docker events stream in a background thread. If the cache is older than `ttl` seconds
+    (e.g. because the events stream broke), the next access rebuilds it with a single container listing in the background and gets the stale entries meanwhile.
+    """
+
+    def __init__(self, docker_client, hub_name: str, ttl: int = 300):
+        self.client = docker_client
+        self.hub_name = hub_name
+        self.ttl = ttl
+        self.log = get_logger()
+
+        self._lock = threading.Lock()
+        self._containers = {}
+        self._ids_by_name = {}
+        self._image_tags = {}
+        self._resource_limits = {}
+        self._last_refresh = 0
+        self._is_watching_events = False
+        # refreshes and lookups requested by readers, see _run_in_background
+        self._executor = ThreadPoolExecutor(1)
+        self._pending_tasks = set()
+
+    @property
+    def label_filter(self) -> dict:
+        return {"label": "{}={}".format(utils.LABEL_MLHUB_ORIGIN, self.hub_name)}
+
+    def start(self) -> None:
+        threading.Thread(target=self._watch_events, name="mlhub-container-events", daemon=True).start()
+
+    def refresh(self) -> None:
+        """Rebuild the cache with one filtered container listing."""
+
+        containers = [extract_container_info(container) for container in self.client.api.containers(all=True, filters=self.label_filter)]
+        with self._lock:
+            self._containers = {container["id"]: container for container in containers}
+            self._ids_by_name = {container["name"]: container["id"] for container in containers}
+            self._resource_limits = {container_id: limits for container_id, limits in self._resource_limits.items() if container_id in self._containers}
+            self._last_refresh = time.time()
+
+    def get(self, id_or_name: str) -> dict:
+        """Get the cached metadata of a container.
+
+        Args:
+            id_or_name (str): container id or container name
+
+        Returns:
+            dict: the container's metadata (see `extract_container_info`) or None if the hub has no such container or it is not known yet
+        """
+
+        if not id_or_name:
+            return None
+
+        # Until the events thread primed the cache, it is empty
+        is_primed = self._last_refresh > 0
+        if is_primed and time.time() - self._last_refresh > self.ttl:
+            self._run_in_background(("refresh",), self.refresh)
+
+        with self._lock:
+            container = self._containers.get(id_or_name) or self._containers.get(self._ids_by_name.get(id_or_name))
+        if container is not None or self._is_watching_events or not is_primed:
+            return container
+
+        # Without the events stream, the container might just not be known yet. It is looked up for the next access.
+        self._run_in_background(("container", id_or_name), self._update_container, id_or_name)
+        return None
+
+    def get_running_containers(self) -> list:
+        with self._lock:
+            return [container for container in self._containers.values() if container["state"] == "running"]
+
+    def get_resource_limits(self, container_id: str) -> dict:
+        """Get the CPU and memory limits of a container. They are not part of the container listing, so the container is
+        inspected once and the result is cached until the container is updated.
+
+        Returns:
+            dict: {"nano_cpus": int, "memory": int}, values are 0 if no limit is set
+        """
+
+        with self._lock:
+            limits = self._resource_limits.get(container_id)
+        if limits is None:
+            host_config = self.client.api.inspect_container(container_id).get("HostConfig") or {}
+            limits = {"nano_cpus": host_config.get("NanoCpus") or 0, "memory": host_config.get("Memory") or 0}
+            with self._lock:
+                self._resource_limits[container_id] = limits
+
+        return limits
+
+    def get_image_tags(self, image_id: str) -> list:
+        """Get the tags of an image. They are requested once per image in the background and invalidated by the image events.
+
+        Returns:
+            list: the image's tags, e.g. ['mltooling/ml-workspace:0.8.7'], or an empty list until they are known
+        """
+
+        if not image_id:
+            return []
+
+        with self._lock:
+            tags = self._image_tags.get(image_id)
+        if tags is None:
+            self._run_in_background(("image", image_id), self._update_image_tags, image_id)
+            return []
+
+        return tags
+
+    def _update_image_tags(self, image_id: str) -> None:
+        try:
+            tags = self.client.api.inspect_image(image_id).get("RepoTags") or []
+        except docker.errors.NotFound:
+            tags = []
+        with self._lock:
+            self._image_tags[image_id] = tags
+
+    def _run_in_background(self, key: tuple, func, *args) -> None:
+        """Run `func` in the cache's background thread, unless a task with the same key is still pending."""
+
+        with self._lock:
+            if key in self._pending_tasks:
+                return
+            self._pending_tasks.add(key)
+        self._executor.submit(self._run_task, key, func, *args)
+
+    def _run_task(self, key: tuple, func, *args) -> None:
+        try:
+            func(*args)
+        except Exception as e:
+            self.log.warn("Could not update the container cache: {}".format(str(e)))
+        finally:
+            with self._lock:
+                self._pending_tasks.discard(key)
+
+    def _update_container(self, id_or_name: str) -> dict:
+        """Fetch a single container and update its cache entry."""
+
+        filters = {**self.label_filter, "id": id_or_name}
+        containers = self.client.api.containers(all=True, filters=filters)
+        if not containers:
+            filters = {**self.label_filter, "name": id_or_name}
+            containers = [container for container in self.client.api.containers(all=True, filters=filters)
+                if extract_container_info(container)["name"] == id_or_name]
+
+        if not containers:
+            self._remove_container(id_or_name)
+            return None
+
+        container = extract_container_info(containers[0])
+        with self._lock:
+            old_container = self._containers.get(container["id"])
+            if old_container is not None:
+                self._ids_by_name.pop(old_container["name"], None)
+            self._containers[container["id"]] = container
+            self._ids_by_name[container["name"]] = container["id"]
+        return container
+
+    def _remove_container(self, container_id: str) -> None:
+        with self._lock:
+            self._resource_limits.pop(container_id, None)
+            container = self._containers.pop(container_id, None)
+            if container is not None:
+                self._ids_by_name.pop(container["name"], None)
+
+    def _handle_event(self, event: dict) -> None:
+        event_type = event.get("Type")
+        action = event.get("Action") or event.get("status") or ""
+        actor = event.get("Actor") or {}
+        actor_id = actor.get("ID") or event.get("id")
+
+        if event_type == "image":
+            if action in IMAGE_EVENTS:
+                with self._lock:
+                    self._image_tags.clear()
+            return
+
+        if event_type != "container" or action not in CONTAINER_EVENTS:
+            return
+
+        # Container events contain the container's labels as attributes
+        if (actor.get("Attributes") or {}).get(utils.LABEL_MLHUB_ORIGIN) != self.hub_name:
+            return
+
+        if action in ("update", "destroy"):
+            with self._lock:
+                self._resource_limits.pop(actor_id, None)
+
+        if action == "destroy":
+            self._remove_container(actor_id)
+        else:
+            self._update_container(actor_id)
+
+    def _watch_events(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.log.warn("Could not refresh the container cache: {}".format(str(e)))
+                time.sleep(EVENTS_RECONNECT_DELAY_SECONDS)
+                continue
+
+            try:
+                # Events that happened between the last refresh and the (re-)connect would be lost otherwise
+                since = self._last_refresh
+                events = self.client.events(decode=True, since=int(since), filters={"type": ["container", "image"]})
+                self._is_watching_events = True
+                for event in events:
+                    try:
+                        self._handle_event(event)
+                    except Exception as e:
+                        self.log.warn("Could not handle docker event: {}".format(str(e)))
+            except Exception as e:
+                self.log.warn("Docker events stream broke: {}".format(str(e)))
+            finally:
+                self._is_watching_events = False
+
+            time.sleep(EVENTS_RECONNECT_DELAY_SECONDS)
+
+def get_container_cache(docker_client, hub_name: str, ttl: int = 300) -> ContainerCache:
+    """Return the hub-wide container cache and start it on first use.
+
+    Returns:
+        ContainerCache
+    """
+
+    global _container_cache
+    with _container_cache_lock:
+        if _container_cache is None:
+            cache = ContainerCache(docker_client, hub_name, ttl=ttl)
+            cache.start()
+            _container_cache = cache
+
+    return _container_cache
@@ -0,0 +1,85 @@
+"""
+In-memory index of the dynamic whitelist file (see `DYNAMIC_WHITELIST_ENABLED`).
+The file is read only when its modification time, inode, or size changed since the last read, so that a login costs one
+`stat` call and a set lookup instead of reading and scanning the whole file.
+"""
+
+import os
+import threading
+
+from traitlets.log import get_logger
+
+DYNAMIC_WHITELIST_FILE = "/resources/users/dynamic_whitelist.txt"
+
+_dynamic_whitelists = {}
+_dynamic_whitelists_lock = threading.Lock()
+
+def normalize_whitelist_entry(line: str) -> str:
+    """Usernames are compared lower-cased and without surrounding whitespace, e.g. ' Foo\\n' -> 'foo'."""
+
+    return line.strip().lower()
+
+class DynamicWhitelist():
+    """Set of the usernames in the whitelist file. The file is re-read when it was modified, replaced (e.g. by an editor
+    or a ConfigMap update), or truncated. If it cannot be read, the last successfully read usernames are used.
+    """
+
+    def __init__(self, path: str = DYNAMIC_WHITELIST_FILE):
+        self.path = path
+        self.log = get_logger()
+
+        self._lock = threading.Lock()
+        self._usernames = None
+        self._file_signature = None
+
+    def get_usernames(self) -> frozenset:
+        """Return the whitelisted usernames, reloading the file if it changed.
+
+        Returns:
+            frozenset: the normalized usernames or None if the file does not exist and was never read
+        """
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self.log.warn("Could not check the dynamic whitelist {}: {}".format(self.path, str(e)))
+            return self._usernames
+
+        file_signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        if file_signature == self._file_signature:
+            return self._usernames
+
+        with self._lock:
+            # another login might have reloaded the file in the meantime
+            if file_signature != self._file_signature:
+                self._reload(file_signature)
+        return self._usernames
+
+    def _reload(self, file_signature: tuple) -> None:
+        try:
+            with open(self.path, "r") as f:
+                usernames = frozenset(normalize_whitelist_entry(line) for line in f)
+        except (OSError, UnicodeDecodeError) as e:
+            self.log.warn("Could not read the dynamic whitelist {}, keep using the previous version: {}".format(self.path, str(e)))
+            return
+
+        self._usernames = usernames - {""}
+        self._file_signature = file_signature
+        self.log.info("Loaded {} usernames from the dynamic whitelist {}".format(len(self._usernames), self.path))
+
+def get_dynamic_whitelist(path: str = DYNAMIC_WHITELIST_FILE) -> DynamicWhitelist:
+    """Return the hub-wide index of the given whitelist file.
+
+    Returns:
+        DynamicWhitelist
+    """
+
+    with _dynamic_whitelists_lock:
+        whitelist = _dynamic_whitelists.get(path)
+        if whitelist is None:
+            whitelist = DynamicWhitelist(path)
+            _dynamic_whitelists[path] = whitelist
+
+    return whitelist
@@ -0,0 +1,137 @@
+"""
+Process-wide snapshot of the resources of the host the hub is running on (Docker-local mode).
+The host is probed once and then refreshed in the background by reading /proc directly, so that spawner instances
+and option forms do not have to probe the host themselves.
+"""
+
+import os
+import threading
+import time
+
+from traitlets.log import get_logger
+
+from mlhubspawner import utils
+
+PROC_MEMINFO = "/proc/meminfo"
+PROC_IRQ = "/proc/irq"
+
+REFRESH_INTERVAL_SECONDS = 30
+
+_host_resources = None
+_host_resources_lock = threading.Lock()
+
+def read_cpu_count() -> int:
+    return os.cpu_count() or 0
+
+def read_memory_in_bytes() -> int:
+    try:
+        with open(PROC_MEMINFO, "r") as f:
+            for line in f:
+                # Example line: "MemTotal:       16318440 kB"
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return 0
+
+def read_gpu_count() -> int:
+    """Count the nvidia interrupt handlers below /proc/irq (same as `find /proc/irq/ -name nvidia | wc -l`).
+    NOTE: this approach currently only works for nvidia gpus.
+    """
+
+    count_gpu = 0
+    try:
+        for irq in os.scandir(PROC_IRQ):
+            if irq.is_dir() and os.path.exists(os.path.join(irq.path, "nvidia")):
+                count_gpu += 1
+    except OSError:
+        pass
+
+    return count_gpu
+
+def get_claimed_gpu_count(labels: dict, gpu_count: int) -> int:
+    """Number of GPUs a container claims according to its `nvidia_visible_devices` label, e.g. 'all' or '0,2'."""
+
+    visible_devices = (labels.get(utils.LABEL_NVIDIA_VISIBLE_DEVICES) or "").strip().lower()
+    if visible_devices in ("", "none", "void"):
+        return 0
+    if visible_devices == "all":
+        return gpu_count
+
+    return len([device for device in visible_devices.split(",") if device.strip()])
+
+def to_gb(value_in_bytes: int) -> float:
+    return round(value_in_bytes/1024/1024/1024, 1)
+
+class HostResources():
+    """Holds the latest snapshot of the host's total resources and of the resources that are not claimed by the
+    running workspaces (via their CPU, memory, and GPU limits). The snapshot is refreshed in a background thread.
+    """
+
+    def __init__(self, container_cache=None, refresh_interval: int = REFRESH_INTERVAL_SECONDS):
+        self.container_cache = container_cache
+        self.refresh_interval = refresh_interval
+        self.log = get_logger()
+        self.snapshot = {}
+
+    def start(self) -> None:
+        # Determining the claimed resources might need a Docker call per running workspace, so it is left to the background thread
+        self.refresh(include_claimed_resources=False)
+        threading.Thread(target=self._refresh_periodically, name="mlhub-host-resources", daemon=True).start()
+
+    def refresh(self, include_claimed_resources: bool = True) -> None:
+        cpu_count = read_cpu_count()
+        memory_in_bytes = read_memory_in_bytes()
+        gpu_count = read_gpu_count()
+
+        claimed_nano_cpus = 0
+        claimed_memory = 0
+        claimed_gpus = 0
+        if self.container_cache is not None and include_claimed_resources:
+            for container in self.container_cache.get_running_containers():
+                try:
+                    limits = self.container_cache.get_resource_limits(container["id"])
+                except Exception:
+                    # e.g. the container was removed in the meantime
+                    continue
+                claimed_nano_cpus += limits["nano_cpus"]
+                claimed_memory += limits["memory"]
+                claimed_gpus += get_claimed_gpu_count(container["labels"], gpu_count)
+
+        # Replace the whole dict, so that readers never see a partially updated snapshot
+        self.snapshot = {
+            "cpu_count": cpu_count,
+            "memory_count_in_gb": to_gb(memory_in_bytes),
+            "gpu_count": gpu_count,
+            "free_cpu_count": round(max(0, cpu_count - claimed_nano_cpus / 1e9), 1),
+            "free_memory_in_gb": to_gb(max(0, memory_in_bytes - claimed_memory)),
+            "free_gpu_count": max(0, gpu_count - claimed_gpus)
+        }
+
+    def _refresh_periodically(self) -> None:
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                self.log.warn("Could not refresh the host resources: {}".format(str(e)))
+            time.sleep(self.refresh_interval)
+
+def get_host_resources(container_cache=None) -> HostResources:
+    """Return the process-wide host resources and start them on first use.
+
+    Args:
+        container_cache (container_cache.ContainerCache): used to determine the resources claimed by the running workspaces
+
+    Returns:
+        HostResources
+    """
+
+    global _host_resources
+    with _host_resources_lock:
+        if _host_resources is None:
+            host_resources = HostResources(container_cache)
+            host_resources.start()
+            _host_resources = host_resources
+
+    return _host_resources
@@ -0,0 +1,239 @@
+"""
+Image pulls of the hub (Docker-local mode).
+All pulls go through one hub-wide ImagePullCoordinator, which runs at most one pull per image reference: concurrent spawns
+of the same image, as well as the background pre-pull on hub start, wait for the same pull and can report its layer progress.
+Images that failed to pull are remembered for a short time, so that a wrong image name does not hit the registry with every spawn.
+"""
+
+import threading
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import docker.errors
+from docker.utils import parse_repository_tag
+from prometheus_client import Gauge
+from traitlets.log import get_logger
+
+PREPULL_MAX_WORKERS = 2
+# Number of different images that are pulled in parallel
+PULL_MAX_WORKERS = 4
+# Seconds during which a failed pull is not retried
+NEGATIVE_CACHE_SECONDS = 60
+# Seconds between two progress log lines of a running pull
+PROGRESS_LOG_INTERVAL_SECONDS = 15
+
+STATUS_PENDING = "pending"
+STATUS_PULLING = "pulling"
+STATUS_PRESENT = "present"
+STATUS_PULLED = "pulled"
+STATUS_FAILED = "failed"
+
+PREPULL_IMAGES = Gauge("mlhub_prepull_images", "Number of workspace images per pre-pull status", ["status"])
+
+_pull_coordinator = None
+_pull_coordinator_lock = threading.Lock()
+
+def get_image_reference(repository: str, tag: str = None) -> str:
+    """Normalized reference of an image, e.g. 'mltooling/ml-workspace:latest' for 'mltooling/ml-workspace'."""
+
+    if tag is None:
+        repository, tag = parse_repository_tag(repository)
+    return "{}:{}".format(repository, tag or "latest")
+
+class ImagePull():
+    """A running or finished pull of one image. The layer progress is updated by the pulling thread."""
+
+    def __init__(self, image: str, repository: str, tag: str):
+        self.image = image
+        self.repository = repository
+        self.tag = tag
+        self.started_at = time.time()
+        self.future = None
+        # downloaded and total bytes per layer
+        self.layers = {}
+
+    @property
+    def is_done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    @property
+    def current_bytes(self) -> int:
+        return sum(layer[0] for layer in list(self.layers.values()))
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(layer[1] for layer in list(self.layers.values()))
+
+    @property
+    def fraction(self) -> float:
+        total = self.total_bytes
+        return min(1.0, self.current_bytes / total) if total else 0.0
+
+    def get_message(self) -> str:
+        return "Pulling image {}: {:.2f} of {:.2f} GB".format(self.image, self.current_bytes/1024**3, self.total_bytes/1024**3)
+
+class ImagePullCoordinator():
+    """Hub-wide single-flight image pulls: for every image reference, at most one pull is running; all callers get the
+    future of the running pull. Failed pulls are cached for NEGATIVE_CACHE_SECONDS.
+    """
+
+    def __init__(self, docker_client, negative_cache_seconds: int = NEGATIVE_CACHE_SECONDS, max_workers: int = PULL_MAX_WORKERS):
+        self.client = docker_client
+        self.negative_cache_seconds = negative_cache_seconds
+        self.log = get_logger()
+
+        self._lock = threading.Lock()
+        self._pulls = {}
+        self._failures = {}
+        self._executor = ThreadPoolExecutor(max_workers)
+
+    def pull(self, repository: str, tag: str = None) -> Future:
+        """Pull an image or attach to its running pull.
+
+        Returns:
+            concurrent.futures.Future: resolves when the image is pulled; fails with the pull's error
+        """
+
+        if tag is None:
+            repository, tag = parse_repository_tag(repository)
+        tag = tag or "latest"
+        image = get_image_reference(repository, tag)
+        with self._lock:
+            failure = self._failures.get(image)
+            if failure is not None and time.time() - failure[0] < self.negative_cache_seconds:
+                future = Future()
+                future.set_exception(failure[1])
+                return future
+
+            pull = self._pulls.get(image)
+            if pull is None or pull.is_done:
+                pull = ImagePull(image, repository, tag)
+                pull.future = self._executor.submit(self._pull, pull)
+                self._pulls[image] = pull
+
+        return pull.future
+
+    def get_pull(self, image: str) -> ImagePull:
+        """Get the running or last pull of an image, e.g. to show its progress. Returns None if the image was not pulled by the hub."""
+
+        with self._lock:
+            return self._pulls.get(get_image_reference(image))
+
+    def _pull(self, pull: ImagePull) -> None:
+        self.log.info("Pull image {}".format(pull.image))
+        last_log_time = time.time()
+        try:
+            for line in self.client.api.pull(pull.repository, tag=pull.tag, stream=True, decode=True):
+                if line.get("error"):
+                    raise docker.errors.APIError(line["error"])
+
+                progress_detail = line.get("progressDetail") or {}
+                if line.get("id") and progress_detail.get("total"):
+                    pull.layers[line["id"]] = (progress_detail.get("current", 0), progress_detail["total"])
+
+                if time.time() - last_log_time > PROGRESS_LOG_INTERVAL_SECONDS:
+                    last_log_time = time.time()
+                    self.log.info(pull.get_message())
+        except Exception as e:
+            with self._lock:
+                self._failures[pull.image] = (time.time(), e)
+            self.log.warn("Could not pull image {}: {}".format(pull.image, str(e)))
+            raise
+
+        with self._lock:
+            self._failures.pop(pull.image, None)
+        self.log.info("Pulled image {} in {:.1f}s".format(pull.image, time.time() - pull.started_at))
+
+def get_image_pull_coordinator(docker_client) -> ImagePullCoordinator:
+    """Return the hub-wide image pull coordinator.
+
+    Returns:
+        ImagePullCoordinator
+    """
+
+    global _pull_coordinator
+    with _pull_coordinator_lock:
+        if _pull_coordinator is None:
+            _pull_coordinator = ImagePullCoordinator(docker_client)
+
+    return _pull_coordinator
+
+def get_unique_images(*image_lists) -> list:
+    """Merge the given images and image lists, keeping the first occurrence of each image, e.g. (image, workspace_images)."""
+
+    images = []
+    for image_list in image_lists:
+        if isinstance(image_list, str):
+            image_list = [image_list]
+        for image in image_list or []:
+            if image and image not in images:
+                images.append(image)
+    return images
+
+class ImagePrePuller():
+    """Pulls a list of images with bounded concurrency in a background thread, e.g. on hub start.
+    The status of each image is available via `progress`.
+    """
+
+    def __init__(self, docker_client, images: list, max_workers: int = PREPULL_MAX_WORKERS):
+        self.client = docker_client
+        self.images = list(images)
+        self.max_workers = max(1, max_workers)
+        self.log = get_logger()
+
+        self._lock = threading.Lock()
+        self.progress = collections.OrderedDict((image, STATUS_PENDING) for image in self.images)
+        self.finished = threading.Event()
+        self._update_gauge()
+
+    def start(self) -> None:
+        threading.Thread(target=self.pull_all, name="mlhub-image-prepull", daemon=True).start()
+
+    def pull_all(self) -> None:
+        start_time = time.time()
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            list(executor.map(self.pull_image, self.images))
+
+        self.log.info("Pre-pulled {} workspace images in {:.1f}s: {}".format(len(self.images), time.time() - start_time, dict(self.progress)))
+        self.finished.set()
+
+    def pull_image(self, image: str) -> None:
+        try:
+            self.client.api.inspect_image(image)
+            self._set_status(image, STATUS_PRESENT)
+            return
+        except docker.errors.ImageNotFound:
+            pass
+        except docker.errors.APIError as e:
+            self.log.warn("Could not inspect image {}: {}".format(image, str(e)))
+
+        self._set_status(image, STATUS_PULLING)
+        try:
+            get_image_pull_coordinator(self.client).pull(image).result()
+            self._set_status(image, STATUS_PULLED)
+        except Exception:
+            # the error is logged by the coordinator
+            self._set_status(image, STATUS_FAILED)
+
+    def _set_status(self, image: str, status: str) -> None:
+        with self._lock:
+            self.progress[image] = status
+        self._update_gauge()
+
+    def _update_gauge(self) -> None:
+        with self._lock:
+            counts = collections.Counter(self.progress.values())
+        for status in (STATUS_PENDING, STATUS_PULLING, STATUS_PRESENT, STATUS_PULLED, STATUS_FAILED):
+            PREPULL_IMAGES.labels(status=status).set(counts.get(status, 0))
+
+def prepull_images(docker_client, images: list, max_workers: int = PREPULL_MAX_WORKERS) -> ImagePrePuller:
+    """Start pulling the given images in the background.
+
+    Returns:
+        ImagePrePuller: to query the progress
+    """
+
+    puller = ImagePrePuller(docker_client, images, max_workers=max_workers)
+    puller.start()
+    return puller
@@ -0,0 +1,151 @@
+"""
+Spawn latency metrics of the MLHub spawners.
+The histograms are registered in the default Prometheus registry and, hence, are exposed by JupyterHub's `/hub/metrics` endpoint
+next to JupyterHub's own metrics. Additionally, each spawn is logged as one structured trace line.
+"""
+
+import collections
+import contextlib
+import json
+import time
+
+from prometheus_client import Histogram
+
+SPAWN_PHASE_DURATION = Histogram(
+    "mlhub_spawn_phase_duration_seconds",
+    "Duration of the phases of a workspace spawn",
+    ["spawner", "phase"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, float("inf"))
+)
+
+# Docker phases
+PHASE_NETWORK_LOOKUP = "network_lookup"
+PHASE_NETWORK_CREATE = "network_create"
+PHASE_HUB_CONNECT = "hub_connect"
+PHASE_VOLUME_CREATE = "volume_create"
+PHASE_IMAGE_PULL = "image_pull"
+PHASE_CONTAINER_CREATE = "container_create"
+PHASE_CONTAINER_START = "container_start"
+PHASE_POOL_CLAIM = "pool_claim"
+# Kubernetes phases
+PHASE_POD_CREATE = "pod_create"
+PHASE_POD_READY = "pod_ready"
+PHASE_SERVICE_CREATE = "service_create"
+# Both: time the spawn waited in the admission queue (see spawn_admission)
+PHASE_ADMISSION_WAIT = "admission_wait"
+# Both: time until the workspace server responds to the hub
+PHASE_SERVER_READY = "server_ready"
+
+class SpawnTrace():
+    """Timings of the phases of a single spawn. Every recorded phase is observed in the histogram right away,
+    the trace line is logged once the spawn is finished.
+    """
+
+    def __init__(self, spawner_type: str, spawner):
+        self.spawner_type = spawner_type
+        self.user_name = spawner.user.name
+        self.server_name = spawner.name
+        self.log = spawner.log
+        self.started_at = time.time()
+        self.phases = collections.OrderedDict()
+        self.phase_finished_at = {}
+        self.is_finished = False
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Context manager that records the time spent in the wrapped block as the given phase."""
+
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start_time)
+
+    def trace_future(self, name: str, future) -> None:
+        """Record the time until the given (concurrent) future is done as the given phase."""
+
+        start_time = time.time()
+        future.add_done_callback(lambda _: self.record(name, time.time() - start_time))
+
+    def record(self, name: str, duration_seconds: float) -> None:
+        if self.is_finished:
+            return
+
+        self.phases[name] = round(self.phases.get(name, 0) + duration_seconds, 3)
+        self.phase_finished_at[name] = time.time()
+        SPAWN_PHASE_DURATION.labels(spawner=self.spawner_type, phase=name).observe(duration_seconds)
+
+    def finish(self, status: str) -> None:
+        """Log the trace line, e.g. 'Spawn trace: {"user": "foo", "server_name": "bar", "status": "started", "total_seconds": 4.2, "phases": {...}}'."""
+
+        if self.is_finished:
+            return
+
+        self.is_finished = True
+        self.log.info("Spawn trace: " + json.dumps({
+            "spawner": self.spawner_type,
+            "user": self.user_name,
+            "server_name": self.server_name,
+            "status": status,
+            "total_seconds": round(time.time() - self.started_at, 3),
+            "phases": self.phases
+        }))
+
+class SpawnTracing():
+    """Mixin for the MLHub spawners that traces the phases of each spawn.
+    The spawner calls `start_spawn_trace` at the beginning of `start` and wraps its phases with `spawn_phase`.
+    The time until the server responds is taken from JupyterHub setting `_waiting_for_response` before and after it waits for the server.
+    JupyterHub also resets that flag if the server did not respond in time, after it stopped the server; hence, the spawner calls
+    `abort_spawn_trace` in `stop`, and a spawn whose server is gone is not counted as started.
+    """
+
+    spawner_type = ""
+    _spawn_trace = None
+    _is_waiting_for_response = False
+
+    def start_spawn_trace(self) -> SpawnTrace:
+        self._spawn_trace = SpawnTrace(self.spawner_type, self)
+        return self._spawn_trace
+
+    @property
+    def spawn_trace(self) -> SpawnTrace:
+        if self._spawn_trace is None:
+            return self.start_spawn_trace()
+        return self._spawn_trace
+
+    def spawn_phase(self, name: str):
+        return self.spawn_trace.phase(name)
+
+    def finish_spawn_trace(self, status: str) -> None:
+        if self._spawn_trace is not None:
+            self._spawn_trace.finish(status)
+
+    def abort_spawn_trace(self) -> None:
+        """Finish the trace as failed if the server is stopped while JupyterHub waits for its response, e.g. after the http_timeout."""
+
+        if self._is_waiting_for_response:
+            self.finish_spawn_trace("failed")
+
+    # Override the class attribute of the JupyterHub Spawner
+    @property
+    def _waiting_for_response(self) -> bool:
+        return self._is_waiting_for_response
+
+    @_waiting_for_response.setter
+    def _waiting_for_response(self, value: bool) -> None:
+        was_waiting = self._is_waiting_for_response
+        self._is_waiting_for_response = value
+
+        trace = self._spawn_trace
+        if trace is None or trace.is_finished:
+            return
+
+        if value and not was_waiting:
+            trace.phase_finished_at["start"] = time.time()
+        elif not value and was_waiting:
+            if getattr(self, "server", None) is None:
+                # JupyterHub removed the server, as it did not respond or its container / pod died in the meantime
+                trace.finish("failed")
+                return
+            trace.record(PHASE_SERVER_READY, time.time() - trace.phase_finished_at.get("start", trace.started_at))
+            trace.finish("started")
@@ -11,17 +11,63 @@ from kubernetes.client.models import V1Service, V1ServiceSpec, V1ServicePort, V1
 
 import os
 import socket
-from traitlets import default, Unicode, List
-from tornado import gen
+import functools
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from traitlets import default, Unicode, List, Integer
+from tornado import gen, ioloop
+import threading
 import time
 import re
 
-from mlhubspawner import spawner_options, utils
+from mlhubspawner import spawner_options, utils, metrics, spawn_admission
 
 LABEL_POD_NAME = "pod_name"
-class MLHubKubernetesSpawner(KubeSpawner):
+
+# Name of the headless Service that all workspace pods of a hub share in the headless routing mode.
+# Keep in sync with the nginx service suffix set in docker-entrypoint.sh.
+HEADLESS_SERVICE_NAME_TEMPLATE = "{hub_name}-workspaces"
+
+# Maximum length of a DNS label, such as the hostname of a pod or the name of a Service
+DNS_LABEL_MAX_LENGTH = 63
+
+# Hub-wide creation of the headless Services, keyed by (namespace, name), so that concurrent spawns share a single API call
+_headless_services = {}
+_headless_services_lock = threading.Lock()
+
+# Guards the creation of the executor shared by all spawner instances (see MLHubKubernetesSpawner.kubernetes)
+_mlhub_executor_lock = threading.Lock()
+
+def get_pod_hostname(pod_name: str) -> str:
+    """Return the hostname of a workspace pod in the headless routing mode. Kubernetes rejects pods whose hostname is not a DNS label,
+    so longer pod names are shortened and kept unique with a hash suffix. Such pods are reachable via SSH (see get_env), but not via
+    the nginx routing, which uses the pod name. In the 'service' mode, their Service cannot be created at all, as its name has the same limit.
+    """
+
+    if len(pod_name) <= DNS_LABEL_MAX_LENGTH:
+        return pod_name
+
+    digest = hashlib.sha1(pod_name.encode("utf-8")).hexdigest()[:8]
+    return pod_name[:DNS_LABEL_MAX_LENGTH - len(digest) - 1].rstrip("-") + "-" + digest
+
+def forget_failed_headless_service(key: tuple, future) -> None:
+    """Remove a failed creation of a headless Service from the hub-wide cache, so that the next spawn tries again.
+    Runs as done callback, so that the failure is also dropped if no spawn awaits the creation anymore.
+    """
+
+    error = future.exception()
+    if error is None or (isinstance(error, client.rest.ApiException) and error.status == 409):
+        return
+
+    with _headless_services_lock:
+        if _headless_services.get(key) is future:
+            del _headless_services[key]
+
+class MLHubKubernetesSpawner(metrics.SpawnTracing, spawn_admission.SpawnAdmission, KubeSpawner):
     """Provides the possibility to spawn docker containers with specific options, such as resource limits (CPU and Memory), Environment Variables, ..."""
 
+    spawner_type = "kubernetes"
+
     workspace_images = List(
         trait = Unicode(),
         default_value = [],
@@ -29,6 +75,34 @@ class MLHubKubernetesSpawner(KubeSpawner):
         help = "Pre-defined workspace images"
     )
 
+    routing_mode = Unicode(
+        config = True,
+        help = "How workspace pods are reached by name: 'service' creates a ClusterIP Service per pod, 'headless' uses one shared headless Service and the pods' hostname and subdomain"
+    )
+
+    headless_service_name = Unicode(
+        config = True,
+        help = "Name of the headless Service shared by all workspace pods in the 'headless' routing mode"
+    )
+
+    max_concurrent_spawns = Integer(
+        default_value = 20,
+        config = True,
+        help = "Maximum number of spawns of all users that run at the same time. Further spawns wait in a queue that is fair between users. Set to 0 to disable the limit."
+    )
+
+    spawn_queue_size = Integer(
+        default_value = 100,
+        config = True,
+        help = "Maximum number of spawns waiting for a free slot. Further spawns are rejected right away."
+    )
+
+    # Shared by all spawner instances (see the kubernetes method)
+    _mlhub_executor = None
+
+    # Set while KubeSpawner starts the pod, see stop
+    _is_starting_pod = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -36,6 +110,42 @@ class MLHubKubernetesSpawner(KubeSpawner):
         self.default_label = {utils.LABEL_MLHUB_ORIGIN: self.hub_name, utils.LABEL_MLHUB_USER: self.user.name, utils.LABEL_MLHUB_SERVER_NAME: self.name, LABEL_POD_NAME: self.pod_name}
         self.extra_labels.update(self.default_label)
         self.extra_labels.update(self.common_labels)
+        # label the user's persistent volume claims as well, so that the cleanup service can find them
+        self.storage_extra_labels.update(self.default_label)
+
+        if self.is_headless_routing():
+            # The pod is resolvable as <hostname>.<subdomain>.<namespace>.svc.cluster.local via the headless Service
+            self.extra_pod_config = {**self.extra_pod_config, "hostname": self.pod_hostname, "subdomain": self.headless_service_name}
+
+    @default('routing_mode')
+    def _routing_mode(self):
+        return utils.KUBERNETES_ROUTING_MODE
+
+    @default('headless_service_name')
+    def _headless_service_name(self):
+        return HEADLESS_SERVICE_NAME_TEMPLATE.format(hub_name=self.hub_name)
+
+    def is_headless_routing(self) -> bool:
+        return self.routing_mode == utils.KUBERNETES_ROUTING_MODE_HEADLESS
+
+    @property
+    def pod_hostname(self) -> str:
+        return get_pod_hostname(self.pod_name)
+
+    def kubernetes(self, method, *args, **kwargs):
+        """Call a method of the hub-wide kubernetes client, e.g. `create_namespaced_service`, in an executor with one thread per pooled connection.
+        KubeSpawner's own pod calls run in its executor (see asynchronize), so the MLHub calls of concurrent spawns do not queue behind them.
+
+        Returns:
+            concurrent.futures.Future: can be yielded in coroutines
+        """
+
+        cls = MLHubKubernetesSpawner
+        if cls._mlhub_executor is None:
+            with _mlhub_executor_lock:
+                if cls._mlhub_executor is None:
+                    cls._mlhub_executor = ThreadPoolExecutor(utils.KUBERNETES_CLIENT_POOL_SIZE)
+        return cls._mlhub_executor.submit(getattr(utils.get_kubernetes_client(), method), *args, **kwargs)
     
     @default('options_form')
     def _options_form(self):
@@ -62,9 +172,13 @@ class MLHubKubernetesSpawner(KubeSpawner):
         #    env['NVIDIA_VISIBLE_DEVICES'] = self.user_options.get('gpus')
 
         if self.user_options.get(utils.OPTION_CPU_LIMIT):
-            env[utils.OPTION_MAX_NUM_THREADS] = self.user_options.get(utils.OPTION_CPU_LIMIT)
+            env[utils.OPTION_MAX_NUM_THREADS] = utils.get_num_threads(self.user_options.get(utils.OPTION_CPU_LIMIT))
 
-        env[utils.OPTION_SSH_JUMPHOST_TARGET] = self.pod_name
+        if self.is_headless_routing():
+            # resolved via the search domain <namespace>.svc.cluster.local of the hub
+            env[utils.OPTION_SSH_JUMPHOST_TARGET] = "{}.{}".format(self.pod_hostname, self.headless_service_name)
+        else:
+            env[utils.OPTION_SSH_JUMPHOST_TARGET] = self.pod_name
 
         return env
 
@@ -72,6 +186,50 @@ class MLHubKubernetesSpawner(KubeSpawner):
     def start(self):
         """Set custom configuration during start before calling the super.start method of Dockerspawner"""
 
+        self.start_spawn_trace()
+        try:
+            yield self.admit_spawn()
+            res = yield self._start_workspace()
+        except Exception:
+            self.finish_spawn_trace("failed")
+            raise
+        finally:
+            self.release_spawn()
+        return res
+
+    async def progress(self):
+        """Report the queue position on the spawn page before the pod events of KubeSpawner."""
+
+        async for event in self.admission_progress():
+            yield event
+
+        ticket = self._spawn_ticket
+        if ticket is not None and not ticket.is_started:
+            # the spawn was stopped or rejected before KubeSpawner started the pod
+            return
+
+        async for event in super().progress():
+            yield event
+
+    def asynchronize(self, method, *args, **kwargs):
+        future = super().asynchronize(method, *args, **kwargs)
+        if getattr(method, "__name__", None) == "create_namespaced_pod":
+            if self._spawn_trace is not None:
+                self._spawn_trace.trace_future(metrics.PHASE_POD_CREATE, future)
+            # Once the pod is created, the spawn only waits for the pod via the reflector and does not call the API server anymore.
+            # Hence, it frees its admission slot instead of holding it while the pod is scheduled and its image is pulled.
+            # A failed create keeps the slot, as KubeSpawner deletes a leftover pod and creates the pod again (409) or start fails.
+            io_loop = ioloop.IOLoop.current()
+
+            def release_if_created(done_future):
+                if not done_future.cancelled() and done_future.exception() is None:
+                    io_loop.add_callback(self.release_spawn)
+
+            future.add_done_callback(release_if_created)
+        return future
+
+    @gen.coroutine
+    def _start_workspace(self):
         self.saved_user_options = self.user_options
 
         if self.user_options.get(utils.OPTION_IMAGE):
@@ -106,9 +264,41 @@ class MLHubKubernetesSpawner(KubeSpawner):
         #    extra_host_config['runtime'] = "nvidia"
         #    self.extra_labels[LABEL_NVIDIA_VISIBLE_DEVICES] = self.user_options.get('gpus')
 
-        res = yield super().start()
+        # The Service only selects the pod by its labels, so it can be created while the pod is starting
+        if self.is_headless_routing():
+            routing_future = self._ensure_headless_service()
+        else:
+            routing_future = self._create_service()
+
+        self._is_starting_pod = True
+        try:
+            res = yield super().start()
+        except Exception:
+            # the routing call must not outlive the failed spawn unobserved
+            try:
+                yield routing_future
+            except Exception as e:
+                self.log.warn("Could not create the routing to the pod {}: {}".format(self.pod_name, str(e)))
+            if not self.is_headless_routing():
+                # stop does not delete the Service while the pod is starting
+                yield self._delete_service()
+            raise
+        finally:
+            self._is_starting_pod = False
+        # KubeSpawner waits for the pod to be running after it was created
+        trace = self.spawn_trace
+        trace.record(metrics.PHASE_POD_READY, time.time() - trace.phase_finished_at.get(metrics.PHASE_POD_CREATE, trace.started_at))
+
+        # only the time the Service creation takes longer than the pod startup delays the spawn
+        with self.spawn_phase(metrics.PHASE_SERVICE_CREATE):
+            yield routing_future
+
+        return res
+
+    @gen.coroutine
+    def _create_service(self):
+        """Create a ClusterIP Service for the pod so that it can be routed via name"""
 
-        # Create service for pod so that it can be routed via name
         service = V1Service(
             kind = 'Service',
             spec = V1ServiceSpec(
@@ -125,26 +315,83 @@ class MLHubKubernetesSpawner(KubeSpawner):
             )
         )
         try:
-            yield self.asynchronize(
-                self.api.create_namespaced_service,
+            yield self.kubernetes(
+                "create_namespaced_service",
                 namespace=self.namespace,
                 body=service
             )
         except client.rest.ApiException as e:
             if e.status == 409:
                 self.log.info('Service {} already existed. No need to re-create.'.format(self.pod_name))
+            else:
+                self.log.warn("Could not create service with name {}: {}".format(self.pod_name, e.reason))
+
+    @gen.coroutine
+    def _ensure_headless_service(self):
+        """Create the headless Service shared by all workspace pods of the hub once per hub process.
+        It does not carry a user label, so that the cleanup service does not remove it together with a user's resources.
+        """
+
+        key = (self.namespace, self.headless_service_name)
+        is_created = False
+        with _headless_services_lock:
+            future = _headless_services.get(key)
+            if future is None:
+                service = V1Service(
+                    kind = 'Service',
+                    spec = V1ServiceSpec(
+                        cluster_ip='None',
+                        ports=[V1ServicePort(port=self.port, target_port=self.port)],
+                        selector={utils.LABEL_MLHUB_ORIGIN: self.hub_name},
+                        # the DNS records exist as soon as the pods have an IP, and not only once they are ready
+                        publish_not_ready_addresses=True
+                    ),
+                    metadata = V1ObjectMeta(
+                        name=self.headless_service_name,
+                        labels={**self.common_labels, utils.LABEL_MLHUB_ORIGIN: self.hub_name}
+                    )
+                )
+                future = self.kubernetes("create_namespaced_service", namespace=self.namespace, body=service)
+                _headless_services[key] = future
+                is_created = True
+
+        if is_created:
+            # outside of the lock, as the callback runs right away if the call already finished
+            future.add_done_callback(functools.partial(forget_failed_headless_service, key))
+
+        try:
+            yield future
+        except client.rest.ApiException as e:
+            if e.status != 409:
+                self.log.warn("Could not create headless service with name {}: {}".format(self.headless_service_name, e.reason))
 
-        return res
-    
     @gen.coroutine
     def stop(self, now=False):
+        # a spawn that still waits for its admission does not start anymore
+        self.cancel_waiting_spawn()
+        self.abort_spawn_trace()
         yield super().stop(now=now)
 
+        if self.is_headless_routing():
+            # the headless Service is shared by all workspaces
+            return
+
+        if self._is_starting_pod:
+            # KubeSpawner stops a leftover pod with the same name before it creates the pod again. The Service, which was created
+            # for this spawn already, is kept; if the spawn fails, it is deleted by _start_workspace
+            return
+
+        yield self._delete_service()
+
+    @gen.coroutine
+    def _delete_service(self):
+        """Delete the ClusterIP Service of the pod (see _create_service)"""
+
         try:
             delete_options = client.V1DeleteOptions()
             delete_options.grace_period_seconds = self.delete_grace_period
-            yield self.asynchronize(
-                self.api.delete_namespaced_service,
+            yield self.kubernetes(
+                "delete_namespaced_service",
                 name=self.pod_name,
                 namespace=self.namespace,
                 body=delete_options
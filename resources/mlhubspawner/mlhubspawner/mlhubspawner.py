@@ -13,42 +13,33 @@ import docker.errors
 from docker.utils import kwargs_from_env
 
 import os
-import subprocess
 import socket
-import ipaddress
-from traitlets import default, Unicode, List
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from traitlets import default, Unicode, List, Integer, Dict
 from tornado import gen
-import psutil
 import time
 import re
+import threading
 
-from mlhubspawner import spawner_options, utils
-
-# we create networks in the range of 172.33-255.0.0/24
-# Docker by default uses the range 172.17-32.0.0, so we should be save using that range
-INITIAL_CIDR_FIRST_OCTET = 172
-INITIAL_CIDR_SECOND_OCTET = 33
-INITIAL_CIDR = "{}.33.0.0/24".format(INITIAL_CIDR_FIRST_OCTET)
+from mlhubspawner import spawner_options, utils, networks, container_cache, host_resources, metrics, warm_pool, image_puller, spawn_admission
 
 OPTION_SHM_SIZE = "shm_size"
 
-def has_complete_network_information(network):
-    """Convenient function to check whether the docker.Network object has all required properties.
-    
-    Args:
-        network (docker.Network)
+# How often a new subnet is tried when Docker reports that the picked subnet overlaps with an existing network
+MAX_SUBNET_ALLOCATION_ATTEMPTS = 10
 
-    Returns:
-        bool: True if it has all properties, False otehrwise.
-    """
-    return network.attrs["IPAM"] and network.attrs["IPAM"]["Config"] \
-        and len(network.attrs["IPAM"]["Config"]) > 0 \
-        and network.attrs["IPAM"]["Config"][0]["Subnet"]
+# User options that select the resource profile of a pooled container
+WARM_POOL_PROFILE_OPTIONS = [utils.OPTION_CPU_LIMIT, utils.OPTION_MEM_LIMIT, OPTION_SHM_SIZE]
 
+# Guards the creation of the executor shared by all spawner instances (see MLHubDockerSpawner.executor)
+_mlhub_executor_lock = threading.Lock()
 
-class MLHubDockerSpawner(DockerSpawner):
+class MLHubDockerSpawner(metrics.SpawnTracing, spawn_admission.SpawnAdmission, DockerSpawner):
     """Provides the possibility to spawn docker containers with specific options, such as resource limits (CPU and Memory), Environment Variables, ..."""
 
+    spawner_type = "docker"
+
     #hub_name = Unicode(config=True, help="Name of the hub container.")
 
     workspace_images = List(
@@ -58,38 +49,171 @@ class MLHubDockerSpawner(DockerSpawner):
         help = "Pre-defined workspace images"
     )
 
+    subnet_prefix_length = Integer(
+        default_value = 24,
+        min = 16,
+        max = 29,
+        config = True,
+        help = "Prefix length of the subnets created for the workspace networks. A longer prefix, e.g. 28, fits more networks into the address range."
+    )
+
+    executor_size = Integer(
+        default_value = 10,
+        min = 1,
+        config = True,
+        help = "Number of threads that execute the blocking Docker calls of all spawners, so that concurrent spawns overlap instead of blocking the hub."
+    )
+
+    max_concurrent_spawns = Integer(
+        default_value = 20,
+        config = True,
+        help = "Maximum number of spawns of all users that run at the same time. Further spawns wait in a queue that is fair between users. A spawn frees its slot while it pulls an image. Set to 0 to disable the limit."
+    )
+
+    spawn_queue_size = Integer(
+        default_value = 100,
+        config = True,
+        help = "Maximum number of spawns waiting for a free slot. Further spawns are rejected right away."
+    )
+
+    container_cache_ttl = Integer(
+        default_value = 300,
+        config = True,
+        help = "Seconds after which the hub-wide container metadata cache is rebuilt in any case. In between, it is kept up-to-date via the Docker events."
+    )
+
+    warm_pool = List(
+        trait = Dict(),
+        default_value = [],
+        config = True,
+        help = """Profiles of workspace containers that are created in advance, so that a spawn only has to claim and start a container.
+        Each profile is a dict with the `image` and the pool `size` and, optionally, the resource options `cpu_limit`, `mem_limit`, and `shm_size`,
+        e.g. [{'image': 'mltooling/ml-workspace:0.8.7', 'size': 2}]. Only spawns whose image and resource options match a profile exactly and
+        which do not mount a volume, have no lifetime, and use no GPUs are served from the pool."""
+    )
+
+    # Shared by all spawner instances (see the executor property)
+    _mlhub_executor = None
+    # Profile keys of the warm pool, set on the first spawn (see get_warm_pool_key)
+    _mlhub_warm_pool_keys = None
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.hub_name = utils.ENV_HUB_NAME
-        self.default_labels = {utils.LABEL_MLHUB_ORIGIN: self.hub_name, utils.LABEL_MLHUB_USER: self.user.name, utils.LABEL_MLHUB_SERVER_NAME: self.name}
         # Get the MLHub container name to be used as the DNS name for the spawned workspaces, so they can connect to the Hub even if the container is
         # removed and restarted
-        client = self.highlevel_docker_client
-
-        # Connect MLHub to the existing workspace networks (in case of removing / recreation). By this, the hub can connect to the existing
-        # workspaces and does not have to restart them.
-        try:
-            network = client.networks.get(self.network_name)
-            self.connect_hub_to_network(network)
-        except:
-            pass
-
-        # Get available resource information
-        self.resource_information = {
-            "cpu_count": psutil.cpu_count(),
-            "memory_count_in_gb": round(psutil.virtual_memory().total/1024/1024/1024, 1),
-            "gpu_count": self.get_gpu_info()
-        }
+        self.hub_name = utils.ENV_HUB_NAME
+        self.default_labels = {utils.LABEL_MLHUB_ORIGIN: self.hub_name, utils.LABEL_MLHUB_USER: self.user.name, utils.LABEL_MLHUB_SERVER_NAME: self.name}
+        # start() adds the user's resource options to extra_host_config, while the warm pool profiles are based on the configured one
+        self.configured_host_config = dict(self.extra_host_config)
+        # NOTE: the spawner must not make Docker calls here, as the hub creates a spawner for every user / server. The hub is connected to the
+        # existing workspace networks once at startup (see networks.reconcile_hub_networks)
     
     @property
     def highlevel_docker_client(self):
-        """Create a highlevel docker client as 'self.client' is the low-level API client.
+        """Return the shared highlevel docker client as 'self.client' is the low-level API client.
 
         Returns:
             docker.DockerClient
         """
         
-        return utils.init_docker_client(self.client_kwargs, self.tls_config)
+        return utils.get_docker_client(self.client_kwargs, self.tls_config)
+
+    @property
+    def client(self):
+        """Return the low-level API client of the shared highlevel docker client, so that the calls of DockerSpawner use the same
+        connection pool and the API version is negotiated only once.
+
+        Returns:
+            docker.APIClient
+        """
+
+        return self.highlevel_docker_client.api
+
+    @property
+    def resource_information(self) -> dict:
+        """Latest snapshot of the host's total and free resources, see host_resources.HostResources"""
+
+        return host_resources.get_host_resources(self.container_cache).snapshot
+
+    @property
+    def executor(self):
+        """Single global executor for all blocking Docker calls. Overrides DockerSpawner's executor, which has only one thread
+        and, thus, serializes the Docker calls of all concurrent spawns.
+        """
+
+        cls = MLHubDockerSpawner
+        if cls._mlhub_executor is None:
+            with _mlhub_executor_lock:
+                if cls._mlhub_executor is None:
+                    cls._mlhub_executor = ThreadPoolExecutor(self.executor_size)
+        return cls._mlhub_executor
+
+    @property
+    def container_cache(self):
+        """Hub-wide cache of the labels, images, and states of the hub's containers.
+
+        Returns:
+            container_cache.ContainerCache
+        """
+
+        return container_cache.get_container_cache(self.highlevel_docker_client, self.hub_name, ttl=self.container_cache_ttl)
+
+    def run_in_executor(self, func, *args, **kwargs):
+        """Run a blocking function, such as a call of the highlevel docker client, in the executor.
+
+        Returns:
+            concurrent.futures.Future: can be yielded in coroutines
+        """
+
+        return self.executor.submit(func, *args, **kwargs)
+
+    def docker(self, method, *args, **kwargs):
+        """Call a method of the low-level docker client in the executor. Pulls are passed to the hub-wide image pull coordinator,
+        so that concurrent spawns of the same image share one pull.
+
+        Returns:
+            Future
+        """
+
+        if method == "pull":
+            return asyncio.ensure_future(self.pull_outside_admission(*args, **kwargs))
+        # the client is resolved in the executor, as creating it negotiates the API version with a blocking call
+        return asyncio.wrap_future(self.run_in_executor(lambda: getattr(self.client, method)(*args, **kwargs)))
+
+    async def pull_outside_admission(self, *args, **kwargs):
+        """Pull an image via the hub-wide image pull coordinator. A pull mostly waits for the registry and can take minutes,
+        so the spawn gives its admission slot to the next waiting spawn meanwhile. Afterwards, it is admitted again ahead of the
+        spawns that are still waiting for their first admission.
+        """
+
+        self.release_spawn()
+        pull_future = image_puller.get_image_pull_coordinator(self.highlevel_docker_client).pull(*args, **kwargs)
+        await asyncio.wrap_future(pull_future)
+        await self.admit_spawn(is_resumed=True)
+
+    async def progress(self):
+        """Report the queue position and the progress of the image pull on the spawn page while the spawn waits for them."""
+
+        async for event in self.admission_progress():
+            yield event
+
+        coordinator = image_puller.get_image_pull_coordinator(self.highlevel_docker_client)
+        last_message = None
+        while True:
+            # after the pull, the spawn waits for its admission again (see pull_outside_admission)
+            admission_message = self.get_admission_message()
+            pull = coordinator.get_pull(self.image) if self.image else None
+            if admission_message is not None:
+                if admission_message != last_message:
+                    last_message = admission_message
+                    yield {"progress": 80, "message": admission_message}
+            elif pull is not None and not pull.is_done:
+                message = pull.get_message()
+                if message != last_message:
+                    last_message = message
+                    # the pull is shown as the first 80 percent of the spawn
+                    yield {"progress": int(pull.fraction * 80), "message": message}
+            await asyncio.sleep(1)
 
     @property
     def network_name(self):
@@ -107,7 +231,8 @@ class MLHubDockerSpawner(DockerSpawner):
         if getattr(self, "name", "") == "":
             return ''
 
-        return spawner_options.get_options_form_docker(self)
+        # Return the function instead of the form, so that JupyterHub renders it with the latest resource snapshot on every request
+        return spawner_options.get_options_form_docker
 
     def options_from_form(self, formdata):
         """Extract the passed form data into the self.user_options variable."""
@@ -137,7 +262,7 @@ class MLHubDockerSpawner(DockerSpawner):
             env['NVIDIA_VISIBLE_DEVICES'] = self.user_options.get('gpus')
 
         if self.user_options.get(utils.OPTION_CPU_LIMIT):
-            env[utils.OPTION_MAX_NUM_THREADS] = self.user_options.get(utils.OPTION_CPU_LIMIT)
+            env[utils.OPTION_MAX_NUM_THREADS] = utils.get_num_threads(self.user_options.get(utils.OPTION_CPU_LIMIT))
 
         env[utils.OPTION_SSH_JUMPHOST_TARGET] = self.object_name
 
@@ -151,29 +276,33 @@ class MLHubDockerSpawner(DockerSpawner):
             (str, int): container's ip address or '127.0.0.1', container's port
         """
 
+        self.start_spawn_trace()
+        try:
+            yield self.admit_spawn()
+            # create the shared docker client outside of the event loop, as it negotiates the API version with a blocking call
+            yield self.run_in_executor(lambda: self.highlevel_docker_client)
+            res = yield self._start()
+        except Exception:
+            self.finish_spawn_trace("failed")
+            raise
+        finally:
+            self.release_spawn()
+        return res
+
+    @gen.coroutine
+    def _start(self) -> (str, int):
         self.saved_user_options = self.user_options
 
         if self.user_options.get(utils.OPTION_IMAGE):
             self.image = self.user_options.get(utils.OPTION_IMAGE)
 
-        extra_host_config = {}
-        if self.user_options.get(utils.OPTION_CPU_LIMIT):
-            # nano_cpus cannot be bigger than the number of CPUs of the machine (this method would currently not work in a cluster, as machines could be different than the machine where the runtime-manager and this code run.
-            max_available_cpus = self.resource_information["cpu_count"]
-            limited_cpus = min(
-                int(self.user_options.get(utils.OPTION_CPU_LIMIT)), max_available_cpus)
-
-            # the nano_cpu parameter of the Docker client expects an integer, not a float
-            nano_cpus = int(limited_cpus * 1e9)
-            extra_host_config['nano_cpus'] = nano_cpus
-        if self.user_options.get(utils.OPTION_MEM_LIMIT):
-            extra_host_config[utils.OPTION_MEM_LIMIT] = str(self.user_options.get(
-                utils.OPTION_MEM_LIMIT)) + "gb"
+        extra_host_config = self.get_resource_host_config(self.user_options)
 
         if self.user_options.get('is_mount_volume') == 'on':
             # {username} and {servername} will be automatically replaced by DockerSpawner with the right values as in template_namespace
             #volumeName = self.name_template.format(prefix=self.prefix)
-            self.highlevel_docker_client.volumes.create(name=self.object_name, labels=self.default_labels)
+            with self.spawn_phase(metrics.PHASE_VOLUME_CREATE):
+                yield self.run_in_executor(self.highlevel_docker_client.volumes.create, name=self.object_name, labels=self.default_labels)
             self.volumes = {self.object_name: "/workspace"}
 
         extra_create_kwargs = {}
@@ -186,9 +315,6 @@ class MLHubDockerSpawner(DockerSpawner):
         else:
             extra_create_kwargs[utils.OPTION_LABELS][utils.LABEL_EXPIRATION_TIMESTAMP] = str(0)
 
-        if self.user_options.get(OPTION_SHM_SIZE):
-            extra_host_config[OPTION_SHM_SIZE] = self.user_options.get('shm_size')
-
         if self.user_options.get('gpus'):
             extra_host_config['runtime'] = "nvidia"
             extra_create_kwargs[utils.OPTION_LABELS][utils.LABEL_NVIDIA_VISIBLE_DEVICES] = self.user_options.get('gpus')
@@ -198,10 +324,13 @@ class MLHubDockerSpawner(DockerSpawner):
 
         # Check whether the network still exists to which the container will try to connect
         try:
-            self.highlevel_docker_client.networks.get(self.network_name)
+            with self.spawn_phase(metrics.PHASE_NETWORK_LOOKUP):
+                yield self.run_in_executor(self.highlevel_docker_client.networks.get, self.network_name)
         except docker.errors.NotFound:
-            created_network = self.create_network(self.network_name)
-            self.connect_hub_to_network(created_network)
+            with self.spawn_phase(metrics.PHASE_NETWORK_CREATE):
+                created_network = yield self.run_in_executor(self.create_network, self.network_name)
+            with self.spawn_phase(metrics.PHASE_HUB_CONNECT):
+                yield self.run_in_executor(self.connect_hub_to_network, created_network)
         except docker.errors.APIError:
             self.log.error("Could not look up network {network_name}".format(network_name=self.network_name))
 
@@ -211,17 +340,114 @@ class MLHubDockerSpawner(DockerSpawner):
         if ((hasattr(self, 'new_creating') and self.new_creating == True) 
             or self.user_options.get("update", False)):
             self.remove = True
+        yield self.prepare_pooled_container()
         res = yield super().start()
         self.remove = False
         self.new_creating = False
         return res
 
+    def get_resource_host_config(self, options: dict) -> dict:
+        """Translate the resource options of a workspace (cpu_limit, mem_limit, shm_size) into Docker host config arguments."""
+
+        extra_host_config = {}
+        if options.get(utils.OPTION_CPU_LIMIT):
+            # nano_cpus cannot be bigger than the number of CPUs of the machine (this method would currently not work in a cluster, as machines could be different than the machine where the runtime-manager and this code run.
+            max_available_cpus = self.resource_information["cpu_count"]
+            limited_cpus = min(
+                float(options.get(utils.OPTION_CPU_LIMIT)), max_available_cpus)
+
+            # the nano_cpu parameter of the Docker client expects an integer, not a float
+            nano_cpus = int(limited_cpus * 1e9)
+            extra_host_config['nano_cpus'] = nano_cpus
+        if options.get(utils.OPTION_MEM_LIMIT):
+            extra_host_config[utils.OPTION_MEM_LIMIT] = str(options.get(
+                utils.OPTION_MEM_LIMIT)) + "gb"
+
+        if options.get(OPTION_SHM_SIZE):
+            extra_host_config[OPTION_SHM_SIZE] = options.get(OPTION_SHM_SIZE)
+
+        return extra_host_config
+
+    def get_warm_pool_key(self) -> str:
+        """Get the key of the warm pool profile that matches this spawn. On the first call, the profiles are passed to the
+        hub-wide warm pool, which then starts to fill itself in the background.
+
+        Returns:
+            str: the profile key or None if the spawn cannot be served from the pool
+        """
+
+        if not self.warm_pool:
+            return None
+
+        if self.has_user_specific_args():
+            # pooled containers are created before the user is known and their command cannot be changed on claim
+            return None
+
+        cls = MLHubDockerSpawner
+        if cls._mlhub_warm_pool_keys is None:
+            # Only the configured traits and the profiles are used, so that nothing of the current spawn ends up in containers
+            # claimed by other users. The resource options are applied on top of the configured host config, the same way as in start.
+            profiles = [{
+                "image": profile["image"],
+                "size": profile.get("size", 1),
+                "command": (list(self.cmd) if self.cmd else None),
+                "args": self.get_args(),
+                "host_config": {**self.configured_host_config, **self.get_resource_host_config(profile)}
+            } for profile in self.warm_pool]
+            keys = warm_pool.get_warm_pool(self.highlevel_docker_client, self.hub_name).set_profiles(profiles)
+            cls._mlhub_warm_pool_keys = [(profile, key) for profile, key in zip(self.warm_pool, keys)]
+
+        if (self.user_options.get('is_mount_volume') == 'on' or self.user_options.get(utils.OPTION_DAYS_TO_LIVE)
+            or self.user_options.get('gpus') or self.volumes):
+            # mounts and labels cannot be added to an existing container
+            return None
+
+        for profile, key in cls._mlhub_warm_pool_keys:
+            if profile["image"] == self.image and all(str(profile.get(option) or "") == str(self.user_options.get(option) or "")
+                    for option in WARM_POOL_PROFILE_OPTIONS):
+                return key
+        return None
+
+    def has_user_specific_args(self) -> bool:
+        """Whether the arguments of the workspace server depend on the user or server, e.g. a notebook_dir of '/home/{username}'."""
+
+        return any("{" in (value or "") for value in (self.notebook_dir, self.default_url))
+
+    @gen.coroutine
+    def prepare_pooled_container(self):
+        """Claim a container from the warm pool for a new workspace, so that DockerSpawner finds and starts it instead of creating one.
+        When a previously claimed container is started again, its env file is rewritten, as JupyterHub uses a new API token for every spawn.
+        """
+
+        obj = yield self.get_object()
+        if obj is not None and not self.remove:
+            if warm_pool.LABEL_MLHUB_POOL in ((obj.get("Config") or {}).get("Labels") or {}):
+                yield self.run_in_executor(warm_pool.write_claim_env, self.highlevel_docker_client, obj["Id"], self.get_env())
+            return
+
+        key = yield self.run_in_executor(self.get_warm_pool_key)
+        if key is None or warm_pool.get_warm_pool(self.highlevel_docker_client, self.hub_name).get_available_count(key) == 0:
+            return
+
+        if obj is not None:
+            yield self.remove_object()
+
+        with self.spawn_phase(metrics.PHASE_POOL_CLAIM):
+            container_id = yield self.run_in_executor(warm_pool.get_warm_pool(self.highlevel_docker_client, self.hub_name).claim,
+                key, self.object_name, self.network_name, self.get_env())
+        if container_id is not None:
+            self.log.info("Claimed pooled container {} for {}".format(container_id[:12], self.object_name))
+            # the claimed container must not be removed by DockerSpawner
+            self.remove = False
+
     @gen.coroutine
     def create_object(self):
         created_network = None
         try:
-            created_network = self.create_network(self.network_name)
-            self.connect_hub_to_network(created_network)
+            with self.spawn_phase(metrics.PHASE_NETWORK_CREATE):
+                created_network = yield self.run_in_executor(self.create_network, self.network_name)
+            with self.spawn_phase(metrics.PHASE_HUB_CONNECT):
+                yield self.run_in_executor(self.connect_hub_to_network, created_network)
         except:
             self.log.error(
                 "Could not create the network {network_name} and, thus, cannot create the container."
@@ -229,9 +455,27 @@ class MLHubDockerSpawner(DockerSpawner):
             )
             return
         
-        obj = yield super().create_object()
+        with self.spawn_phase(metrics.PHASE_CONTAINER_CREATE):
+            obj = yield super().create_object()
         return obj
-        
+
+    @gen.coroutine
+    def start_object(self):
+        with self.spawn_phase(metrics.PHASE_CONTAINER_START):
+            yield super().start_object()
+
+    @gen.coroutine
+    def pull_image(self, image):
+        with self.spawn_phase(metrics.PHASE_IMAGE_PULL):
+            yield super().pull_image(image)
+
+    @gen.coroutine
+    def stop(self, now=False):
+        # a spawn that still waits for its admission does not start anymore
+        self.cancel_waiting_spawn()
+        self.abort_spawn_trace()
+        yield super().stop(now=now)
+
     @gen.coroutine
     def remove_object(self):
         yield super().remove_object()
@@ -242,8 +486,10 @@ class MLHubDockerSpawner(DockerSpawner):
         Containers are separated by networks to prevent them from seeing each other.
         Determine whether a new subnet has to be used. Otherwise, the default Docker subnet would be used
         and, as a result, the amount of networks that can be created is strongly limited.
-        We create networks in the range of 172.33-255.0.0/24 whereby Docker by default uses the range 172.17-32.0.0
+        We create networks in the range of 172.33-255.0.0 whereby Docker by default uses the range 172.17-32.0.0
         See: https://stackoverflow.com/questions/41609998/how-to-increase-maximum-docker-network-on-one-server ; https://loomchild.net/2016/09/04/docker-can-create-only-31-networks-on-a-single-machine/
+        The subnets are handed out by the hub-wide networks.SubnetAllocator, so that concurrent spawns never pick the same subnet
+        and subnets of removed networks are reused.
 
         Args:
             name (str): name of the network to be created
@@ -254,37 +500,38 @@ class MLHubDockerSpawner(DockerSpawner):
         """
 
         client = self.highlevel_docker_client
-        networks = client.networks.list()
-        highest_cidr = ipaddress.ip_network(INITIAL_CIDR)
-
-        # determine subnet for the network to be created by finding the highest subnet so far.
-        # E.g. when you have three subnets 172.33.1.0, 172.33.2.0, and 172.33.3.0, highest_cidr will be 172.33.3.0
-        for network in networks:
-            if network.name.lower() == name.lower():
-                self.log.info("Network {} already exists".format(name))
-                return network
-
-            if (has_complete_network_information(network)):
-                cidr = ipaddress.ip_network(
-                    network.attrs["IPAM"]["Config"][0]["Subnet"])
-
-                if cidr.network_address.packed[0] == INITIAL_CIDR_FIRST_OCTET \
-                        and cidr.network_address.packed[1] >= INITIAL_CIDR_SECOND_OCTET:
-                    if cidr > highest_cidr:
-                        highest_cidr = cidr
-
-        # take the highest cidr and add 256 bits, so that if the highest subnet was 172.33.2.0, the new subnet is 172.33.3.0
-        next_cidr = ipaddress.ip_network(
-            (highest_cidr.network_address + 256).exploded + "/24")
-        if next_cidr.network_address.packed[0] > INITIAL_CIDR_FIRST_OCTET:
-            raise Exception("No more possible subnet addresses exist")
-
-        self.log.info("Create network {} with subnet {}".format(
-            name, next_cidr.exploded))
-        ipam_pool = docker.types.IPAMPool(subnet=next_cidr.exploded,
-                                          gateway=(next_cidr.network_address + 1).exploded)
-        ipam_config = docker.types.IPAMConfig(pool_configs=[ipam_pool])
-        return client.networks.create(name, ipam=ipam_config, labels=self.default_labels)
+        try:
+            network = client.networks.get(name)
+            self.log.info("Network {} already exists".format(name))
+            return network
+        except docker.errors.NotFound:
+            pass
+
+        allocator = networks.get_subnet_allocator(client, self.subnet_prefix_length)
+        for _ in range(MAX_SUBNET_ALLOCATION_ATTEMPTS):
+            subnet = allocator.allocate()
+            if subnet is None:
+                # Networks might have been removed in the meantime (e.g. by the cleanup service), so rebuild the allocator to reclaim their subnets
+                allocator.load(client.networks.list())
+                subnet = allocator.allocate()
+            if subnet is None:
+                raise Exception("No more possible subnet addresses exist")
+
+            self.log.info("Create network {} with subnet {}".format(
+                name, subnet.exploded))
+            ipam_pool = docker.types.IPAMPool(subnet=subnet.exploded,
+                                              gateway=(subnet.network_address + 1).exploded)
+            ipam_config = docker.types.IPAMConfig(pool_configs=[ipam_pool])
+            try:
+                return client.networks.create(name, ipam=ipam_config, labels=self.default_labels)
+            except docker.errors.APIError as e:
+                if not networks.is_pool_overlap_error(e):
+                    allocator.release(subnet)
+                    raise
+                # The subnet is used by a network the allocator does not know about, so it stays marked as used and the next one is tried
+                self.log.warn("Subnet {} is already in use. Try the next one.".format(subnet.exploded))
+
+        raise Exception("Could not find a free subnet for network {}".format(name))
     
     def connect_hub_to_network(self, network):
         try:
@@ -303,9 +550,17 @@ class MLHubDockerSpawner(DockerSpawner):
 
     def is_update_available(self):
         try:
+            container = self.container_cache.get(self.container_id or self.object_name)
+            if container is None:
+                return False
+
+            image_tags = self.container_cache.get_image_tags(container["image_id"])
+            if len(image_tags) == 0:
+                return False
+
             # compare the last parts of the images, so that also "mltooling/ml-workspace:0.8.7 = ml-workspace:0.8.7" would match
             config_image = self.image.split("/")[-1]
-            workspace_image = self.highlevel_docker_client.containers.get(self.container_id).image.tags[0].split("/")[-1]
+            workspace_image = image_tags[0].split("/")[-1]
 
             return config_image != workspace_image
         except (docker.errors.NotFound, docker.errors.NullResource):
@@ -313,7 +568,13 @@ class MLHubDockerSpawner(DockerSpawner):
 
     def get_labels(self) -> dict:
         try:
-            return self.highlevel_docker_client.containers.get(self.container_id).labels
+            container = self.container_cache.get(self.container_id or self.object_name)
+            if container is None:
+                return {}
+            if warm_pool.LABEL_MLHUB_POOL in container["labels"]:
+                # a claimed pooled container only carries the origin and pool labels
+                return {**self.default_labels, **container["labels"]}
+            return container["labels"]
         except:
             return {}
 
@@ -336,16 +597,3 @@ class MLHubDockerSpawner(DockerSpawner):
     def load_state(self, state):
         super(MLHubDockerSpawner, self).load_state(state)
         utils.load_state(self, state)
-
-    def get_gpu_info(self) -> list:
-        count_gpu = 0
-        try:
-            # NOTE: this approach currently only works for nvidia gpus.
-            ps = subprocess.Popen(('find', '/proc/irq/', '-name', 'nvidia'), stdout=subprocess.PIPE)
-            output = subprocess.check_output(('wc', '-l'), stdin=ps.stdout)
-            ps.wait()
-            count_gpu = int(output.decode("utf-8"))
-        except:
-            pass
-
-        return count_gpu
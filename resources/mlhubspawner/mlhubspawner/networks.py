@@ -0,0 +1,195 @@
+"""
+Hub-wide handling of the workspace networks which are created in Docker-local mode.
+"""
+
+import ipaddress
+import threading
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker.errors
+
+from mlhubspawner import utils
+
+# we create networks in the range of 172.33.0.0 - 172.255.255.255
+# Docker by default uses the range 172.17-32.0.0, so we should be save using that range
+SUBNET_RANGE_START = ipaddress.ip_address("172.33.0.0")
+SUBNET_RANGE_END = ipaddress.ip_address("172.255.255.255")
+
+# Number of networks that are connected to the hub in parallel during the startup reconciliation
+RECONCILE_MAX_WORKERS = 16
+
+# One allocator per prefix length (see get_subnet_allocator)
+_subnet_allocators = {}
+_subnet_allocators_lock = threading.Lock()
+
+def has_complete_network_information(network):
+    """Convenient function to check whether the docker.Network object has all required properties.
+
+    Args:
+        network (docker.Network)
+
+    Returns:
+        bool: True if it has all properties, False otehrwise.
+    """
+    return network.attrs["IPAM"] and network.attrs["IPAM"]["Config"] \
+        and len(network.attrs["IPAM"]["Config"]) > 0 \
+        and network.attrs["IPAM"]["Config"][0].get("Subnet")
+
+def is_pool_overlap_error(error) -> bool:
+    """Docker refuses to create a network whose subnet overlaps with an existing one, e.g. 'Pool overlaps with other one on this address space'."""
+    return "overlaps" in str(error).lower()
+
+class SubnetAllocator():
+    """Hands out free subnets of the hub's address range in O(1).
+    The allocator keeps a bitmap of the used subnets which is built once from the existing networks. Subnets that were never
+    handed out are taken in ascending order, released subnets are reused first. All methods are thread-safe.
+    """
+
+    def __init__(self, prefix_length: int = 24, range_start=SUBNET_RANGE_START, range_end=SUBNET_RANGE_END):
+        self.prefix_length = prefix_length
+        self.subnet_size = 2 ** (32 - prefix_length)
+        # align the first subnet to the subnet size, otherwise the network addresses would not be valid
+        self._first_address = -(-int(range_start) // self.subnet_size) * self.subnet_size
+        self.capacity = max(0, (int(range_end) + 1 - self._first_address) // self.subnet_size)
+
+        self._lock = threading.Lock()
+        self._used = bytearray(self.capacity)
+        self._released = collections.deque()
+        self._next_index = 0
+
+    def load(self, networks) -> None:
+        """(Re-)build the bitmap from the given docker networks. Subnets of networks that were removed in the meantime become free again.
+
+        Args:
+            networks (list): list of docker.Network objects
+        """
+
+        used = bytearray(self.capacity)
+        for network in networks:
+            if has_complete_network_information(network):
+                self._mark(used, ipaddress.ip_network(network.attrs["IPAM"]["Config"][0]["Subnet"], strict=False), 1)
+
+        with self._lock:
+            self._used = used
+            self._released.clear()
+            self._next_index = 0
+
+    def allocate(self):
+        """Reserve the next free subnet.
+
+        Returns:
+            ipaddress.IPv4Network: the reserved subnet or None if the address range is exhausted
+        """
+
+        with self._lock:
+            while self._released:
+                index = self._released.popleft()
+                if not self._used[index]:
+                    self._used[index] = 1
+                    return self._get_subnet(index)
+
+            while self._next_index < self.capacity:
+                index = self._next_index
+                self._next_index += 1
+                if not self._used[index]:
+                    self._used[index] = 1
+                    return self._get_subnet(index)
+
+        return None
+
+    def mark_used(self, subnet) -> None:
+        with self._lock:
+            self._mark(self._used, subnet, 1)
+
+    def release(self, subnet) -> None:
+        """Give a subnet back to the allocator, e.g. because its network was removed or could not be created."""
+
+        with self._lock:
+            for index in self._mark(self._used, subnet, 0):
+                self._released.append(index)
+
+    def _get_subnet(self, index: int):
+        return ipaddress.ip_network("{}/{}".format(ipaddress.ip_address(self._first_address + index * self.subnet_size), self.prefix_length))
+
+    def _mark(self, bitmap: bytearray, subnet, value: int) -> range:
+        """Set all bitmap entries overlapping with `subnet` to `value`.
+
+        Returns:
+            range: the indices that were set
+        """
+
+        if subnet.version != 4:
+            return range(0)
+
+        first_index = max(0, (int(subnet.network_address) - self._first_address) // self.subnet_size)
+        last_index = min(self.capacity - 1, (int(subnet.broadcast_address) - self._first_address) // self.subnet_size)
+        if int(subnet.broadcast_address) < self._first_address or first_index > last_index:
+            return range(0)
+
+        indices = range(first_index, last_index + 1)
+        for index in indices:
+            bitmap[index] = value
+        return indices
+
+def get_subnet_allocator(docker_client, prefix_length: int = 24) -> SubnetAllocator:
+    """Return the hub-wide subnet allocator for the given prefix length. On first use, it is built from the networks
+    that currently exist on the Docker host (one `networks.list` call).
+
+    Args:
+        docker_client (docker.DockerClient)
+        prefix_length (int): prefix length of the subnets to hand out, e.g. 24 or 28
+
+    Returns:
+        SubnetAllocator
+    """
+
+    with _subnet_allocators_lock:
+        allocator = _subnet_allocators.get(prefix_length)
+        if allocator is None:
+            allocator = SubnetAllocator(prefix_length)
+            allocator.load(docker_client.networks.list())
+            _subnet_allocators[prefix_length] = allocator
+
+    return allocator
+
+def reconcile_hub_networks(docker_client, hub_name: str, max_workers: int = RECONCILE_MAX_WORKERS) -> dict:
+    """Connect the hub container to all workspace networks it is not attached to, e.g. after the hub container was recreated.
+    By this, the hub can reach the existing workspaces and does not have to restart them. Should be called once at hub startup.
+
+    Args:
+        docker_client (docker.DockerClient)
+        hub_name (str): name of the hub container, which is also the value of the `mlhub.origin` label of the networks
+        max_workers (int): number of networks that are connected in parallel
+
+    Returns:
+        dict: number of `networks`, `missing` and `connected` networks and the `duration_seconds` of the reconciliation
+    """
+
+    start_time = time.time()
+    label_filter = {"label": "{}={}".format(utils.LABEL_MLHUB_ORIGIN, hub_name)}
+    hub_networks = docker_client.api.networks(filters=label_filter)
+    hub_container = docker_client.api.inspect_container(hub_name)
+    attached_networks = set((hub_container["NetworkSettings"].get("Networks") or {}).keys())
+    missing_networks = [network for network in hub_networks if network["Name"] not in attached_networks]
+
+    def connect(network) -> bool:
+        try:
+            docker_client.api.connect_container_to_network(hub_name, network["Id"])
+            return True
+        except docker.errors.APIError as e:
+            # 403 means that the hub is already in the network
+            return e.status_code == 403
+
+    connected_count = 0
+    if len(missing_networks) > 0:
+        with ThreadPoolExecutor(max_workers) as executor:
+            connected_count = sum(executor.map(connect, missing_networks))
+
+    return {
+        "networks": len(hub_networks),
+        "missing": len(missing_networks),
+        "connected": connected_count,
+        "duration_seconds": time.time() - start_time
+    }
@@ -0,0 +1,267 @@
+"""
+Hub-wide admission control of workspace spawns.
+At most `max_concurrent_spawns` spawns talk to the Docker daemon or the Kubernetes API server at the same time. Further spawns
+wait in a queue that is fair between users: the waiting spawns are admitted round-robin per user in the order the users arrived,
+so that a user who starts many servers at once does not delay everybody else. Spawns of admins are admitted before those of other users.
+If more than `spawn_queue_size` spawns are waiting, a new spawn is rejected right away instead of waiting until it runs into the start timeout.
+A spawn that gave up its slot for a while, e.g. during an image pull, resumes ahead of all other waiting spawns and is never rejected.
+
+All methods have to be called from the hub's event loop.
+"""
+
+import asyncio
+import collections
+
+from prometheus_client import Counter, Gauge
+from tornado import gen, web
+from tornado.concurrent import Future
+
+from mlhubspawner import metrics
+
+# Seconds between two queue position updates on the spawn page
+PROGRESS_INTERVAL_SECONDS = 1
+
+SPAWNS_IN_FLIGHT = Gauge("mlhub_spawn_admission_in_flight", "Number of admitted spawns that are not finished yet")
+SPAWNS_QUEUED = Gauge("mlhub_spawn_admission_queued", "Number of spawns waiting for admission")
+SPAWNS_REJECTED = Counter("mlhub_spawn_admission_rejected_total", "Spawns rejected because the admission queue was full")
+
+_admission_controller = None
+
+class SpawnTicket():
+    """Place of one spawn in the admission queue. The future resolves once the spawn is admitted."""
+
+    def __init__(self, user_name: str, is_admin: bool, is_resumed: bool = False):
+        self.user_name = user_name
+        self.is_admin = is_admin
+        self.is_resumed = is_resumed
+        self.future = Future()
+        # set by the spawn once it continues after its admission, see SpawnAdmission.admit_spawn
+        self.is_started = False
+        self.is_released = False
+
+    @property
+    def is_waiting(self) -> bool:
+        return not self.future.done()
+
+class SpawnAdmissionController():
+    """Caps the number of in-flight spawns and queues the others fairly per user, see the module description.
+
+    Args:
+        max_in_flight (int): maximum number of admitted spawns; 0 or less admits every spawn right away
+        max_queued (int): maximum number of waiting spawns
+    """
+
+    def __init__(self, max_in_flight: int, max_queued: int):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+
+        self._in_flight = 0
+        # user name -> waiting tickets; the order of the users is the round-robin order
+        self._queues = collections.OrderedDict()
+        self._admin_queues = collections.OrderedDict()
+        # spawns that gave up their slot temporarily, in the order they came back
+        self._resumed_queue = collections.deque()
+        self._queued = 0
+        # ticket -> 0-based position, rebuilt lazily after the queue changed
+        self._positions = None
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def request(self, user_name: str, is_admin: bool = False, is_resumed: bool = False) -> SpawnTicket:
+        """Request the admission of a spawn. The spawn may continue once the future of the returned ticket is resolved
+        and has to release the ticket when it is finished (see release).
+
+        Args:
+            is_resumed (bool): the spawn was admitted before and gave up its slot temporarily; it is admitted before all other
+                waiting spawns and never rejected
+
+        Raises:
+            tornado.web.HTTPError: 429 if the queue is full
+        """
+
+        ticket = SpawnTicket(user_name, is_admin, is_resumed=is_resumed)
+        # a resumed spawn only waits behind other resumed spawns
+        is_queue_empty = not self._resumed_queue if is_resumed else self._queued == 0
+        if self.max_in_flight <= 0 or (self._in_flight < self.max_in_flight and is_queue_empty):
+            self._admit(ticket)
+            return ticket
+
+        if is_resumed:
+            self._resumed_queue.append(ticket)
+        elif self._queued >= self.max_queued:
+            SPAWNS_REJECTED.inc()
+            raise web.HTTPError(429, "Too many workspaces are starting right now. Try again in a minute.")
+        else:
+            queues = self._admin_queues if is_admin else self._queues
+            queues.setdefault(user_name, collections.deque()).append(ticket)
+        self._queued += 1
+        self._positions = None
+        SPAWNS_QUEUED.set(self._queued)
+        return ticket
+
+    def release(self, ticket: SpawnTicket) -> None:
+        """Release an admitted ticket or remove a waiting one from the queue, e.g. when the spawn was stopped. A waiting ticket's future fails."""
+
+        if ticket.is_released:
+            return
+        ticket.is_released = True
+
+        if ticket.is_waiting:
+            queues = self._admin_queues if ticket.is_admin else self._queues
+            queue = self._resumed_queue if ticket.is_resumed else queues.get(ticket.user_name)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                if not queue and not ticket.is_resumed:
+                    del queues[ticket.user_name]
+                self._queued -= 1
+                self._positions = None
+                SPAWNS_QUEUED.set(self._queued)
+            ticket.future.set_exception(RuntimeError("The spawn was stopped while it waited for admission."))
+            return
+
+        self._in_flight -= 1
+        SPAWNS_IN_FLIGHT.set(self._in_flight)
+        self._admit_waiting()
+
+    def get_position(self, ticket: SpawnTicket) -> int:
+        """Return the 1-based position of a waiting ticket in the admission order or 0 if it is not waiting."""
+
+        if self._positions is None:
+            self._positions = {ticket: position for position, ticket in enumerate(self._get_admission_order())}
+        position = self._positions.get(ticket)
+        return position + 1 if position is not None else 0
+
+    def _get_admission_order(self) -> list:
+        """The order in which the waiting tickets are admitted if no other spawns arrive: resumed spawns first, then admins,
+        each group of new spawns round-robin per user."""
+
+        order = list(self._resumed_queue)
+        for queues in (self._admin_queues, self._queues):
+            rounds = []
+            for user_queue in queues.values():
+                for round_index, ticket in enumerate(user_queue):
+                    if round_index == len(rounds):
+                        rounds.append([])
+                    rounds[round_index].append(ticket)
+            order.extend(ticket for tickets in rounds for ticket in tickets)
+        return order
+
+    def _admit(self, ticket: SpawnTicket) -> None:
+        self._in_flight += 1
+        SPAWNS_IN_FLIGHT.set(self._in_flight)
+        ticket.future.set_result(None)
+
+    def _admit_waiting(self) -> None:
+        while self._queued > 0 and (self.max_in_flight <= 0 or self._in_flight < self.max_in_flight):
+            if self._resumed_queue:
+                self._queued -= 1
+                self._positions = None
+                SPAWNS_QUEUED.set(self._queued)
+                self._admit(self._resumed_queue.popleft())
+                continue
+
+            queues = self._admin_queues if self._admin_queues else self._queues
+            user_name, user_queue = next(iter(queues.items()))
+            ticket = user_queue.popleft()
+            if user_queue:
+                # the user's next spawn has to wait until every other waiting user had a turn
+                queues.move_to_end(user_name)
+            else:
+                del queues[user_name]
+            self._queued -= 1
+            self._positions = None
+            SPAWNS_QUEUED.set(self._queued)
+            self._admit(ticket)
+
+def get_spawn_admission_controller(max_in_flight: int, max_queued: int) -> SpawnAdmissionController:
+    """Return the hub-wide admission controller. The limits are updated to the given values, e.g. after the hub config changed.
+
+    Returns:
+        SpawnAdmissionController
+    """
+
+    global _admission_controller
+    if _admission_controller is None:
+        _admission_controller = SpawnAdmissionController(max_in_flight, max_queued)
+    else:
+        _admission_controller.max_in_flight = max_in_flight
+        _admission_controller.max_queued = max_queued
+
+    return _admission_controller
+
+class SpawnAdmission():
+    """Mixin for the MLHub spawners that lets every spawn wait for its admission by the hub-wide controller.
+    The spawner sets the traits `max_concurrent_spawns` and `spawn_queue_size`, wraps its start with `admit_spawn` and `release_spawn`,
+    and reports `admission_progress` on the spawn page.
+    """
+
+    _spawn_ticket = None
+
+    @property
+    def spawn_admission_controller(self) -> SpawnAdmissionController:
+        return get_spawn_admission_controller(self.max_concurrent_spawns, self.spawn_queue_size)
+
+    @gen.coroutine
+    def admit_spawn(self, is_resumed: bool = False):
+        """Wait until the spawn is admitted. Must be followed by release_spawn once the spawn is finished, also if it failed.
+
+        Args:
+            is_resumed (bool): the spawn released its slot temporarily (see SpawnAdmissionController.request)
+
+        Raises:
+            tornado.web.HTTPError: 429 if the admission queue is full
+        """
+
+        self._spawn_ticket = None
+        ticket = self.spawn_admission_controller.request(self.user.name, is_admin=bool(getattr(self.user, "admin", False)), is_resumed=is_resumed)
+        self._spawn_ticket = ticket
+        if ticket.is_waiting:
+            self.log.info("Spawn of {} waits for admission at position {}".format(self.user.name, self.spawn_admission_controller.get_position(ticket)))
+            with self.spawn_phase(metrics.PHASE_ADMISSION_WAIT):
+                yield ticket.future
+        ticket.is_started = True
+
+    def release_spawn(self) -> None:
+        if self._spawn_ticket is not None:
+            self.spawn_admission_controller.release(self._spawn_ticket)
+
+    def cancel_waiting_spawn(self) -> None:
+        """Remove the spawn from the admission queue if it still waits, e.g. when it is stopped. Its admit_spawn fails."""
+
+        if self._spawn_ticket is not None and self._spawn_ticket.is_waiting:
+            self.spawn_admission_controller.release(self._spawn_ticket)
+
+    def get_admission_message(self) -> str:
+        """Return the queue position of the spawn for the spawn page, or None if the spawn does not wait for admission.
+        Follows the current ticket, so that also the wait of a resumed spawn is reported.
+        """
+
+        ticket = self._spawn_ticket
+        if ticket is None or not ticket.is_waiting:
+            return None
+
+        position = self.spawn_admission_controller.get_position(ticket)
+        if not position:
+            return None
+        return "Waiting for a free spawn slot: position {} of {} in the queue".format(position, self.spawn_admission_controller.queued)
+
+    async def admission_progress(self):
+        """Report the queue position on the spawn page until the spawn continues after its admission."""
+
+        last_message = None
+        while True:
+            ticket = self._spawn_ticket
+            if ticket is None or ticket.is_started or ticket.is_released:
+                return
+
+            message = self.get_admission_message()
+            if message and message != last_message:
+                last_message = message
+                yield {"progress": 0, "message": message}
+            await asyncio.sleep(PROGRESS_INTERVAL_SECONDS)
@@ -1,46 +1,81 @@
 """
 Functions to provide Jupyterhub Options forms for our custom spawners.
+The static parts of the forms are substituted once on import; the rendered forms are cached per workspace image list and
+resource snapshot, so that showing the spawn page does not rebuild the HTML for every request.
 """
 
+import re
+import functools
+
+from mlhubspawner import utils
+
 label_style = "width: 25%"
 input_style = "width: 75%"
 div_style = "margin-bottom: 16px"
 additional_info_style="margin-top: 4px; color: rgb(165,165,165); font-size: 12px;"
 optional_label = "<span style=\"font-size: 12px; font-weight: 400;\">(optional)</span>"
 
-def get_options_form(spawner, additional_cpu_info="", additional_memory_info="", additional_gpu_info="") -> str:
-    """Return the spawner options screen"""
-
-    # Only show spawner options for named servers (the default server should start with default values)
-    if getattr(spawner, "name", "") == "":
-        return ''
-
-    description_memory_limit = 'Memory Limit in GB.'
-    description_env = 'One name=value pair per line, without quotes'
-    description_days_to_live = 'Number of days the container should live'
-
-    default_image = getattr(spawner, "image", "mltooling/ml-workspace:latest")
-
-    # Show / hide custom image input field when checkbox is clicked
-    custom_image_listener = "if(event.target.checked){ $('#image-name').css('display', 'block'); $('.defined-images').css('display', 'none'); }else{ $('#image-name').css('display', 'none'); $('.defined-images').css('display', 'block'); }"
-    
-    # Indicate a wrong input value (not a number) by changing the color to red
-    memory_input_listener = "if(isNaN(event.srcElement.value)){ $('#mem-limit').css('color', 'red'); }else{ $('#mem-limit').css('color', 'black'); }"
-
-    # Create drop down menu with pre-defined custom images
-    image_option_template = """
+description_memory_limit = 'Memory Limit in GB.'
+description_env = 'One name=value pair per line, without quotes'
+description_days_to_live = 'Number of days the container should live'
+description_gpus = 'Leave empty for no GPU, "all" for all GPUs, or a comma-separated list of indices of the GPUs (e.g 0,2).'
+
+# Number of rendered forms that are kept, e.g. per combination of image list and resource snapshot
+OPTIONS_FORM_CACHE_SIZE = 64
+
+# Validation schema of the form fields: field -> (pattern, error message). Empty fields are not validated, as all fields are optional.
+OPTIONS_SCHEMA = {
+    utils.OPTION_IMAGE: (re.compile(r"^\S+$"), "The image name must not contain whitespace."),
+    utils.OPTION_CPU_LIMIT: (re.compile(r"^(?:0|[1-9][0-9]*)(?:\.[0-9]+)?$"), "CPU Limit must be a positive number of CPUs, e.g. 0.5 or 8."),
+    utils.OPTION_MEM_LIMIT: (re.compile(r"^([0-9]*\.)?[0-9]+$"), "Memory Limit must be a number of GB, e.g. 1, 2, 15."),
+    utils.OPTION_DAYS_TO_LIVE: (re.compile(r"^[1-9][0-9]*$"), "Days to live must be a positive whole number, e.g. 3."),
+    "shm_size": (re.compile(r"^[0-9]+[bkmg]?b?$", re.IGNORECASE), "Shared Memory Size must be a size such as 256m or 2g."),
+    "gpus": (re.compile(r"^(all|[0-9]+(\s*,\s*[0-9]+)*)$"), "GPUs must be 'all' or a comma-separated list of GPU indices, e.g. 0,2."),
+}
+# Fields whose value must be bigger than 0 in addition to matching the schema
+POSITIVE_OPTIONS = {utils.OPTION_CPU_LIMIT}
+ENV_LINE_PATTERN = re.compile(r"^\s*([^=\s]+)\s*=(.*)$")
+
+class _PartialFormat(dict):
+    """Keeps the placeholders that are not given, so that they can be filled by a later str.format call."""
+
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+def precompile_template(template: str, **static_values) -> str:
+    """Substitute the given static values into a template. The remaining placeholders are left for str.format at render time."""
+
+    escaped_values = {key: str(value).replace("{", "{{").replace("}", "}}") for key, value in static_values.items()}
+    return template.format_map(_PartialFormat(escaped_values))
+
+# Show / hide custom image input field when checkbox is clicked
+custom_image_listener = "if(event.target.checked){ $('#image-name').css('display', 'block'); $('.defined-images').css('display', 'none'); }else{ $('#image-name').css('display', 'none'); $('.defined-images').css('display', 'block'); }"
+
+# Indicate a wrong input value (not a number) by changing the color to red
+memory_input_listener = "if(isNaN(event.srcElement.value)){ $('#mem-limit').css('color', 'red'); }else{ $('#mem-limit').css('color', 'black'); }"
+
+# When GPus shall be used, change the default image to the default gpu image (if the user entered a different image, it is not changed), and show an info box
+# reminding the user of inserting a GPU-leveraging docker image
+show_gpu_info_box = "$('#gpu-info-box').css('display', 'block');"
+hide_gpu_info_box = "$('#gpu-info-box').css('display', 'none');"
+gpu_input_listener = "if(event.srcElement.value !== ''){{ {show_gpu_info_box} }}else{{ {hide_gpu_info_box} }}" \
+    .format(
+        show_gpu_info_box=show_gpu_info_box,
+        hide_gpu_info_box=hide_gpu_info_box
+)
+
+additional_shm_size_info = "This will override the default shm_size value. Check the <a href='https://docs.docker.com/compose/compose-file/#shm_size'>documentation</a> for more info."
+
+# Create drop down menu with pre-defined custom images
+IMAGE_OPTION_TEMPLATE = """
         <option value="{image}">{image}</option>
     """
-    image_options = ""
-    for image in spawner.workspace_images:
-        image_options += image_option_template.format(image=image)
 
-    images_template = """
+IMAGES_TEMPLATE = """
         <select name="defined_image" class="defined-images" required autofocus>{image_options}</select>
-    """.format(image_options=image_options)
+    """
 
-    # template = super()._default_options_form()
-    return """
+OPTIONS_FORM_TEMPLATE = precompile_template("""
         <div style="{div_style}">
             <label style="{label_style}" for="image">Docker Image</label>
             <div name="image">
@@ -54,7 +89,7 @@ def get_options_form(spawner, additional_cpu_info="", additional_memory_info="",
         </div>
         <div style="{div_style}">
             <label style="{label_style}" for="cpu_limit">CPU Limit {optional_label}</label>
-            <input style="{input_style}" name="cpu_limit" placeholder="e.g. 8"></input>
+            <input style="{input_style}" name="cpu_limit" placeholder="e.g. 0.5, 2, 8"></input>
             <div style="{additional_info_style}">{additional_cpu_info}</div>
         </div>
         <div style="{div_style}">
@@ -71,49 +106,20 @@ def get_options_form(spawner, additional_cpu_info="", additional_memory_info="",
             <label style="{label_style}" for="days_to_live" title="{description_days_to_live}">Days to live {optional_label}</label>
             <input style="{input_style}" name="days_to_live" title="{description_days_to_live}" placeholder="e.g. 3"></input>
         </div>
-    """.format(
-        div_style=div_style,
-        label_style=label_style,
-        input_style=input_style,
-        additional_info_style=additional_info_style,
-        default_image=default_image,
-        images_template=images_template,
-        custom_image_listener=custom_image_listener,
-        optional_label=optional_label,
-        description_memory_limit=description_memory_limit,
-        memory_input_listener=memory_input_listener,
-        description_env=description_env,
-        description_days_to_live=description_days_to_live,
-        additional_cpu_info=additional_cpu_info,
-        additional_memory_info=additional_memory_info,
-    )
-
-def get_options_form_docker(spawner):
-    description_gpus = 'Leave empty for no GPU, "all" for all GPUs, or a comma-separated list of indices of the GPUs (e.g 0,2).'
-    additional_info = {
-        "additional_cpu_info": "Host has {cpu_count} CPUs".format(cpu_count=spawner.resource_information['cpu_count']),
-        "additional_memory_info": "Host has {memory_count_in_gb}GB memory".format(memory_count_in_gb=spawner.resource_information['memory_count_in_gb']),
-        "additional_gpu_info": "<div>Host has {gpu_count} GPUs</div><div>{description_gpus}</div>".format(gpu_count=spawner.resource_information['gpu_count'], description_gpus=description_gpus)
-    }
-    options_form = get_options_form(spawner, **additional_info)
-    
-    # When GPus shall be used, change the default image to the default gpu image (if the user entered a different image, it is not changed), and show an info box
-    # reminding the user of inserting a GPU-leveraging docker image
-    show_gpu_info_box = "$('#gpu-info-box').css('display', 'block');"
-    hide_gpu_info_box = "$('#gpu-info-box').css('display', 'none');"
-    gpu_input_listener = "if(event.srcElement.value !== ''){{ {show_gpu_info_box} }}else{{ {hide_gpu_info_box} }}" \
-        .format(
-            show_gpu_info_box=show_gpu_info_box, 
-            hide_gpu_info_box=hide_gpu_info_box
-    )
-
-    gpu_disabled = ""
-    if spawner.resource_information['gpu_count'] < 1:
-        gpu_disabled = "disabled"
-
-    additional_shm_size_info = "This will override the default shm_size value. Check the <a href='https://docs.docker.com/compose/compose-file/#shm_size'>documentation</a> for more info."
-    options_form_docker = \
-    """
+    """,
+    div_style=div_style,
+    label_style=label_style,
+    input_style=input_style,
+    additional_info_style=additional_info_style,
+    custom_image_listener=custom_image_listener,
+    optional_label=optional_label,
+    description_memory_limit=description_memory_limit,
+    memory_input_listener=memory_input_listener,
+    description_env=description_env,
+    description_days_to_live=description_days_to_live,
+)
+
+OPTIONS_FORM_DOCKER_TEMPLATE = precompile_template("""
     <div style="{div_style}">
         <label style="{label_style}" for="shm_size">Shared Memory Size {optional_label}</label>
         <input style="{input_style}" name="shm_size" placeholder="default is {default_shm_size}"></input>
@@ -129,46 +135,118 @@ def get_options_form_docker(spawner):
         <div style="{additional_info_style}">{additional_gpu_info}</div>
         <div style="background-color: #ffa000; padding: 8px; margin-top: 4px; display: none; {input_style}" id="gpu-info-box">When using GPUs, make sure to use a GPU-supporting Docker image!</div>
     </div>
-    """.format(
-        div_style=div_style,
-        label_style=label_style,
-        input_style=input_style,
-        additional_info_style=additional_info_style,
-        optional_label=optional_label,
-        default_shm_size=spawner.extra_host_config["shm_size"] if "shm_size" in spawner.extra_host_config else "0m",
-        additional_shm_size_info=additional_shm_size_info,
-        gpu_input_listener=gpu_input_listener,
-        gpu_disabled=gpu_disabled,
-        description_gpus=description_gpus,
-        additional_gpu_info=additional_info['additional_gpu_info']
+    """,
+    div_style=div_style,
+    label_style=label_style,
+    input_style=input_style,
+    additional_info_style=additional_info_style,
+    optional_label=optional_label,
+    additional_shm_size_info=additional_shm_size_info,
+    gpu_input_listener=gpu_input_listener,
+    description_gpus=description_gpus,
+)
+
+@functools.lru_cache(maxsize=OPTIONS_FORM_CACHE_SIZE)
+def render_options_form(workspace_images: tuple, additional_cpu_info: str = "", additional_memory_info: str = "") -> str:
+    """Render the common options form. Cached per image list and additional infos, so all arguments must be hashable."""
+
+    image_options = "".join(IMAGE_OPTION_TEMPLATE.format(image=image) for image in workspace_images)
+    return OPTIONS_FORM_TEMPLATE.format(
+        images_template=IMAGES_TEMPLATE.format(image_options=image_options),
+        additional_cpu_info=additional_cpu_info,
+        additional_memory_info=additional_memory_info,
+    )
+
+@functools.lru_cache(maxsize=OPTIONS_FORM_CACHE_SIZE)
+def render_options_form_docker(workspace_images: tuple, resource_snapshot: tuple, default_shm_size: str) -> str:
+    """Render the options form of the Docker spawner. Cached per image list, resource snapshot, and default shm size.
+
+    Args:
+        workspace_images (tuple): the selectable images
+        resource_snapshot (tuple): cpu_count, free_cpu_count, memory_count_in_gb, free_memory_in_gb, gpu_count, free_gpu_count
+        default_shm_size (str): the configured shm size
+    """
+
+    cpu_count, free_cpu_count, memory_count_in_gb, free_memory_in_gb, gpu_count, free_gpu_count = resource_snapshot
+    options_form = render_options_form(
+        workspace_images,
+        additional_cpu_info="Host has {cpu_count} CPUs ({free_cpu_count} not claimed by running workspaces)".format(
+            cpu_count=cpu_count, free_cpu_count=free_cpu_count),
+        additional_memory_info="Host has {memory_count_in_gb}GB memory ({free_memory_in_gb}GB not claimed by running workspaces)".format(
+            memory_count_in_gb=memory_count_in_gb, free_memory_in_gb=free_memory_in_gb)
+    )
+
+    options_form_docker = OPTIONS_FORM_DOCKER_TEMPLATE.format(
+        default_shm_size=default_shm_size,
+        gpu_disabled="disabled" if gpu_count < 1 else "",
+        additional_gpu_info="<div>Host has {gpu_count} GPUs ({free_gpu_count} not claimed by running workspaces)</div><div>{description_gpus}</div>".format(
+            gpu_count=gpu_count, free_gpu_count=free_gpu_count, description_gpus=description_gpus)
     )
 
     return options_form + options_form_docker
 
+def get_options_form(spawner, additional_cpu_info="", additional_memory_info="", additional_gpu_info="") -> str:
+    """Return the spawner options screen"""
+
+    # Only show spawner options for named servers (the default server should start with default values)
+    if getattr(spawner, "name", "") == "":
+        return ''
+
+    return render_options_form(tuple(spawner.workspace_images), additional_cpu_info, additional_memory_info)
+
+def get_options_form_docker(spawner):
+    resource_information = spawner.resource_information
+    resource_snapshot = tuple(resource_information.get(key, 0) for key in
+        ("cpu_count", "free_cpu_count", "memory_count_in_gb", "free_memory_in_gb", "gpu_count", "free_gpu_count"))
+    default_shm_size = spawner.extra_host_config["shm_size"] if "shm_size" in spawner.extra_host_config else "0m"
+
+    return render_options_form_docker(tuple(spawner.workspace_images), resource_snapshot, str(default_shm_size))
+
+def validate_option(name: str, value):
+    """Validate a form value against OPTIONS_SCHEMA.
+
+    Returns:
+        str: the stripped value or None if the value is empty
+
+    Raises:
+        ValueError: if the value does not match the schema. JupyterHub shows the message above the options form.
+    """
+
+    if value is None or value.strip() == "":
+        return None
+
+    value = value.strip()
+    pattern, message = OPTIONS_SCHEMA[name]
+    if not pattern.match(value) or (name in POSITIVE_OPTIONS and float(value) <= 0):
+        raise ValueError(message)
+    return value
+
 def options_from_form(spawner, formdata):
     """Extract the passed form data into the self.user_options variable."""
     options = {}
 
     if formdata.get('is_custom_image', ["off"])[0] == "on":
-        options["image"] = formdata.get('custom_image', [None])[0]
+        options["image"] = validate_option(utils.OPTION_IMAGE, formdata.get('custom_image', [None])[0])
     else:
-        options["image"] = formdata.get('defined_image', [None])[0]
+        options["image"] = validate_option(utils.OPTION_IMAGE, formdata.get('defined_image', [None])[0])
 
-    options["cpu_limit"] = formdata.get('cpu_limit', [None])[0]
-    options["mem_limit"] = formdata.get('mem_limit', [None])[0]
+    options["cpu_limit"] = validate_option(utils.OPTION_CPU_LIMIT, formdata.get('cpu_limit', [None])[0])
+    options["mem_limit"] = validate_option(utils.OPTION_MEM_LIMIT, formdata.get('mem_limit', [None])[0])
     options["is_mount_volume"] = formdata.get('is_mount_volume', ["off"])[0]
-    options["days_to_live"] = formdata.get('days_to_live', [None])[0]
+    options["days_to_live"] = validate_option(utils.OPTION_DAYS_TO_LIVE, formdata.get('days_to_live', [None])[0])
 
     env = {}
     env_lines = formdata.get('env', [''])
 
     for line in env_lines[0].splitlines():
-        if line:
-            key, value = line.split('=', 1)
-            env[key.strip()] = value.strip()
+        if line.strip():
+            match = ENV_LINE_PATTERN.match(line)
+            if not match:
+                raise ValueError("Environment variables must be given as one name=value pair per line, not '{}'.".format(line.strip()))
+            env[match.group(1)] = match.group(2).strip()
     options['env'] = env
 
-    options['shm_size'] = formdata.get('shm_size', [None])[0]
-    options['gpus'] = formdata.get('gpus', [None])[0]
+    options['shm_size'] = validate_option('shm_size', formdata.get('shm_size', [None])[0])
+    options['gpus'] = validate_option('gpus', formdata.get('gpus', [None])[0])
 
     return options
@@ -6,9 +6,12 @@ import os
 
 import math
 import time
+import inspect
+import threading
 
 import docker
 from docker.utils import kwargs_from_env
+import requests.adapters
 
 import json
 
@@ -23,6 +26,16 @@ ENV_NAME_EXECUTION_MODE = "EXECUTION_MODE"
 EXECUTION_MODE_LOCAL = "local"
 EXECUTION_MODE_KUBERNETES = "k8s"
 ENV_NAME_CLEANUP_INTERVAL_SECONDS = "CLEANUP_INTERVAL_SECONDS"
+ENV_NAME_DOCKER_CLIENT_POOL_SIZE = "DOCKER_CLIENT_POOL_SIZE"
+ENV_NAME_KUBERNETES_CLIENT_POOL_SIZE = "KUBERNETES_CLIENT_POOL_SIZE"
+ENV_NAME_CLEANUP_MAX_WORKERS = "CLEANUP_MAX_WORKERS"
+ENV_NAME_PREPULL_MAX_WORKERS = "PREPULL_MAX_WORKERS"
+ENV_NAME_DYNAMIC_WHITELIST_ENABLED = "DYNAMIC_WHITELIST_ENABLED"
+ENV_NAME_KUBERNETES_ROUTING_MODE = "KUBERNETES_ROUTING_MODE"
+# Each workspace pod gets its own ClusterIP Service named like the pod
+KUBERNETES_ROUTING_MODE_SERVICE = "service"
+# All workspace pods share one headless Service and are resolved via their pod hostname and subdomain
+KUBERNETES_ROUTING_MODE_HEADLESS = "headless"
 
 ENV_HUB_NAME = os.getenv("HUB_NAME", "mlhub")
 
@@ -36,14 +49,37 @@ OPTION_SHM_SIZE = "shm_size"
 OPTION_SSH_JUMPHOST_TARGET = "SSH_JUMPHOST_TARGET"
 OPTION_MAX_NUM_THREADS = "MAX_NUM_THREADS"
 
+# Maximum number of keep-alive connections each shared docker client holds to the daemon
+DOCKER_CLIENT_POOL_SIZE = int(os.getenv(ENV_NAME_DOCKER_CLIENT_POOL_SIZE, 25))
+
+# Maximum number of keep-alive connections the shared kubernetes client holds to the API server
+KUBERNETES_CLIENT_POOL_SIZE = int(os.getenv(ENV_NAME_KUBERNETES_CLIENT_POOL_SIZE, 25))
+
+KUBERNETES_ROUTING_MODE = os.getenv(ENV_NAME_KUBERNETES_ROUTING_MODE, KUBERNETES_ROUTING_MODE_SERVICE).lower()
+
+# Process-wide docker clients, keyed by their configuration (see get_docker_client)
+_docker_clients = {}
+_docker_clients_lock = threading.Lock()
+
+# Process-wide kubernetes client (see get_kubernetes_client)
+_kubernetes_client = None
+_kubernetes_client_lock = threading.Lock()
 
 def get_lifetime_timestamp(labels: dict) -> float:
     return float(labels.get(LABEL_EXPIRATION_TIMESTAMP, '0'))
 
-def init_docker_client(client_kwargs: dict, tls_config: dict) -> docker.DockerClient:
+def get_num_threads(cpu_limit: str) -> str:
+    """Return the value of MAX_NUM_THREADS for a cpu_limit option, which can be a fraction of a CPU such as 0.5. Workspaces use at least one thread."""
+
+    return str(max(1, math.floor(float(cpu_limit))))
+
+def init_docker_client(client_kwargs: dict, tls_config: dict, max_pool_size: int = None) -> docker.DockerClient:
     """Create a docker client. 
     The configuration is done the same way DockerSpawner initializes the low-level API client.
 
+    Args:
+        max_pool_size (int): maximum number of connections kept open to the daemon. Only applied if the installed docker library supports it.
+
     Returns:
         docker.DockerClient
     """
@@ -51,12 +87,97 @@ def init_docker_client(client_kwargs: dict, tls_config: dict) -> docker.DockerCl
     kwargs = {"version": "auto"}
     if tls_config:
         kwargs["tls"] = docker.tls.TLSConfig(**tls_config)
+    if max_pool_size and "max_pool_size" in inspect.signature(docker.APIClient.__init__).parameters:
+        kwargs["max_pool_size"] = max_pool_size
     kwargs.update(kwargs_from_env())
     if client_kwargs:
         kwargs.update(client_kwargs)
         
     return docker.DockerClient(**kwargs)
 
+def get_docker_client(client_kwargs: dict, tls_config: dict) -> docker.DockerClient:
+    """Return the shared docker client for the given configuration and create it on first use.
+    All callers with the same configuration reuse one client, so its keep-alive connection pool is shared
+    and the API version is negotiated only once (`version: auto` costs a `/version` round trip per client) and then stays pinned.
+    The underlying requests session is safe to be used from multiple threads.
+
+    Returns:
+        docker.DockerClient
+    """
+
+    key = json.dumps([client_kwargs or {}, tls_config or {}], sort_keys=True, default=str)
+    with _docker_clients_lock:
+        docker_client = _docker_clients.get(key)
+        if docker_client is None:
+            docker_client = init_docker_client(client_kwargs, tls_config, max_pool_size=DOCKER_CLIENT_POOL_SIZE)
+            if docker_client.api.base_url.startswith("http://"):
+                # For plain TCP connections, docker-py uses the default requests adapter which only keeps 10 connections
+                docker_client.api.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=DOCKER_CLIENT_POOL_SIZE))
+            _docker_clients[key] = docker_client
+
+    return docker_client
+
+def init_kubernetes_client(max_pool_size: int):
+    """Create a kubernetes CoreV1Api client with its own connection pool.
+    The configuration is loaded the same way KubeSpawner's reflectors do: the incluster config of the service account or, outside of a cluster, the kubeconfig.
+
+    Args:
+        max_pool_size (int): maximum number of keep-alive connections kept open to the API server
+
+    Returns:
+        kubernetes.client.CoreV1Api
+    """
+
+    # only imported in Kubernetes mode
+    from kubernetes import client, config
+
+    try:
+        config.load_incluster_config()
+    except config.ConfigException:
+        config.load_kube_config()
+
+    # a copy of the configuration loaded above
+    configuration = client.Configuration()
+    configuration.connection_pool_maxsize = max_pool_size
+    return client.CoreV1Api(client.ApiClient(configuration))
+
+def get_kubernetes_client():
+    """Return the process-wide kubernetes client and create it on first use.
+    Its urllib3 pool keeps up to KUBERNETES_CLIENT_POOL_SIZE connections alive, so callers that run at most that many calls in parallel
+    (e.g. in an executor of the same size) always reuse an open connection instead of opening and discarding one per call.
+    The client is safe to be used from multiple threads.
+
+    Returns:
+        kubernetes.client.CoreV1Api
+    """
+
+    global _kubernetes_client
+    with _kubernetes_client_lock:
+        if _kubernetes_client is None:
+            _kubernetes_client = init_kubernetes_client(KUBERNETES_CLIENT_POOL_SIZE)
+
+    return _kubernetes_client
+
+def replace_forbidden_username_chars(username: str) -> str:
+    """Remove characters from a username that break the routing of the nginx proxy, e.g. "lastname, firstname" -> "lastname0firstname".
+    Used by the hub's `normalize_username` for every login, independent from the used authenticator.
+    """
+
+    more_than_one_forbidden_char = False
+    for forbidden_username_char in [" ", ",", ";", ".", "-", "@", "_"]:
+        # Replace special characters with a non-special character. Cannot just be empty, like "", because then it could happen that two distinct user names are transformed into the same username.
+        # Example: "foo, bar" and "fo, obar" would both become "foobar".
+        replace_char = "0"
+        # If there is more than one special character, just replace one of them. Otherwise, "foo, bar" would become "foo00bar" instead of "foo0bar"
+        if more_than_one_forbidden_char == True:
+            replace_char = ""
+        temp_username = username
+        username = username.replace(forbidden_username_char, replace_char, 1)
+        if username != temp_username:
+            more_than_one_forbidden_char = True
+
+    return username
+
 def get_state(spawner, state) -> dict:
     if hasattr(spawner, "saved_user_options"):
         state["saved_user_options"] = spawner.saved_user_options
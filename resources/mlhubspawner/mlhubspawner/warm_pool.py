@@ -0,0 +1,254 @@
+"""
+Optional hub-wide pool of pre-created workspace containers (Docker-local mode).
+For every configured profile (image and resource options), the pool keeps a number of created but unassigned containers.
+On spawn, a matching container is claimed: it is renamed to the workspace's name, moved into the user's network, and
+gets the workspace's environment variables written into an env file that its entrypoint sources on start.
+By this, the image pull and container creation are not part of the spawn anymore. A background thread refills the pool.
+
+Docker does not allow to change the labels, environment variables, or mounts of an existing container. Hence, pooled
+containers only carry the `mlhub.origin` and `mlhub.pool` labels, and workspaces that need own mounts or labels
+(e.g. a volume or an expiration date) are always created from scratch. The user of a claimed container is given by the user
+network it was moved into, which the cleanup service uses to remove it together with the user's other resources.
+"""
+
+import hashlib
+import io
+import json
+import shlex
+import tarfile
+import threading
+import time
+import uuid
+import collections
+
+import docker.errors
+from traitlets.log import get_logger
+
+from mlhubspawner import utils, image_puller
+
+LABEL_MLHUB_POOL = "mlhub.pool"
+
+# The env file is written to the root of the container's filesystem on claim and sourced by the entrypoint on every start
+CLAIM_ENV_FILE_NAME = "mlhub-claim.env"
+CLAIM_ENTRYPOINT = [
+    "/bin/sh", "-c",
+    'if [ -f /{file} ]; then set -a; . /{file}; set +a; fi; exec "$@"'.format(file=CLAIM_ENV_FILE_NAME),
+    "mlhub-claim"
+]
+
+REFILL_INTERVAL_SECONDS = 30
+
+_warm_pool = None
+_warm_pool_lock = threading.Lock()
+
+def get_profile_key(profile: dict) -> str:
+    """Stable key of a pool profile. Changes whenever the image, the command, or the host config of the profile changes,
+    so that containers created for an outdated configuration are not claimed anymore.
+    """
+
+    relevant_fields = {key: value for key, value in profile.items() if key != "size"}
+    return hashlib.sha1(json.dumps(relevant_fields, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+def create_env_archive(env: dict) -> bytes:
+    """Create a tar archive containing the env file with the given environment variables, e.g. "JUPYTERHUB_API_TOKEN='...'"."""
+
+    content = "".join("{}={}\n".format(key, shlex.quote(str(value))) for key, value in env.items() if value is not None).encode("utf-8")
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        info = tarfile.TarInfo(CLAIM_ENV_FILE_NAME)
+        info.size = len(content)
+        info.mode = 0o600
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(content))
+    return archive.getvalue()
+
+def write_claim_env(docker_client, container_id: str, env: dict) -> None:
+    """Write the workspace's environment variables into a pooled container. Must be called before each start of the container,
+    as JupyterHub hands out a new API token for every spawn.
+    """
+
+    docker_client.api.put_archive(container_id, "/", create_env_archive(env))
+
+class WarmPool():
+    """Pre-created workspace containers per profile. A profile is a dict with the `image`, the `command` and its `args`,
+    the `host_config`, and the pool `size`. Claiming is thread-safe; the pool is refilled in a background thread.
+    """
+
+    def __init__(self, docker_client, hub_name: str, refill_interval: int = REFILL_INTERVAL_SECONDS):
+        self.client = docker_client
+        self.hub_name = hub_name
+        self.refill_interval = refill_interval
+        self.log = get_logger()
+
+        self._lock = threading.Lock()
+        self._profiles = {}
+        self._available = collections.defaultdict(collections.deque)
+        self._refill_requested = threading.Event()
+        self._is_started = False
+
+    def set_profiles(self, profiles: list) -> list:
+        """Set the pool profiles and start filling the pool. Pooled containers of profiles that are not set anymore are removed.
+
+        Returns:
+            list: the keys of the profiles in the given order
+        """
+
+        keys = [get_profile_key(profile) for profile in profiles]
+        with self._lock:
+            self._profiles = {key: profile for key, profile in zip(keys, profiles)}
+            is_started = self._is_started
+            self._is_started = True
+
+        if is_started:
+            self._refill_requested.set()
+        else:
+            threading.Thread(target=self._refill_periodically, name="mlhub-warm-pool", daemon=True).start()
+        return keys
+
+    def has_profile(self, key: str) -> bool:
+        with self._lock:
+            return key in self._profiles
+
+    def get_available_count(self, key: str) -> int:
+        with self._lock:
+            return len(self._available[key])
+
+    def claim(self, key: str, name: str, network_name: str, env: dict) -> str:
+        """Claim a pooled container of the given profile for a workspace.
+
+        Args:
+            key (str): profile key (see get_profile_key)
+            name (str): the workspace's container name
+            network_name (str): the (existing) network of the workspace
+            env (dict): the workspace's environment variables
+
+        Returns:
+            str: id of the claimed container or None if no container is available
+        """
+
+        while True:
+            with self._lock:
+                if not self._available[key]:
+                    self._refill_requested.set()
+                    return None
+                container_id = self._available[key].popleft()
+            self._refill_requested.set()
+
+            try:
+                self.client.api.rename(container_id, name)
+                try:
+                    self.client.api.disconnect_container_from_network(container_id, "bridge")
+                except docker.errors.APIError:
+                    pass
+                self.client.api.connect_container_to_network(container_id, network_name)
+                write_claim_env(self.client, container_id, env)
+                return container_id
+            except docker.errors.APIError as e:
+                # e.g. the container was removed in the meantime; do not leave a half-claimed container behind
+                self.log.warn("Could not claim pooled container {}: {}".format(container_id, str(e)))
+                self._remove_container(container_id)
+
+    def load(self) -> None:
+        """Take over the unclaimed containers that were pooled before, e.g. before the hub was restarted.
+        Unclaimed containers of profiles that do not exist anymore are removed.
+        """
+
+        pooled_containers = self.client.api.containers(all=True, filters={"label": [
+            "{}={}".format(utils.LABEL_MLHUB_ORIGIN, self.hub_name), LABEL_MLHUB_POOL]})
+
+        with self._lock:
+            profiles = dict(self._profiles)
+        available = collections.defaultdict(collections.deque)
+        for container in pooled_containers:
+            names = container.get("Names") or []
+            if not any(name.lstrip("/").startswith(self.get_name_prefix()) for name in names):
+                # already claimed by a workspace
+                continue
+
+            key = (container.get("Labels") or {}).get(LABEL_MLHUB_POOL)
+            if key in profiles and container.get("State") == "created":
+                available[key].append(container["Id"])
+            else:
+                self._remove_container(container["Id"])
+
+        with self._lock:
+            self._available = available
+
+    def refill(self) -> None:
+        """Remove the pooled containers of outdated profiles and create the missing containers of each profile."""
+
+        with self._lock:
+            profiles = dict(self._profiles)
+            outdated_keys = [key for key in self._available if key not in profiles]
+            outdated_container_ids = [container_id for key in outdated_keys for container_id in self._available.pop(key)]
+
+        for container_id in outdated_container_ids:
+            self._remove_container(container_id)
+
+        for key, profile in profiles.items():
+            for _ in range(max(0, int(profile.get("size", 0)) - self.get_available_count(key))):
+                container_id = self._create_container(key, profile)
+                with self._lock:
+                    self._available[key].append(container_id)
+
+    def get_name_prefix(self) -> str:
+        return "{}-pool-".format(self.hub_name)
+
+    def _remove_container(self, container_id: str) -> None:
+        self.log.info("Remove pooled container {}".format(container_id[:12]))
+        try:
+            self.client.api.remove_container(container_id, force=True)
+        except docker.errors.APIError:
+            pass
+
+    def _create_container(self, key: str, profile: dict) -> str:
+        image = profile["image"]
+        try:
+            image_info = self.client.api.inspect_image(image)
+        except docker.errors.ImageNotFound:
+            image_puller.get_image_pull_coordinator(self.client).pull(image).result()
+            image_info = self.client.api.inspect_image(image)
+
+        image_entrypoint = image_info["Config"].get("Entrypoint") or []
+        if isinstance(image_entrypoint, str):
+            image_entrypoint = ["/bin/sh", "-c", image_entrypoint]
+
+        container = self.client.api.create_container(
+            image=image,
+            name=self.get_name_prefix() + uuid.uuid4().hex[:12],
+            entrypoint=CLAIM_ENTRYPOINT + image_entrypoint,
+            # same as DockerSpawner: the configured or the image's command followed by the spawner's arguments
+            command=(profile.get("command") or image_info["Config"].get("Cmd") or []) + (profile.get("args") or []),
+            labels={utils.LABEL_MLHUB_ORIGIN: self.hub_name, LABEL_MLHUB_POOL: key},
+            host_config=self.client.api.create_host_config(**(profile.get("host_config") or {}))
+        )
+        self.log.info("Created pooled container {} for image {}".format(container["Id"][:12], image))
+        return container["Id"]
+
+    def _refill_periodically(self) -> None:
+        try:
+            self.load()
+        except Exception as e:
+            self.log.warn("Could not load the pooled containers: {}".format(str(e)))
+
+        while True:
+            self._refill_requested.clear()
+            try:
+                self.refill()
+            except Exception as e:
+                self.log.warn("Could not refill the warm pool: {}".format(str(e)))
+            self._refill_requested.wait(self.refill_interval)
+
+def get_warm_pool(docker_client, hub_name: str) -> WarmPool:
+    """Return the hub-wide warm pool. It is filled once profiles are set (see WarmPool.set_profiles).
+
+    Returns:
+        WarmPool
+    """
+
+    global _warm_pool
+    with _warm_pool_lock:
+        if _warm_pool is None:
+            _warm_pool = WarmPool(docker_client, hub_name)
+
+    return _warm_pool
@@ -0,0 +1,103 @@
+"""
+Benchmark of the functions that run for every login and spawn-page request: the username normalization, the dynamic
+whitelist check, the rendering of the options form, and the parsing of the submitted form.
+
+Usage (from the repository root, with the mlhubspawner dependencies installed):
+    python test/benchmarks/auth_hot_path.py                  # compare against baselines/auth_hot_path.json
+    python test/benchmarks/auth_hot_path.py --save-baseline  # store the results as new baseline
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "resources", "mlhubspawner"))
+
+from mlhubspawner import utils, dynamic_whitelist, spawner_options
+
+import benchmark
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "baselines", "auth_hot_path.json")
+
+WHITELIST_SIZE = 50000
+
+USERNAMES = [
+    "alice",
+    "Lastname, Firstname",
+    "first.last@example.com",
+    "Jürgen Müller-Lüdenscheidt",
+    "李小龙",
+    "Ωμέγα_user; admin",
+    "a" * 64 + "@" + "b" * 64 + ".example.org",
+]
+
+class BenchmarkSpawner():
+    name = "benchmark"
+    workspace_images = ["mltooling/ml-workspace:{}".format(version) for version in ("0.8.7", "0.9.1", "0.10.0", "latest")] + \
+        ["mltooling/ml-workspace-gpu:0.9.1", "mltooling/ml-workspace-r:0.9.1", "mltooling/ml-workspace-spark:0.9.1"]
+    extra_host_config = {"shm_size": "256m"}
+    resource_information = {"cpu_count": 64, "free_cpu_count": 12.5, "memory_count_in_gb": 503.8, "free_memory_in_gb": 97.3, "gpu_count": 8, "free_gpu_count": 2}
+
+def create_whitelist_file(directory: str) -> str:
+    path = os.path.join(directory, "dynamic_whitelist.txt")
+    with open(path, "w") as f:
+        for i in range(WHITELIST_SIZE):
+            f.write("user{}\n".format(i))
+        for username in USERNAMES:
+            f.write(utils.replace_forbidden_username_chars(username.lower()) + "\n")
+    return path
+
+def create_formdata(env_lines: int) -> dict:
+    return {
+        "defined_image": ["mltooling/ml-workspace:0.9.1"],
+        "cpu_limit": ["8"],
+        "mem_limit": ["16"],
+        "days_to_live": ["3"],
+        "is_mount_volume": ["on"],
+        "shm_size": ["2g"],
+        "gpus": ["0,2"],
+        "env": ["\n".join("VARIABLE_{}=value with spaces and = signs {}".format(i, i) for i in range(env_lines))]
+    }
+
+def main():
+    parser = benchmark.get_argument_parser(__doc__.strip().splitlines()[0], BASELINE_FILE)
+    args = parser.parse_args()
+
+    def calls(count: int) -> int:
+        return max(1, int(count * args.scale))
+
+    spawner = BenchmarkSpawner()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        whitelist_file = create_whitelist_file(directory)
+        whitelist = dynamic_whitelist.DynamicWhitelist(whitelist_file)
+        normalized_usernames = [utils.replace_forbidden_username_chars(username.lower()) for username in USERNAMES]
+        unknown_usernames = ["unknown{}".format(i) for i in range(100)]
+
+        results["normalize_username"] = benchmark.measure(
+            lambda username: utils.replace_forbidden_username_chars(username.lower()), USERNAMES, calls(200000))
+        # the same check as dynamic_check_whitelist in jupyterhub_config.py
+        def check_whitelist(username: str) -> bool:
+            return dynamic_whitelist.normalize_whitelist_entry(username) in whitelist.get_usernames()
+
+        results["whitelist_check_hit"] = benchmark.measure(check_whitelist, normalized_usernames, calls(100000))
+        results["whitelist_check_miss"] = benchmark.measure(check_whitelist, unknown_usernames, calls(100000))
+        results["whitelist_load_50k"] = benchmark.measure(
+            lambda path: dynamic_whitelist.DynamicWhitelist(path).get_usernames(), [whitelist_file], calls(50), warmup=1)
+
+    results["options_form_render_cached"] = benchmark.measure(spawner_options.get_options_form_docker, [spawner], calls(100000))
+    resource_snapshot = (64, 12.5, 503.8, 97.3, 8, 2)
+    results["options_form_render_uncached"] = benchmark.measure(
+        lambda images: spawner_options.render_options_form_docker.__wrapped__(images, resource_snapshot, "256m"),
+        [tuple(spawner.workspace_images)], calls(20000))
+
+    formdata = create_formdata(env_lines=5)
+    results["options_from_form"] = benchmark.measure(lambda data: spawner_options.options_from_form(spawner, data), [formdata], calls(50000))
+    large_formdata = create_formdata(env_lines=1000)
+    results["options_from_form_large_env"] = benchmark.measure(
+        lambda data: spawner_options.options_from_form(spawner, data), [large_formdata], calls(1000))
+
+    benchmark.finish(args, results)
+
+if __name__ == "__main__":
+    main()
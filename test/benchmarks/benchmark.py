@@ -0,0 +1,131 @@
+"""
+Minimal benchmark runner for the MLHub benchmarks (standard library only, so that it runs offline in CI).
+Each case is measured for a fixed number of calls; the throughput and the latency percentiles are compared against a
+stored baseline and a case counts as regressed if it is slower than the baseline by more than the tolerance.
+The baselines are absolute timings of the machine they were recorded on, so record your own baseline before changing the code.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+DEFAULT_TOLERANCE = 0.3
+
+# Key of the baseline entry that describes the machine the baseline was recorded on
+MACHINE_KEY = "_machine"
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def measure(func, inputs: list, iterations: int, warmup: int = 10, rounds: int = 5) -> dict:
+    """Call `func` with the given inputs in turn and measure each call. The calls are split into rounds and the throughput
+    of the fastest round is reported (same as `timeit` recommends), which makes the result robust against noisy neighbours.
+
+    Returns:
+        dict: `calls`, `ops_per_second`, and the `p50_us`, `p99_us`, and `max_us` latencies in microseconds over all calls
+    """
+
+    for i in range(warmup):
+        func(inputs[i % len(inputs)])
+
+    rounds = max(1, min(rounds, iterations))
+    calls_per_round = max(1, iterations // rounds)
+    latencies = []
+    best_ops_per_second = 0.0
+    for _ in range(rounds):
+        round_start = time.perf_counter()
+        for i in range(calls_per_round):
+            call_start = time.perf_counter()
+            func(inputs[i % len(inputs)])
+            latencies.append(time.perf_counter() - call_start)
+        round_seconds = time.perf_counter() - round_start
+        if round_seconds > 0:
+            best_ops_per_second = max(best_ops_per_second, calls_per_round / round_seconds)
+
+    latencies.sort()
+    return {
+        "calls": len(latencies),
+        "ops_per_second": round(best_ops_per_second, 1),
+        "p50_us": round(percentile(latencies, 0.50) * 1e6, 2),
+        "p99_us": round(percentile(latencies, 0.99) * 1e6, 2),
+        "max_us": round(latencies[-1] * 1e6, 2)
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float = DEFAULT_TOLERANCE) -> list:
+    """Compare the results with the baseline. The tail latency is noisier than the throughput, so it may deviate by twice the tolerance.
+
+    Returns:
+        list: a description of every regressed case
+    """
+
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        if result["ops_per_second"] < expected["ops_per_second"] * (1 - tolerance):
+            regressions.append("{}: {} ops/s (baseline {} ops/s)".format(name, result["ops_per_second"], expected["ops_per_second"]))
+        elif result["p99_us"] > expected["p99_us"] * (1 + 2 * tolerance):
+            regressions.append("{}: p99 {}us (baseline {}us)".format(name, result["p99_us"], expected["p99_us"]))
+    return regressions
+
+def get_machine() -> dict:
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version()
+    }
+
+def print_results(results: dict) -> None:
+    print("{:<45} {:>12} {:>12} {:>12}".format("case", "ops/s", "p50 (us)", "p99 (us)"))
+    for name, result in results.items():
+        print("{:<45} {:>12} {:>12} {:>12}".format(name, result["ops_per_second"], result["p50_us"], result["p99_us"]))
+
+def get_argument_parser(description: str, default_baseline: str) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--baseline", help="baseline file to compare against", default=default_baseline)
+    parser.add_argument("--save-baseline", help="store the results as new baseline", action="store_true")
+    parser.add_argument("--tolerance", help="allowed slowdown compared to the baseline, e.g. 0.3 for 30%%", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--scale", help="multiplier for the number of calls per case, e.g. 0.1 for a quick run", type=float, default=1.0)
+    return parser
+
+def finish(args, results: dict) -> None:
+    """Print, store, and compare the results. Exits with 1 if a case regressed compared to the baseline."""
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({**results, MACHINE_KEY: get_machine()}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Stored baseline in {}".format(args.baseline))
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found at {}, skip the comparison".format(args.baseline))
+        return
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    if baseline.get(MACHINE_KEY) != get_machine():
+        print("The baseline was recorded on another machine ({}), so the comparison is only meaningful after recording a baseline "
+            "of this machine with --save-baseline".format(baseline.get(MACHINE_KEY, "unknown")))
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("Regressions compared to {}:".format(args.baseline))
+        for regression in regressions:
+            print("  " + regression)
+        sys.exit(1)
+    print("No regressions compared to {}".format(args.baseline))
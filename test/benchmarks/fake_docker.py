@@ -0,0 +1,473 @@
+"""
+In-memory stand-in for the Docker Engine API, used by the spawn benchmarks. It implements the endpoints the MLHub spawner
+and DockerSpawner use to spawn, stop, and remove workspaces (containers, images, networks, volumes) on top of a threaded
+HTTP server from the standard library. Every endpoint can be given an artificial latency and a failure rate, and all calls
+are counted per endpoint.
+
+Example:
+    daemon = FakeDockerDaemon(latency={"containers.create": 0.05}, failure_rates={"containers.start": 0.01})
+    daemon.start()
+    os.environ["DOCKER_HOST"] = daemon.base_url
+"""
+
+import collections
+import ipaddress
+import json
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+API_VERSION = "1.41"
+
+# (method, path pattern, endpoint name); the API version prefix (e.g. /v1.41) is removed from the path before matching
+ROUTES = [
+    ("GET", r"/_ping", "ping"),
+    ("HEAD", r"/_ping", "ping"),
+    ("GET", r"/version", "version"),
+    ("GET", r"/events", "events"),
+    ("GET", r"/containers/json", "containers.list"),
+    ("POST", r"/containers/create", "containers.create"),
+    ("GET", r"/containers/(?P<id>[^/]+)/json", "containers.inspect"),
+    ("POST", r"/containers/(?P<id>[^/]+)/start", "containers.start"),
+    ("POST", r"/containers/(?P<id>[^/]+)/stop", "containers.stop"),
+    ("POST", r"/containers/(?P<id>[^/]+)/rename", "containers.rename"),
+    ("PUT", r"/containers/(?P<id>[^/]+)/archive", "containers.archive"),
+    ("DELETE", r"/containers/(?P<id>[^/]+)", "containers.remove"),
+    ("POST", r"/images/create", "images.pull"),
+    ("GET", r"/images/(?P<name>.+)/json", "images.inspect"),
+    ("GET", r"/networks", "networks.list"),
+    ("POST", r"/networks/create", "networks.create"),
+    ("POST", r"/networks/(?P<id>[^/]+)/connect", "networks.connect"),
+    ("POST", r"/networks/(?P<id>[^/]+)/disconnect", "networks.disconnect"),
+    ("GET", r"/networks/(?P<id>[^/]+)", "networks.inspect"),
+    ("DELETE", r"/networks/(?P<id>[^/]+)", "networks.remove"),
+    ("POST", r"/volumes/create", "volumes.create"),
+]
+COMPILED_ROUTES = [(method, re.compile("^" + pattern + "$"), name) for method, pattern, name in ROUTES]
+VERSION_PREFIX = re.compile(r"^/v[0-9.]+")
+
+class DockerAPIError(Exception):
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+def matches_label_filters(labels: dict, label_filters: list) -> bool:
+    """Docker label filters are either `key` or `key=value`, and all of them have to match."""
+
+    for label_filter in label_filters:
+        key, _, value = label_filter.partition("=")
+        if key not in labels or ("=" in label_filter and labels[key] != value):
+            return False
+    return True
+
+class FakeDockerState():
+    """Containers, images, networks, and volumes of the fake daemon. All methods are called under the state lock."""
+
+    def __init__(self, images: list):
+        self.containers = {}
+        self.networks = {}
+        self.volumes = {}
+        self.images = {}
+        for image in images:
+            self.add_image(image)
+        self.add_network("bridge", "172.17.0.0/16", {})
+
+    def add_image(self, image: str) -> dict:
+        if ":" not in image.split("/")[-1]:
+            image += ":latest"
+        info = {
+            "Id": "sha256:" + uuid.uuid5(uuid.NAMESPACE_URL, image).hex * 2,
+            "RepoTags": [image],
+            "Config": {"Cmd": ["start.sh"], "Entrypoint": None, "Env": []}
+        }
+        self.images[image] = info
+        return info
+
+    def find_image(self, name: str) -> dict:
+        if name in self.images:
+            return self.images[name]
+        if name + ":latest" in self.images:
+            return self.images[name + ":latest"]
+        for info in self.images.values():
+            if info["Id"] == name:
+                return info
+        raise DockerAPIError(404, "No such image: {}".format(name))
+
+    def add_network(self, name: str, subnet: str, labels: dict) -> dict:
+        network_id = uuid.uuid4().hex * 2
+        network = {
+            "Id": network_id,
+            "Name": name,
+            "Driver": "bridge",
+            "Labels": labels or {},
+            "IPAM": {"Driver": "default", "Config": [{"Subnet": subnet}] if subnet else []},
+            "Containers": {},
+            "_next_host": 2
+        }
+        self.networks[network_id] = network
+        return network
+
+    def find_network(self, name_or_id: str) -> dict:
+        if name_or_id in self.networks:
+            return self.networks[name_or_id]
+        for network in self.networks.values():
+            if network["Name"] == name_or_id or network["Id"].startswith(name_or_id):
+                return network
+        raise DockerAPIError(404, "network {} not found".format(name_or_id))
+
+    def find_container(self, name_or_id: str) -> dict:
+        name_or_id = name_or_id.lstrip("/")
+        if name_or_id in self.containers:
+            return self.containers[name_or_id]
+        for container in self.containers.values():
+            if container["Name"] == "/" + name_or_id or container["Id"].startswith(name_or_id):
+                return container
+        raise DockerAPIError(404, "No such container: {}".format(name_or_id))
+
+    def attach(self, container: dict, network: dict) -> None:
+        subnet = network["IPAM"]["Config"][0]["Subnet"] if network["IPAM"]["Config"] else "172.17.0.0/16"
+        ip_address = str(ipaddress.ip_network(subnet).network_address + network["_next_host"])
+        network["_next_host"] += 1
+        network["Containers"][container["Id"]] = {"Name": container["Name"].lstrip("/"), "IPv4Address": ip_address}
+        container["NetworkSettings"]["Networks"][network["Name"]] = {"NetworkID": network["Id"], "IPAddress": ip_address}
+
+    def detach(self, container: dict, network: dict) -> None:
+        network["Containers"].pop(container["Id"], None)
+        container["NetworkSettings"]["Networks"].pop(network["Name"], None)
+
+class FakeDockerDaemon():
+    """Fake Docker daemon listening on a local TCP port.
+
+    Args:
+        latency (dict): seconds to delay each endpoint by name, e.g. {"containers.create": 0.05}; `default` applies to all other endpoints
+        failure_rates (dict): probability that a call of the endpoint fails with a 500 error, e.g. {"networks.create": 0.01}
+        images (list): images that are present from the beginning; others are "pulled" on request
+        pull_seconds (float): duration of a pull
+        seed (int): seed of the failure injection, so that runs are reproducible
+    """
+
+    def __init__(self, latency: dict = None, failure_rates: dict = None, images: list = None, pull_seconds: float = 0.5, seed: int = 42):
+        self.latency = dict(latency or {})
+        self.failure_rates = dict(failure_rates or {})
+        self.pull_seconds = pull_seconds
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.state = FakeDockerState(images or [])
+        self.calls = collections.Counter()
+        self.stopped = threading.Event()
+        self.server = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return "tcp://{}:{}".format(host, port)
+
+    def start(self) -> None:
+        daemon = self
+
+        class Handler(FakeDockerRequestHandler):
+            pass
+        Handler.daemon = daemon
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        # the spawners open many keep-alive connections at once
+        self.server.request_queue_size = 1024
+        threading.Thread(target=self.server.serve_forever, name="fake-docker-daemon", daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def get_calls(self) -> dict:
+        with self.lock:
+            return dict(self.calls)
+
+    def reset_calls(self) -> None:
+        with self.lock:
+            self.calls.clear()
+
+    def handle(self, method: str, path: str, query: dict, body: dict):
+        """Dispatch a request to its endpoint.
+
+        Returns:
+            (int, object): status code and JSON body, or a list of JSON lines to stream
+        """
+
+        path = VERSION_PREFIX.sub("", path)
+        for route_method, pattern, name in COMPILED_ROUTES:
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {"message": "page not found: {} {}".format(method, path)}
+
+        with self.lock:
+            self.calls[name] += 1
+            should_fail = self.random.random() < self.failure_rates.get(name, 0)
+
+        delay = self.latency.get(name, self.latency.get("default", 0))
+        if delay:
+            time.sleep(delay)
+        if should_fail:
+            return 500, {"message": "injected failure of {}".format(name)}
+
+        handler = getattr(self, "_" + name.replace(".", "_"))
+        params = {key: unquote(value) for key, value in match.groupdict().items()}
+        try:
+            return handler(query=query, body=body or {}, **params)
+        except DockerAPIError as e:
+            return e.status_code, {"message": e.message}
+
+    def _ping(self, **kwargs):
+        return 200, "OK"
+
+    def _version(self, **kwargs):
+        return 200, {"ApiVersion": API_VERSION, "MinAPIVersion": "1.12", "Version": "20.10.0-fake", "Os": "linux", "Arch": "amd64"}
+
+    def _events(self, **kwargs):
+        # nothing happens on the fake daemon; the stream stays open until the daemon is stopped
+        self.stopped.wait()
+        return 200, []
+
+    def _containers_list(self, query, **kwargs):
+        filters = json.loads(query.get("filters", ["{}"])[0])
+        label_filters = filters.get("label", [])
+        if isinstance(label_filters, dict):
+            label_filters = [key for key, enabled in label_filters.items() if enabled]
+        show_all = query.get("all", ["0"])[0] in ("1", "true", "True")
+        with self.lock:
+            containers = [container for container in self.state.containers.values()
+                if (show_all or container["State"]["Running"]) and matches_label_filters(container["Config"]["Labels"], label_filters)]
+            return 200, [{
+                "Id": container["Id"],
+                "Names": [container["Name"]],
+                "Image": container["Config"]["Image"],
+                "ImageID": container["Image"],
+                "Labels": container["Config"]["Labels"],
+                "State": container["State"]["Status"]
+            } for container in containers]
+
+    def _containers_create(self, query, body, **kwargs):
+        name = query.get("name", [uuid.uuid4().hex[:12]])[0]
+        host_config = body.get("HostConfig") or {}
+        with self.lock:
+            if any(container["Name"] == "/" + name for container in self.state.containers.values()):
+                raise DockerAPIError(409, 'Conflict. The container name "/{}" is already in use'.format(name))
+            image = self.state.find_image(body.get("Image", ""))
+            container_id = uuid.uuid4().hex * 2
+            container = {
+                "Id": container_id,
+                "Name": "/" + name,
+                "Image": image["Id"],
+                "Created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "Config": {"Image": body.get("Image"), "Labels": body.get("Labels") or {}, "Env": body.get("Env") or [], "Cmd": body.get("Cmd")},
+                "HostConfig": host_config,
+                "State": {"Status": "created", "Running": False, "ExitCode": 0, "Error": "", "FinishedAt": "0001-01-01T00:00:00Z"},
+                "NetworkSettings": {"Networks": {}, "IPAddress": "", "Ports": {}}
+            }
+            self.state.containers[container_id] = container
+            network_mode = host_config.get("NetworkMode") or "bridge"
+            if network_mode not in ("host", "none", "default"):
+                self.state.attach(container, self.state.find_network(network_mode))
+        return 201, {"Id": container_id, "Warnings": []}
+
+    def _containers_inspect(self, id, **kwargs):
+        with self.lock:
+            return 200, self.state.find_container(id)
+
+    def _containers_start(self, id, **kwargs):
+        with self.lock:
+            container = self.state.find_container(id)
+            if container["State"]["Running"]:
+                return 304, None
+            container["State"].update({"Status": "running", "Running": True})
+        return 204, None
+
+    def _containers_stop(self, id, **kwargs):
+        with self.lock:
+            container = self.state.find_container(id)
+            if not container["State"]["Running"]:
+                return 304, None
+            container["State"].update({"Status": "exited", "Running": False})
+        return 204, None
+
+    def _containers_rename(self, id, query, **kwargs):
+        with self.lock:
+            container = self.state.find_container(id)
+            container["Name"] = "/" + query["name"][0]
+        return 204, None
+
+    def _containers_archive(self, id, **kwargs):
+        with self.lock:
+            self.state.find_container(id)
+        return 200, None
+
+    def _containers_remove(self, id, query, **kwargs):
+        force = query.get("force", ["0"])[0] in ("1", "true", "True")
+        with self.lock:
+            container = self.state.find_container(id)
+            if container["State"]["Running"] and not force:
+                raise DockerAPIError(409, "You cannot remove a running container {}. Stop the container before attempting removal or force remove".format(id))
+            for network_name in list(container["NetworkSettings"]["Networks"].keys()):
+                self.state.detach(container, self.state.find_network(network_name))
+            del self.state.containers[container["Id"]]
+        return 204, None
+
+    def _images_pull(self, query, **kwargs):
+        image = query.get("fromImage", [""])[0]
+        tag = query.get("tag", ["latest"])[0] or "latest"
+        reference = image if ":" in image.split("/")[-1] else "{}:{}".format(image, tag)
+        layer_size = 100 * 1024 * 1024
+        lines = [{"status": "Pulling from {}".format(image), "id": tag}]
+        for step in range(1, 5):
+            time.sleep(self.pull_seconds / 4)
+            lines.append({"status": "Downloading", "id": "layer", "progressDetail": {"current": layer_size * step // 4, "total": layer_size}})
+        with self.lock:
+            self.state.add_image(reference)
+        lines.append({"status": "Status: Downloaded newer image for {}".format(reference)})
+        return 200, lines
+
+    def _images_inspect(self, name, **kwargs):
+        with self.lock:
+            return 200, self.state.find_image(name)
+
+    def _networks_list(self, query, **kwargs):
+        filters = json.loads(query.get("filters", ["{}"])[0])
+        label_filters = filters.get("label", [])
+        if isinstance(label_filters, dict):
+            label_filters = [key for key, enabled in label_filters.items() if enabled]
+        with self.lock:
+            return 200, [self._get_network_info(network) for network in self.state.networks.values()
+                if matches_label_filters(network["Labels"], label_filters)]
+
+    def _networks_create(self, body, **kwargs):
+        name = body.get("Name")
+        pool_configs = (body.get("IPAM") or {}).get("Config") or []
+        subnet = pool_configs[0].get("Subnet") if pool_configs else None
+        with self.lock:
+            if any(network["Name"] == name for network in self.state.networks.values()):
+                raise DockerAPIError(409, "network with name {} already exists".format(name))
+            if subnet:
+                new_subnet = ipaddress.ip_network(subnet)
+                for network in self.state.networks.values():
+                    for config in network["IPAM"]["Config"]:
+                        if ipaddress.ip_network(config["Subnet"]).overlaps(new_subnet):
+                            raise DockerAPIError(403, "Pool overlaps with other one on this address space")
+            network = self.state.add_network(name, subnet, body.get("Labels"))
+        return 201, {"Id": network["Id"], "Warning": ""}
+
+    def _networks_connect(self, id, body, **kwargs):
+        with self.lock:
+            network = self.state.find_network(id)
+            container_name = body.get("Container", "")
+            try:
+                container = self.state.find_container(container_name)
+            except DockerAPIError:
+                # e.g. the hub container, which does not run on the fake daemon
+                if container_name in network["Containers"]:
+                    raise DockerAPIError(403, "endpoint with name {} already exists in network {}".format(container_name, network["Name"]))
+                network["Containers"][container_name] = {"Name": container_name}
+                return 200, None
+            if container["Id"] in network["Containers"]:
+                raise DockerAPIError(403, "endpoint with name {} already exists in network {}".format(container["Name"].lstrip("/"), network["Name"]))
+            self.state.attach(container, network)
+        return 200, None
+
+    def _networks_disconnect(self, id, body, **kwargs):
+        with self.lock:
+            network = self.state.find_network(id)
+            container = self.state.find_container(body.get("Container", ""))
+            self.state.detach(container, network)
+        return 200, None
+
+    def _networks_inspect(self, id, **kwargs):
+        with self.lock:
+            return 200, self._get_network_info(self.state.find_network(id))
+
+    def _networks_remove(self, id, **kwargs):
+        with self.lock:
+            network = self.state.find_network(id)
+            del self.state.networks[network["Id"]]
+        return 204, None
+
+    def _volumes_create(self, body, **kwargs):
+        name = body.get("Name") or uuid.uuid4().hex
+        with self.lock:
+            volume = self.state.volumes.setdefault(name, {"Name": name, "Driver": "local", "Labels": body.get("Labels") or {}, "Mountpoint": "/var/lib/docker/volumes/" + name})
+        return 201, volume
+
+    def _get_network_info(self, network: dict) -> dict:
+        return {key: value for key, value in network.items() if not key.startswith("_")}
+
+class FakeDockerRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    daemon = None
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately, which would wait for the delayed ACK of the client otherwise
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        url = urlparse(self.path)
+        body = None
+        content_length = int(self.headers.get("Content-Length") or 0)
+        if content_length:
+            raw_body = self.rfile.read(content_length)
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                body = json.loads(raw_body.decode("utf-8"))
+
+        status_code, response = self.daemon.handle(self.command, url.path, parse_qs(url.query), body)
+        if isinstance(response, list) and self.command == "POST" or url.path.endswith("/events"):
+            self._send_stream(status_code, response)
+        else:
+            self._send(status_code, response)
+
+    def _send(self, status_code: int, response) -> None:
+        if response is None:
+            content = b""
+        elif isinstance(response, str):
+            content = response.encode("utf-8")
+        else:
+            content = json.dumps(response).encode("utf-8")
+
+        self.send_response(status_code)
+        self.send_header("Api-Version", API_VERSION)
+        self.send_header("Content-Type", "text/plain" if isinstance(response, str) else "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(content)
+
+    def _send_stream(self, status_code: int, lines: list) -> None:
+        """Send JSON lines with chunked encoding, as the Docker daemon does for pulls and events."""
+
+        self.send_response(status_code)
+        self.send_header("Api-Version", API_VERSION)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for line in lines:
+            chunk = (json.dumps(line) + "\r\n").encode("utf-8")
+            self.wfile.write("{:x}\r\n".format(len(chunk)).encode("ascii") + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_DELETE = _handle
+    do_HEAD = _handle
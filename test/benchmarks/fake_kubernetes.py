@@ -0,0 +1,483 @@
+"""
+In-memory stand-in for the Kubernetes API server, used by the Kubernetes spawner load test. It implements the core/v1
+endpoints that KubeSpawner, its reflectors, and the MLHub spawner use: pods, events, services, and persistent volume claims
+with list, watch, create, read, and delete. Created pods become `Running` after a configurable time and disappear after
+a grace period once deleted, and the corresponding watch events are streamed to all watchers.
+Every endpoint can be given an artificial latency and an injected error status (e.g. 409 or 404) with a given rate.
+
+Example:
+    server = FakeKubernetesServer(latency={"services.create": 0.02}, failures={"services.create": (409, 0.1)})
+    server.start()
+    kubeconfig = server.write_kubeconfig(directory)
+"""
+
+import collections
+import heapq
+import json
+import os
+import queue
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Resource kinds served by the fake API server: plural -> kind
+RESOURCES = {
+    "pods": "Pod",
+    "events": "Event",
+    "services": "Service",
+    "persistentvolumeclaims": "PersistentVolumeClaim",
+}
+
+COLLECTION_PATH = re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)/(?P<plural>[a-z]+)$")
+OBJECT_PATH = re.compile(r"^/api/v1/namespaces/(?P<namespace>[^/]+)/(?P<plural>[a-z]+)/(?P<name>[^/]+)$")
+
+# Number of watch events that are kept, so that a watch started with an older resource version gets the events it missed
+WATCH_HISTORY_SIZE = 200000
+DEFAULT_WATCH_TIMEOUT_SECONDS = 300
+
+class KubernetesAPIError(Exception):
+
+    def __init__(self, code: int, reason: str, message: str):
+        super().__init__(message)
+        self.code = code
+        self.reason = reason
+        self.message = message
+
+    def to_status(self) -> dict:
+        return {"kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Failure",
+            "message": self.message, "reason": self.reason, "code": self.code}
+
+REASONS = {400: "BadRequest", 403: "Forbidden", 404: "NotFound", 409: "AlreadyExists", 410: "Expired", 422: "Invalid", 500: "InternalError"}
+
+def now_timestamp() -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+def parse_label_selector(selector: str) -> list:
+    """Parse a label selector such as 'a=b,c!=d,e,f in (g,h)' into (key, operator, values) requirements."""
+
+    requirements = []
+    for requirement in re.findall(r"[^,(]+(?:\([^)]*\))?", selector or ""):
+        requirement = requirement.strip()
+        if not requirement:
+            continue
+        match = re.match(r"^(\S+)\s+(in|notin)\s+\((.*)\)$", requirement)
+        if match:
+            requirements.append((match.group(1), match.group(2), {value.strip() for value in match.group(3).split(",")}))
+        elif "!=" in requirement:
+            key, value = requirement.split("!=", 1)
+            requirements.append((key.strip(), "notin", {value.strip()}))
+        elif "=" in requirement:
+            key, value = requirement.replace("==", "=").split("=", 1)
+            requirements.append((key.strip(), "in", {value.strip()}))
+        elif requirement.startswith("!"):
+            requirements.append((requirement[1:].strip(), "!", set()))
+        else:
+            requirements.append((requirement, "exists", set()))
+    return requirements
+
+def matches_labels(labels: dict, requirements: list) -> bool:
+    for key, operator, values in requirements:
+        if operator == "in" and labels.get(key) not in values:
+            return False
+        if operator == "notin" and labels.get(key) in values:
+            return False
+        if operator == "exists" and key not in labels:
+            return False
+        if operator == "!" and key in labels:
+            return False
+    return True
+
+class Watcher():
+
+    def __init__(self, plural: str, namespace: str, requirements: list):
+        self.plural = plural
+        self.namespace = namespace
+        self.requirements = requirements
+        self.events = queue.Queue()
+
+    def matches(self, plural: str, obj: dict) -> bool:
+        return plural == self.plural and obj["metadata"]["namespace"] == self.namespace \
+            and matches_labels(obj["metadata"].get("labels") or {}, self.requirements)
+
+class FakeKubernetesServer():
+    """Fake Kubernetes API server listening on a local TCP port.
+
+    Args:
+        latency (dict): seconds to delay each endpoint, e.g. {"pods.create": 0.05}; `default` applies to all other endpoints
+        failures (dict): injected errors per endpoint as (status code, rate), e.g. {"services.create": (409, 0.1), "pods.delete": (404, 0.05)}.
+            An injected 409 on create or 404 on delete still applies the operation, as if another client did it concurrently.
+        pod_start_seconds (float): seconds until a created pod is running
+        pod_stop_seconds (float): seconds until a deleted pod is gone
+        seed (int): seed of the failure injection, so that runs are reproducible
+    """
+
+    def __init__(self, latency: dict = None, failures: dict = None, pod_start_seconds: float = 0.5, pod_stop_seconds: float = 0.2, seed: int = 42):
+        self.latency = dict(latency or {})
+        self.failures = dict(failures or {})
+        self.pod_start_seconds = pod_start_seconds
+        self.pod_stop_seconds = pod_stop_seconds
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.objects = {plural: {} for plural in RESOURCES}
+        self.resource_version = 1
+        self.history = collections.deque(maxlen=WATCH_HISTORY_SIZE)
+        self.watchers = []
+        self.calls = collections.Counter()
+        self.next_pod_ip = 1
+
+        self.stopped = threading.Event()
+        self._timers = []
+        self._timers_changed = threading.Condition(self.lock)
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self) -> None:
+        server = self
+
+        class Handler(FakeKubernetesRequestHandler):
+            pass
+        Handler.api_server = server
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        threading.Thread(target=self.server.serve_forever, name="fake-kubernetes-api", daemon=True).start()
+        threading.Thread(target=self._run_timers, name="fake-kubernetes-timers", daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        with self.lock:
+            self._timers_changed.notify_all()
+            for watcher in self.watchers:
+                watcher.events.put(None)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def write_kubeconfig(self, directory: str, namespace: str = "default") -> str:
+        """Write a kubeconfig pointing to this server, e.g. to set it as KUBECONFIG for `config.load_kube_config`."""
+
+        path = os.path.join(directory, "kubeconfig")
+        with open(path, "w") as f:
+            # JSON is valid YAML
+            json.dump({
+                "apiVersion": "v1",
+                "kind": "Config",
+                "clusters": [{"name": "fake", "cluster": {"server": self.url}}],
+                "users": [{"name": "fake", "user": {"token": "fake-token"}}],
+                "contexts": [{"name": "fake", "context": {"cluster": "fake", "user": "fake", "namespace": namespace}}],
+                "current-context": "fake"
+            }, f)
+        return path
+
+    def get_calls(self) -> dict:
+        with self.lock:
+            return dict(self.calls)
+
+    def reset_calls(self) -> None:
+        with self.lock:
+            self.calls.clear()
+
+    def count(self, plural: str) -> int:
+        with self.lock:
+            return len(self.objects[plural])
+
+    def exists(self, plural: str, namespace: str, name: str) -> bool:
+        with self.lock:
+            return (namespace, name) in self.objects[plural]
+
+    def handle(self, method: str, path: str, query: dict, body: dict):
+        """Dispatch a request.
+
+        Returns:
+            (int, object): status code and JSON body, or a Watcher whose events have to be streamed
+        """
+
+        match = OBJECT_PATH.match(path) or COLLECTION_PATH.match(path)
+        if not match or match.group("plural") not in RESOURCES:
+            return 404, KubernetesAPIError(404, "NotFound", "the server could not find the requested resource").to_status()
+
+        plural = match.group("plural")
+        namespace = match.group("namespace")
+        name = match.groupdict().get("name")
+        is_watch = query.get("watch", ["false"])[0].lower() in ("1", "true")
+        verb = {"GET": "watch" if is_watch else ("read" if name else "list"), "POST": "create",
+            "DELETE": "delete" if name else "deletecollection"}.get(method)
+        if verb is None:
+            return 405, KubernetesAPIError(405, "MethodNotAllowed", "method not allowed").to_status()
+        endpoint = "{}.{}".format(plural, verb)
+
+        with self.lock:
+            self.calls[endpoint] += 1
+            failure = self.failures.get(endpoint)
+            injected_status = failure[0] if failure and self.random.random() < failure[1] else None
+
+        delay = self.latency.get(endpoint, self.latency.get("default", 0))
+        if delay:
+            time.sleep(delay)
+        injected_error = None
+        if injected_status:
+            injected_error = KubernetesAPIError(injected_status, REASONS.get(injected_status, "Unknown"), "injected failure of {}".format(endpoint))
+            # A 409 on create and a 404 on delete simulate a concurrent actor that created or deleted the object in the meantime,
+            # so the operation is applied nevertheless. All other injected errors fail the call without changing anything.
+            if not (injected_status == 409 and verb == "create" or injected_status == 404 and verb == "delete"):
+                return injected_status, injected_error.to_status()
+
+        requirements = parse_label_selector(query.get("labelSelector", [""])[0])
+        try:
+            if injected_error is not None:
+                if verb == "create":
+                    self._create(plural, namespace, body or {})
+                else:
+                    self._delete(plural, namespace, name)
+                return injected_status, injected_error.to_status()
+            if verb == "watch":
+                resource_version = int(query.get("resourceVersion", ["0"])[0] or 0)
+                timeout_seconds = int(query.get("timeoutSeconds", [DEFAULT_WATCH_TIMEOUT_SECONDS])[0])
+                return 200, (self._watch(plural, namespace, requirements, resource_version), timeout_seconds)
+            if verb == "list":
+                return 200, self._list(plural, namespace, requirements)
+            if verb == "read":
+                with self.lock:
+                    return 200, self._get(plural, namespace, name)
+            if verb == "create":
+                return 201, self._create(plural, namespace, body or {})
+            if verb == "delete":
+                return 200, self._delete(plural, namespace, name)
+            return 200, self._delete_collection(plural, namespace, requirements)
+        except KubernetesAPIError as e:
+            return e.code, e.to_status()
+
+    def stop_watch(self, watcher: Watcher) -> None:
+        with self.lock:
+            if watcher in self.watchers:
+                self.watchers.remove(watcher)
+
+    def _list(self, plural: str, namespace: str, requirements: list) -> dict:
+        with self.lock:
+            items = [obj for (obj_namespace, _), obj in self.objects[plural].items()
+                if obj_namespace == namespace and matches_labels(obj["metadata"].get("labels") or {}, requirements)]
+            return {"kind": RESOURCES[plural] + "List", "apiVersion": "v1", "metadata": {"resourceVersion": str(self.resource_version)}, "items": items}
+
+    def _watch(self, plural: str, namespace: str, requirements: list, resource_version: int) -> Watcher:
+        watcher = Watcher(plural, namespace, requirements)
+        with self.lock:
+            if resource_version and self.history and self.history[0][0] > resource_version + 1:
+                watcher.events.put({"type": "ERROR", "object": KubernetesAPIError(410, "Expired", "too old resource version").to_status()})
+                watcher.events.put(None)
+                return watcher
+            if resource_version:
+                for event_resource_version, event_plural, event in self.history:
+                    if event_resource_version > resource_version and watcher.matches(event_plural, event["object"]):
+                        watcher.events.put(event)
+            self.watchers.append(watcher)
+        return watcher
+
+    def _get(self, plural: str, namespace: str, name: str) -> dict:
+        obj = self.objects[plural].get((namespace, name))
+        if obj is None:
+            raise KubernetesAPIError(404, "NotFound", '{} "{}" not found'.format(plural, name))
+        return obj
+
+    def _create(self, plural: str, namespace: str, body: dict) -> dict:
+        metadata = dict(body.get("metadata") or {})
+        name = metadata.get("name") or "{}{}".format(metadata.get("generateName", "obj-"), uuid.uuid4().hex[:5])
+        with self.lock:
+            if (namespace, name) in self.objects[plural]:
+                raise KubernetesAPIError(409, "AlreadyExists", '{} "{}" already exists'.format(plural, name))
+            metadata.update({"name": name, "namespace": namespace, "uid": str(uuid.uuid4()), "creationTimestamp": now_timestamp()})
+            obj = dict(body, apiVersion="v1", kind=RESOURCES[plural], metadata=metadata)
+            if plural == "pods":
+                obj["status"] = {"phase": "Pending", "conditions": []}
+                self._add_pod_event(obj, "Scheduled", "Successfully assigned {}/{} to fake-node".format(namespace, name))
+                self._schedule(self.pod_start_seconds, self._run_pod, namespace, name)
+            elif plural == "services":
+                obj["spec"] = dict(obj.get("spec") or {})
+                if obj["spec"].get("clusterIP") != "None":
+                    obj["spec"]["clusterIP"] = "10.96.{}.{}".format(len(self.objects[plural]) // 250 % 250, len(self.objects[plural]) % 250 + 1)
+            elif plural == "persistentvolumeclaims":
+                obj["status"] = {"phase": "Bound"}
+            self._store(plural, obj, "ADDED")
+            return obj
+
+    def _delete(self, plural: str, namespace: str, name: str) -> dict:
+        with self.lock:
+            obj = self._get(plural, namespace, name)
+            if plural != "pods":
+                self._remove(plural, obj)
+                return {"kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Success", "details": {"name": name, "kind": plural}}
+
+            if not obj["metadata"].get("deletionTimestamp"):
+                obj = dict(obj, metadata=dict(obj["metadata"], deletionTimestamp=now_timestamp()))
+                self._store(plural, obj, "MODIFIED")
+                self._add_pod_event(obj, "Killing", "Stopping container notebook")
+                self._schedule(self.pod_stop_seconds, self._remove_pod, namespace, name)
+            return obj
+
+    def _delete_collection(self, plural: str, namespace: str, requirements: list) -> dict:
+        for obj in self._list(plural, namespace, requirements)["items"]:
+            try:
+                self._delete(plural, namespace, obj["metadata"]["name"])
+            except KubernetesAPIError:
+                pass
+        return {"kind": "Status", "apiVersion": "v1", "metadata": {}, "status": "Success"}
+
+    def _run_pod(self, namespace: str, name: str) -> None:
+        obj = self.objects["pods"].get((namespace, name))
+        if obj is None or obj["metadata"].get("deletionTimestamp"):
+            return
+        pod_ip = "10.{}.{}.{}".format(self.next_pod_ip // 62500 % 250, self.next_pod_ip // 250 % 250, self.next_pod_ip % 250 + 1)
+        self.next_pod_ip += 1
+        containers = (obj.get("spec") or {}).get("containers") or []
+        obj = dict(obj, status={
+            "phase": "Running",
+            "podIP": pod_ip,
+            "hostIP": "192.168.0.10",
+            "startTime": now_timestamp(),
+            "conditions": [{"type": "Ready", "status": "True"}],
+            "containerStatuses": [{
+                "name": container.get("name", "notebook"),
+                "image": container.get("image", ""),
+                "imageID": "docker-pullable://" + container.get("image", ""),
+                "ready": True,
+                "restartCount": 0,
+                "state": {"running": {"startedAt": now_timestamp()}}
+            } for container in containers]
+        })
+        self._add_pod_event(obj, "Pulled", "Container image already present on machine")
+        self._add_pod_event(obj, "Started", "Started container notebook")
+        self._store("pods", obj, "MODIFIED")
+
+    def _remove_pod(self, namespace: str, name: str) -> None:
+        obj = self.objects["pods"].get((namespace, name))
+        if obj is not None:
+            self._remove("pods", obj)
+
+    def _add_pod_event(self, pod: dict, reason: str, message: str) -> None:
+        event = {
+            "apiVersion": "v1",
+            "kind": "Event",
+            "metadata": {"name": "{}.{}".format(pod["metadata"]["name"], uuid.uuid4().hex[:16]), "namespace": pod["metadata"]["namespace"],
+                "uid": str(uuid.uuid4()), "creationTimestamp": now_timestamp()},
+            "involvedObject": {"kind": "Pod", "name": pod["metadata"]["name"], "namespace": pod["metadata"]["namespace"], "uid": pod["metadata"]["uid"]},
+            "reason": reason,
+            "message": message,
+            "type": "Normal",
+            "count": 1,
+            "firstTimestamp": now_timestamp(),
+            "lastTimestamp": now_timestamp(),
+            "source": {"component": "kubelet"}
+        }
+        self._store("events", event, "ADDED")
+
+    def _store(self, plural: str, obj: dict, event_type: str) -> None:
+        """Store an object with a new resource version and notify the watchers. Must be called with the lock held."""
+
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        self.objects[plural][(obj["metadata"]["namespace"], obj["metadata"]["name"])] = obj
+        self._notify(plural, {"type": event_type, "object": obj})
+
+    def _remove(self, plural: str, obj: dict) -> None:
+        self.resource_version += 1
+        obj = dict(obj, metadata=dict(obj["metadata"], resourceVersion=str(self.resource_version)))
+        del self.objects[plural][(obj["metadata"]["namespace"], obj["metadata"]["name"])]
+        self._notify(plural, {"type": "DELETED", "object": obj})
+
+    def _notify(self, plural: str, event: dict) -> None:
+        self.history.append((self.resource_version, plural, event))
+        for watcher in self.watchers:
+            if watcher.matches(plural, event["object"]):
+                watcher.events.put(event)
+
+    def _schedule(self, delay_seconds: float, callback, *args) -> None:
+        """Run the callback with the lock held after the delay. Must be called with the lock held."""
+
+        heapq.heappush(self._timers, (time.monotonic() + delay_seconds, uuid.uuid4().int, callback, args))
+        self._timers_changed.notify()
+
+    def _run_timers(self) -> None:
+        with self.lock:
+            while not self.stopped.is_set():
+                if not self._timers:
+                    self._timers_changed.wait()
+                    continue
+                due_time = self._timers[0][0]
+                if due_time > time.monotonic():
+                    self._timers_changed.wait(due_time - time.monotonic())
+                    continue
+                _, _, callback, args = heapq.heappop(self._timers)
+                callback(*args)
+
+class FakeKubernetesRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api_server = None
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately, which would wait for the delayed ACK of the client otherwise
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        url = urlparse(self.path)
+        body = None
+        content_length = int(self.headers.get("Content-Length") or 0)
+        if content_length:
+            raw_body = self.rfile.read(content_length)
+            if raw_body:
+                body = json.loads(raw_body.decode("utf-8"))
+
+        status_code, response = self.api_server.handle(self.command, url.path, parse_qs(url.query), body)
+        if isinstance(response, tuple):
+            self._stream_watch(*response)
+            return
+
+        content = json.dumps(response).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _stream_watch(self, watcher: Watcher, timeout_seconds: int) -> None:
+        """Stream the watch events as JSON lines with chunked encoding until the watch times out or the client disconnects."""
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        deadline = time.monotonic() + timeout_seconds
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    event = watcher.events.get(timeout=min(1, max(0.01, deadline - time.monotonic())))
+                except queue.Empty:
+                    continue
+                if event is None:
+                    break
+                chunk = (json.dumps(event) + "\n").encode("utf-8")
+                self.wfile.write("{:x}\r\n".format(len(chunk)).encode("ascii") + chunk + b"\r\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.api_server.stop_watch(watcher)
+            self.close_connection = True
+
+    do_GET = _handle
+    do_POST = _handle
+    do_DELETE = _handle
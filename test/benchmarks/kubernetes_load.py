@@ -0,0 +1,244 @@
+"""
+Load test of the MLHubKubernetesSpawner against a fake Kubernetes API server (see fake_kubernetes.py).
+For every concurrency level, that many real spawner instances are started at the same time (pod + Service creation),
+then stopped (pod + Service deletion). Reported are the spawns per second, the start latencies (also without the wait for a
+free spawn slot, see --max-concurrent-spawns), the extra time of the per-pod Service step, the API calls per spawn, and the
+memory the shared pod and event reflectors hold with all pods running.
+A started workspace without its routing Service (e.g. after KubeSpawner replaced a leftover pod, which an injected
+pods.create=409 simulates) counts as failed spawn.
+
+Usage (from the repository root, with the mlhubspawner dependencies installed):
+    python test/benchmarks/kubernetes_load.py --concurrency 1 100 1000
+    python test/benchmarks/kubernetes_load.py --inject services.create=409:0.1 --inject pods.delete=404:0.05
+    python test/benchmarks/kubernetes_load.py --inject pods.create=409:0.2
+    python test/benchmarks/kubernetes_load.py --routing-mode headless
+    python test/benchmarks/kubernetes_load.py --save-baseline
+"""
+
+import asyncio
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "resources", "mlhubspawner"))
+
+from kubernetes.config import kube_config
+from traitlets.config import Config
+
+from mlhubspawner import MLHubKubernetesSpawner, metrics
+
+import benchmark
+import fake_kubernetes
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "baselines", "kubernetes_load.json")
+
+NAMESPACE = "mlhub"
+WORKSPACE_IMAGE = "mltooling/ml-workspace:0.9.1"
+
+class BenchmarkHub():
+    public_host = ""
+    base_url = "/hub/"
+    api_url = "http://hub:8081/hub/api"
+    url = "http://hub:8081/hub/"
+
+class BenchmarkUser():
+
+    def __init__(self, user_id: int, name: str):
+        self.id = user_id
+        self.name = name
+        self.escaped_name = name
+        self.url = "/user/{}/".format(name)
+
+def parse_injections(values: list) -> dict:
+    """Parse arguments such as ['services.create=409:0.1'] into {'services.create': (409, 0.1)}."""
+
+    injections = {}
+    for value in values or []:
+        endpoint, _, failure = value.partition("=")
+        status_code, _, rate = failure.partition(":")
+        injections[endpoint] = (int(status_code), float(rate))
+    return injections
+
+def parse_latencies(values: list) -> dict:
+    latencies = {}
+    for value in values or []:
+        endpoint, _, seconds = value.partition("=")
+        latencies[endpoint] = float(seconds)
+    return latencies
+
+def get_deep_size(obj, seen: set = None) -> int:
+    """Approximate memory of an object graph, e.g. of the kubernetes model objects held by a reflector."""
+
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(get_deep_size(key, seen) + get_deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(get_deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        size += get_deep_size(vars(obj), seen)
+    return size
+
+def create_spawner(config: Config, user_id: int, user_name: str) -> MLHubKubernetesSpawner:
+    spawner = MLHubKubernetesSpawner(user=BenchmarkUser(user_id, user_name), hub=BenchmarkHub(), name="workspace", config=config)
+    spawner.api_token = "benchmark-token"
+    spawner.user_options = {}
+    return spawner
+
+async def start_workspace(spawner: MLHubKubernetesSpawner) -> dict:
+    result = {}
+    try:
+        start_time = time.perf_counter()
+        await spawner.start()
+        result["start_seconds"] = time.perf_counter() - start_time
+        result["service_seconds"] = spawner.spawn_trace.phases.get(metrics.PHASE_SERVICE_CREATE, 0)
+        # the time spent waiting for a free spawn slot does not load the API server
+        result["active_seconds"] = result["start_seconds"] - spawner.spawn_trace.phases.get(metrics.PHASE_ADMISSION_WAIT, 0)
+    except Exception as e:
+        result["error"] = "start: {}: {}".format(type(e).__name__, str(e).splitlines()[0] if str(e) else "")
+    return result
+
+async def stop_workspace(spawner: MLHubKubernetesSpawner) -> dict:
+    result = {}
+    try:
+        stop_time = time.perf_counter()
+        await spawner.stop()
+        result["stop_seconds"] = time.perf_counter() - stop_time
+    except Exception as e:
+        result["error"] = "stop: {}: {}".format(type(e).__name__, str(e).splitlines()[0] if str(e) else "")
+    return result
+
+def print_errors(results: list) -> int:
+    # remove the names, so that the same error of different spawns is reported once
+    errors = [re.sub(r"bench\d+x\d+", "<user>", result["error"]) for result in results if "error" in result]
+    for error in sorted(set(errors)):
+        print("  {}x {}".format(errors.count(error), error))
+    return len(errors)
+
+async def run_level(api_server: fake_kubernetes.FakeKubernetesServer, config: Config, concurrency: int, level_index: int) -> dict:
+    spawners = [create_spawner(config, level_index * 100000 + i, "bench{}x{}".format(level_index, i)) for i in range(concurrency)]
+    api_server.reset_calls()
+
+    start_time = time.perf_counter()
+    start_results = await asyncio.gather(*(start_workspace(spawner) for spawner in spawners))
+    start_total_seconds = time.perf_counter() - start_time
+
+    # all pods of this level are running now, so the reflectors hold their maximum
+    pod_reflector = spawners[0].pod_reflector
+    event_reflector = spawners[0].event_reflector
+    pod_count = len(pod_reflector.pods)
+    pod_reflector_bytes = get_deep_size(dict(pod_reflector.pods))
+    event_reflector_bytes = get_deep_size(dict(event_reflector.resources)) if event_reflector else 0
+    service_count = api_server.count("services")
+    for spawner, result in zip(spawners, start_results):
+        service_name = spawner.headless_service_name if spawner.is_headless_routing() else spawner.pod_name
+        if "error" not in result and not api_server.exists("services", NAMESPACE, service_name):
+            result["error"] = "start: the workspace has no Service {}".format(service_name)
+
+    stop_results = await asyncio.gather(*(stop_workspace(spawner) for spawner in spawners))
+    # the per-pod Services of stopped and of failed spawns are deleted, the shared headless Service is kept
+    leftover_service_count = api_server.count("services") - (1 if spawners[0].is_headless_routing() else 0)
+    calls = api_server.get_calls()
+    failures = print_errors(start_results) + print_errors(stop_results)
+
+    start_latencies = sorted(result["start_seconds"] for result in start_results if "start_seconds" in result)
+    service_latencies = sorted(result["service_seconds"] for result in start_results if "start_seconds" in result)
+    active_latencies = sorted(result["active_seconds"] for result in start_results if "start_seconds" in result)
+    stop_latencies = sorted(result["stop_seconds"] for result in stop_results if "stop_seconds" in result)
+    return {
+        "calls": concurrency,
+        "failures": failures,
+        "ops_per_second": round(len(start_latencies) / start_total_seconds, 1) if start_total_seconds else 0.0,
+        "p50_us": round(benchmark.percentile(start_latencies, 0.50) * 1e6, 2),
+        "p99_us": round(benchmark.percentile(start_latencies, 0.99) * 1e6, 2),
+        "max_us": round(start_latencies[-1] * 1e6, 2) if start_latencies else 0.0,
+        "active_p50_us": round(benchmark.percentile(active_latencies, 0.50) * 1e6, 2),
+        "active_p99_us": round(benchmark.percentile(active_latencies, 0.99) * 1e6, 2),
+        "service_step_p50_us": round(benchmark.percentile(service_latencies, 0.50) * 1e6, 2),
+        "service_step_p99_us": round(benchmark.percentile(service_latencies, 0.99) * 1e6, 2),
+        "service_step_share": round(sum(service_latencies) / sum(start_latencies), 4) if start_latencies else 0.0,
+        "stop_p50_us": round(benchmark.percentile(stop_latencies, 0.50) * 1e6, 2),
+        "running_pods": pod_count,
+        "services": service_count,
+        "leftover_services": leftover_service_count,
+        "pod_reflector_bytes": pod_reflector_bytes,
+        "pod_reflector_bytes_per_pod": round(pod_reflector_bytes / pod_count) if pod_count else 0,
+        "event_reflector_bytes": event_reflector_bytes,
+        "api_calls_per_spawn": round(sum(value for key, value in calls.items() if not key.endswith(".watch")) / concurrency, 2),
+        "api_calls": calls
+    }
+
+async def run_levels(api_server: fake_kubernetes.FakeKubernetesServer, config: Config, concurrency_levels: list) -> dict:
+    results = {}
+    for level_index, concurrency in enumerate(concurrency_levels):
+        print("Run {} concurrent spawns".format(concurrency))
+        results["kubernetes_spawn_concurrency_{}".format(concurrency)] = await run_level(api_server, config, concurrency, level_index)
+    return results
+
+def main():
+    parser = benchmark.get_argument_parser(__doc__.strip().splitlines()[0], BASELINE_FILE)
+    parser.add_argument("--concurrency", help="numbers of concurrent spawns", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--latency", help="default latency of every API call in seconds", type=float, default=0.005)
+    parser.add_argument("--endpoint-latency", help="latency of an endpoint, e.g. services.create=0.05", action="append")
+    parser.add_argument("--inject", help="inject an error status with a rate, e.g. services.create=409:0.1 or pods.delete=404:0.05", action="append")
+    parser.add_argument("--pod-start-seconds", help="seconds until a created pod is running", type=float, default=0.5)
+    parser.add_argument("--pod-stop-seconds", help="seconds until a deleted pod is gone", type=float, default=0.2)
+    parser.add_argument("--threadpool-workers", help="c.KubeSpawner.k8s_api_threadpool_workers", type=int, default=None)
+    parser.add_argument("--routing-mode", help="c.MLHubKubernetesSpawner.routing_mode", choices=["service", "headless"], default="service")
+    parser.add_argument("--max-concurrent-spawns", help="c.MLHubKubernetesSpawner.max_concurrent_spawns (0 disables the admission limit)", type=int, default=20)
+    parser.add_argument("--spawn-queue-size", help="c.MLHubKubernetesSpawner.spawn_queue_size", type=int, default=100000)
+    args = parser.parse_args()
+
+    logging.getLogger("traitlets").setLevel(logging.ERROR)
+    # e.g. "Connection pool is full" of the kubernetes client for every concurrent call beyond its pool size
+    logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
+
+    latency = {"default": args.latency}
+    latency.update(parse_latencies(args.endpoint_latency))
+    api_server = fake_kubernetes.FakeKubernetesServer(
+        latency=latency,
+        failures=parse_injections(args.inject),
+        pod_start_seconds=args.pod_start_seconds,
+        pod_stop_seconds=args.pod_stop_seconds
+    )
+    api_server.start()
+
+    config = Config()
+    config.MLHubKubernetesSpawner.namespace = NAMESPACE
+    config.MLHubKubernetesSpawner.image = WORKSPACE_IMAGE
+    config.MLHubKubernetesSpawner.start_timeout = 600
+    config.MLHubKubernetesSpawner.routing_mode = args.routing_mode
+    config.MLHubKubernetesSpawner.max_concurrent_spawns = args.max_concurrent_spawns
+    config.MLHubKubernetesSpawner.spawn_queue_size = args.spawn_queue_size
+    if args.threadpool_workers:
+        config.MLHubKubernetesSpawner.k8s_api_threadpool_workers = args.threadpool_workers
+
+    with tempfile.TemporaryDirectory() as directory:
+        # the spawner's reflectors load the kubeconfig if they do not run inside a cluster
+        os.environ.pop("KUBERNETES_SERVICE_HOST", None)
+        os.environ["KUBECONFIG"] = api_server.write_kubeconfig(directory, NAMESPACE)
+        # the kubernetes client reads KUBECONFIG on import
+        kube_config.KUBE_CONFIG_DEFAULT_LOCATION = os.environ["KUBECONFIG"]
+        try:
+            results = asyncio.run(run_levels(api_server, config, args.concurrency))
+        finally:
+            api_server.stop()
+
+    for name, result in results.items():
+        print("{}: {} API calls per spawn, Service step {:.1%} of the start time (p50 {:.0f}ms), pod reflector {:.1f} KB per pod, {} failures".format(
+            name, result["api_calls_per_spawn"], result["service_step_share"], result["service_step_p50_us"] / 1000,
+            result["pod_reflector_bytes_per_pod"] / 1024, result["failures"]))
+        if result["leftover_services"]:
+            print("  {} Services were not deleted".format(result["leftover_services"]))
+    benchmark.finish(args, results)
+
+if __name__ == "__main__":
+    main()
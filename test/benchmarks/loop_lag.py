@@ -0,0 +1,98 @@
+"""
+Event loop lag check of the MLHubDockerSpawner against a slow fake Docker daemon (see fake_docker.py).
+Concurrent spawns are started while a periodic callback measures how late the event loop runs it. Every Docker call of the
+fake daemon takes --latency seconds, so a single blocking call on the event loop delays the callbacks by at least that much.
+The check fails (exit code 1) if the maximum callback latency exceeds --max-lag.
+
+Usage (from the repository root, with the mlhubspawner dependencies installed):
+    python test/benchmarks/loop_lag.py
+    python test/benchmarks/loop_lag.py --concurrency 100 --latency 0.5 --max-lag 0.2
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+from traitlets.config import Config
+
+import benchmark
+import fake_docker
+import spawn_throughput
+
+# Seconds between two runs of the callback that measures the lag
+PROBE_INTERVAL_SECONDS = 0.01
+
+async def measure_lag(stopped: asyncio.Event) -> list:
+    """Run a callback every PROBE_INTERVAL_SECONDS until `stopped` is set.
+
+    Returns:
+        list: the sorted delays in seconds by which the callback ran later than scheduled
+    """
+
+    lags = []
+    while not stopped.is_set():
+        scheduled_time = time.perf_counter() + PROBE_INTERVAL_SECONDS
+        await asyncio.sleep(PROBE_INTERVAL_SECONDS)
+        lags.append(max(0.0, time.perf_counter() - scheduled_time))
+    return sorted(lags)
+
+async def run_check(config: Config, concurrency: int) -> dict:
+    spawners = [spawn_throughput.create_spawner(config, "lag{}".format(i)) for i in range(concurrency)]
+    stopped = asyncio.Event()
+    lag_task = asyncio.ensure_future(measure_lag(stopped))
+
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*(spawn_throughput.run_lifecycle(spawner) for spawner in spawners))
+    total_seconds = time.perf_counter() - start_time
+    stopped.set()
+    lags = await lag_task
+
+    errors = [result["error"] for result in results if "error" in result]
+    for error in sorted(set(errors)):
+        print("  {}x {}".format(errors.count(error), error))
+
+    return {
+        "failures": len(errors),
+        "seconds": round(total_seconds, 2),
+        "lag_p50_us": round(benchmark.percentile(lags, 0.50) * 1e6, 2),
+        "lag_p99_us": round(benchmark.percentile(lags, 0.99) * 1e6, 2),
+        "lag_max_us": round(lags[-1] * 1e6, 2) if lags else 0.0
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", help="number of concurrent spawns", type=int, default=50)
+    parser.add_argument("--latency", help="latency of every Docker API call in seconds", type=float, default=0.25)
+    parser.add_argument("--max-lag", help="maximum allowed callback latency in seconds", type=float, default=0.1)
+    parser.add_argument("--executor-size", help="c.MLHubDockerSpawner.executor_size", type=int, default=10)
+    args = parser.parse_args()
+
+    logging.getLogger("traitlets").setLevel(logging.ERROR)
+
+    daemon = fake_docker.FakeDockerDaemon(latency={"default": args.latency}, images=[spawn_throughput.WORKSPACE_IMAGE])
+    daemon.start()
+
+    config = Config()
+    config.MLHubDockerSpawner.image = spawn_throughput.WORKSPACE_IMAGE
+    config.MLHubDockerSpawner.client_kwargs = {"base_url": daemon.base_url}
+    config.MLHubDockerSpawner.executor_size = args.executor_size
+    # all spawns talk to the daemon at the same time
+    config.MLHubDockerSpawner.max_concurrent_spawns = 0
+
+    try:
+        print("Run {} concurrent spawns with {}s per Docker call".format(args.concurrency, args.latency))
+        result = asyncio.run(run_check(config, args.concurrency))
+    finally:
+        daemon.stop()
+
+    print("{} failed spawns in {}s, callback latency p50 {}us, p99 {}us, max {}us".format(
+        result["failures"], result["seconds"], result["lag_p50_us"], result["lag_p99_us"], result["lag_max_us"]))
+    if result["failures"] or result["lag_max_us"] > args.max_lag * 1e6:
+        print("The event loop was blocked for more than {}s or spawns failed".format(args.max_lag))
+        sys.exit(1)
+    print("The event loop was never blocked for more than {}s".format(args.max_lag))
+
+if __name__ == "__main__":
+    main()
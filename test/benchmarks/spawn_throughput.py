@@ -0,0 +1,158 @@
+"""
+Spawn throughput benchmark of the MLHubDockerSpawner against a fake Docker daemon (see fake_docker.py).
+For every concurrency level, that many real spawner instances are started at the same time (which creates their networks
+and containers), then stopped and removed. Reported are the spawns per second, the start latencies (also without the wait
+for a free spawn slot, see --max-concurrent-spawns), and the number of Docker API calls per spawn.
+
+Usage (from the repository root, with the mlhubspawner dependencies installed):
+    python test/benchmarks/spawn_throughput.py --concurrency 1 50 500
+    python test/benchmarks/spawn_throughput.py --endpoint-latency containers.create=0.2 --failure-rate containers.start=0.01
+    python test/benchmarks/spawn_throughput.py --save-baseline
+"""
+
+import asyncio
+import logging
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "..", "resources", "mlhubspawner"))
+
+from traitlets.config import Config
+
+from mlhubspawner import MLHubDockerSpawner, metrics
+
+import benchmark
+import fake_docker
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "baselines", "spawn_throughput.json")
+
+WORKSPACE_IMAGE = "mltooling/ml-workspace:0.9.1"
+
+class BenchmarkHub():
+    public_host = ""
+    base_url = "/hub/"
+    api_url = "http://mlhub:8081/hub/api"
+    url = "http://mlhub:8081/hub/"
+
+class BenchmarkUser():
+
+    def __init__(self, name: str):
+        self.name = name
+        self.escaped_name = name
+        self.url = "/user/{}/".format(name)
+
+def parse_key_values(values: list) -> dict:
+    """Parse arguments such as ['containers.create=0.2'] into {'containers.create': 0.2}."""
+
+    parsed = {}
+    for value in values or []:
+        key, _, number = value.partition("=")
+        parsed[key] = float(number)
+    return parsed
+
+def create_spawner(config: Config, user_name: str) -> MLHubDockerSpawner:
+    spawner = MLHubDockerSpawner(user=BenchmarkUser(user_name), hub=BenchmarkHub(), name="workspace", config=config)
+    spawner.api_token = "benchmark-token"
+    spawner.user_options = {}
+    return spawner
+
+async def run_lifecycle(spawner: MLHubDockerSpawner) -> dict:
+    """Start, stop, and remove the workspace of the spawner.
+
+    Returns:
+        dict: `start_seconds`, `active_seconds` (without the admission wait), and `stop_seconds`, or the `error` of the failed step
+    """
+
+    result = {}
+    try:
+        start_time = time.perf_counter()
+        await spawner.start()
+        result["start_seconds"] = time.perf_counter() - start_time
+        # the time spent waiting for a free spawn slot does not load the daemon
+        result["active_seconds"] = result["start_seconds"] - spawner.spawn_trace.phases.get(metrics.PHASE_ADMISSION_WAIT, 0)
+
+        stop_time = time.perf_counter()
+        await spawner.stop()
+        await spawner.remove_object()
+        result["stop_seconds"] = time.perf_counter() - stop_time
+    except Exception as e:
+        # remove the ids, so that the same error of different spawns is reported once
+        result["error"] = re.sub(r"[0-9a-f]{12,}", "<id>", "{}: {}".format(type(e).__name__, str(e)))
+    return result
+
+async def run_level(daemon: fake_docker.FakeDockerDaemon, config: Config, concurrency: int, level_index: int) -> dict:
+    spawners = [create_spawner(config, "bench{}x{}".format(level_index, i)) for i in range(concurrency)]
+    daemon.reset_calls()
+
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*(run_lifecycle(spawner) for spawner in spawners))
+    total_seconds = time.perf_counter() - start_time
+
+    calls = daemon.get_calls()
+    start_latencies = sorted(result["start_seconds"] for result in results if "start_seconds" in result)
+    active_latencies = sorted(result["active_seconds"] for result in results if "active_seconds" in result)
+    stop_latencies = sorted(result["stop_seconds"] for result in results if "stop_seconds" in result)
+    errors = [result["error"] for result in results if "error" in result]
+    for error in sorted(set(errors)):
+        print("  {}x {}".format(errors.count(error), error))
+
+    return {
+        "calls": concurrency,
+        "failures": len(errors),
+        "ops_per_second": round(len(start_latencies) / total_seconds, 1) if total_seconds else 0.0,
+        "p50_us": round(benchmark.percentile(start_latencies, 0.50) * 1e6, 2),
+        "p99_us": round(benchmark.percentile(start_latencies, 0.99) * 1e6, 2),
+        "max_us": round(start_latencies[-1] * 1e6, 2) if start_latencies else 0.0,
+        "active_p50_us": round(benchmark.percentile(active_latencies, 0.50) * 1e6, 2),
+        "active_p99_us": round(benchmark.percentile(active_latencies, 0.99) * 1e6, 2),
+        "stop_p50_us": round(benchmark.percentile(stop_latencies, 0.50) * 1e6, 2),
+        "docker_calls_per_spawn": round(sum(calls.values()) / concurrency, 2),
+        "docker_calls": calls
+    }
+
+def main():
+    parser = benchmark.get_argument_parser(__doc__.strip().splitlines()[0], BASELINE_FILE)
+    parser.add_argument("--concurrency", help="numbers of concurrent spawns", type=int, nargs="+", default=[1, 50, 500])
+    parser.add_argument("--latency", help="default latency of every Docker API call in seconds", type=float, default=0.005)
+    parser.add_argument("--endpoint-latency", help="latency of an endpoint, e.g. containers.create=0.2", action="append")
+    parser.add_argument("--failure-rate", help="failure rate of an endpoint, e.g. containers.start=0.01", action="append")
+    parser.add_argument("--executor-size", help="c.MLHubDockerSpawner.executor_size", type=int, default=10)
+    parser.add_argument("--pull", help="let the first spawns pull the workspace image", action="store_true")
+    parser.add_argument("--max-concurrent-spawns", help="c.MLHubDockerSpawner.max_concurrent_spawns (0 disables the admission limit)", type=int, default=20)
+    parser.add_argument("--spawn-queue-size", help="c.MLHubDockerSpawner.spawn_queue_size", type=int, default=100000)
+    args = parser.parse_args()
+
+    logging.getLogger("traitlets").setLevel(logging.ERROR)
+
+    latency = {"default": args.latency}
+    latency.update(parse_key_values(args.endpoint_latency))
+    daemon = fake_docker.FakeDockerDaemon(
+        latency=latency,
+        failure_rates=parse_key_values(args.failure_rate),
+        images=[] if args.pull else [WORKSPACE_IMAGE]
+    )
+    daemon.start()
+
+    config = Config()
+    config.MLHubDockerSpawner.image = WORKSPACE_IMAGE
+    config.MLHubDockerSpawner.client_kwargs = {"base_url": daemon.base_url}
+    config.MLHubDockerSpawner.executor_size = args.executor_size
+    config.MLHubDockerSpawner.max_concurrent_spawns = args.max_concurrent_spawns
+    config.MLHubDockerSpawner.spawn_queue_size = args.spawn_queue_size
+
+    results = {}
+    try:
+        for level_index, concurrency in enumerate(args.concurrency):
+            print("Run {} concurrent spawns".format(concurrency))
+            results["spawn_concurrency_{}".format(concurrency)] = asyncio.run(run_level(daemon, config, concurrency, level_index))
+    finally:
+        daemon.stop()
+
+    for name, result in results.items():
+        print("{}: {} Docker API calls per spawn, {} failed spawns".format(name, result["docker_calls_per_spawn"], result["failures"]))
+    benchmark.finish(args, results)
+
+if __name__ == "__main__":
+    main()